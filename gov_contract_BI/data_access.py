@@ -0,0 +1,262 @@
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow  # parquet cache
+except ImportError:
+    pyarrow = None
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_CSV = os.path.join(APP_DIR, 'cleaned_gov_contracts_data.csv')
+SOURCE_URL = 'https://raw.githubusercontent.com/jryan814/datab-projects/main/gov_contract_BI/cleaned_gov_contracts_data.csv'
+# The pipeline's database (gov_contracts_pipeline/build_db.py), used instead of the csv when it exists
+PIPELINE_DB = os.path.join(APP_DIR, '..', 'gov_contracts_pipeline', 'data', 'gov_contracts.db')
+CACHE_DIR = os.path.join(APP_DIR, 'data_cache')
+CACHE_TTL = 60 * 60  # seconds before the source is checked for changes again
+CACHE_VERSION = 2  # part of the cache file names, bump when prepare() changes
+FIGURE_CACHE_SIZE = 256  # rendered company profiles kept per data load (see LRUCache)
+
+# source column -> app column, only these are loaded
+COLUMNS = {
+    'recipient_name': 'Company',
+    'naics_code': 'naics_code',
+    'award_id': 'number_of_awards',
+    'dollars_obligated': 'dollars_obligated',
+    'action_date': 'action_date'}
+DB_QUERY = f"SELECT {', '.join(COLUMNS)} FROM action_facts"
+
+
+def default_source():
+    return PIPELINE_DB if os.path.isfile(PIPELINE_DB) else SOURCE_CSV if os.path.isfile(SOURCE_CSV) else SOURCE_URL
+
+def source_files(source):
+    '''A local source's files: the file and, for the pipeline DB, its write-ahead log (see build_db.begin_bulk_load)
+    where new writes land until they're checkpointed into the DB file'''
+    return [f for f in (source, source + '-wal') if os.path.isfile(f)]
+
+def source_stamp(source):
+    '''Modification times and sizes of a local source's files (None for urls), a changed stamp invalidates the cache'''
+    if not os.path.isfile(source):
+        return None
+    return tuple((os.path.getmtime(f), os.path.getsize(f)) for f in source_files(source))
+
+def prepare(data):
+    '''Renames the columns and fixes the types the app expects'''
+    data = data[list(COLUMNS)].rename(columns=COLUMNS)
+    data['naics_code'] = data['naics_code'].astype(str).str.replace(r'\.0$', '', regex=True)
+    data['action_date'] = pd.to_datetime(data['action_date'])
+    return data.sort_values(['Company', 'action_date'], kind='stable').reset_index(drop=True)
+
+def cache_path(source):
+    '''The source's cache file, keyed on a hash of its full path or url (a url and a local copy share a basename)'''
+    name = os.path.splitext(os.path.basename(source))[0]
+    key = hashlib.sha1((source if '://' in source else os.path.abspath(source)).encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{name}.{key}.v{CACHE_VERSION}" + ('.parquet' if pyarrow else '.pkl'))
+
+def read_source(source):
+    '''Reads the app's columns from the pipeline DB (action_facts view) or a csv file/url'''
+    if source.endswith('.db'):
+        with closing(sqlite3.connect(f'file:{source}?mode=ro', uri=True)) as conn:
+            return prepare(pd.read_sql_query(DB_QUERY, conn))
+    return prepare(pd.read_csv(source, usecols=list(COLUMNS)))
+
+def load_frame(source, ttl=CACHE_TTL):
+    '''Reads the prepared frame from the columnar cache file, rebuilding it if the source (or its write-ahead log) is newer
+    (urls: if the file is older than ttl)
+        args:
+            source: (str) pipeline DB, csv file or url
+            ttl: (int) seconds
+        returns (pd.DataFrame)
+    '''
+    path = cache_path(source)
+    stamp = source_stamp(source)
+    if os.path.isfile(path):
+        modified = os.path.getmtime(path)
+        if (time.time() - modified < ttl) if stamp is None else all(modified >= mtime for mtime, _ in stamp):
+            return pd.read_parquet(path) if pyarrow else pd.read_pickle(path)
+    data = read_source(source)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if pyarrow:
+        data.to_parquet(path, index=False)
+    else:
+        data.to_pickle(path)
+    return data
+
+
+class ContractData:
+    '''
+    The app's contract actions with aggregates precomputed once per load:
+    company_naics (dollars and distinct awards per company and NAICS code, the all dates company profile),
+    naics_data (the same per NAICS code and company) and the row range of each company (rows are sorted by
+    company, then date), so a company's actions are a slice instead of a scan of the whole frame.
+    Date ranges are found by binary search, in the company's slice or in a date sorted index of all rows,
+    and select() only materializes the matching rows and requested columns.
+    profiles holds each company's all dates profile (see company_profile) and figures caches the app's
+    rendered profiles, both are rebuilt with the data.
+    '''
+    def __init__(self, data, source=None):
+        self.data = data
+        self.source = source
+        self.stamp = source_stamp(source) if source else None
+        self.checked_at = time.monotonic()
+        self.companies = data['Company'].unique()
+        self.naics_codes = data['naics_code'].unique()
+        aggs = {'dollars_obligated': 'sum', 'number_of_awards': 'nunique'}
+        self.company_naics = data.groupby(['Company', 'naics_code']).agg(aggs)
+        self.naics_data = data.groupby(['naics_code', 'Company']).agg(aggs).reset_index()
+        bounds = data.groupby('Company', sort=False).indices
+        self.company_rows = {co: (rows[0], rows[-1] + 1) for co, rows in bounds.items()}
+        self.dates = data['action_date'].to_numpy()
+        self.date_order = np.argsort(self.dates, kind='stable')
+        self.sorted_dates = self.dates[self.date_order]
+        self.naics = data['naics_code'].to_numpy()
+        self.profiles = {co: self._profile(totals.droplevel('Company'))
+                         for co, totals in self.company_naics.groupby(level='Company', sort=False)}
+        self.figures = LRUCache(FIGURE_CACHE_SIZE)
+
+    def company(self, co_name):
+        '''returns (pd.DataFrame) the company's actions, sorted by date'''
+        start, end = self.company_rows.get(co_name, (0, 0))
+        return self.data.iloc[start:end]
+
+    @staticmethod
+    def _search(dates, start_date, end_date):
+        '''Positions of the first and past the last action in the (inclusive) date range of sorted dates'''
+        lo = 0 if start_date is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date)), 'left')
+        end = None if end_date is None else np.datetime64(pd.Timestamp(end_date) + pd.Timedelta(days=1))
+        hi = len(dates) if end is None else np.searchsorted(dates, end, 'left')  # anything on the end date
+        return lo, max(lo, hi)
+
+    def rows(self, co_name=None, start_date=None, end_date=None, naics_codes=None):
+        '''Positions of the rows matching the filters (None -> not filtered)
+            args:
+                co_name: (str) company
+                start_date, end_date: (str/date) inclusive action date range
+                naics_codes: (list) NAICS codes
+            returns (np.ndarray) row positions, in frame order
+        '''
+        if co_name is not None:
+            start, end = self.company_rows.get(co_name, (0, 0))
+            lo, hi = self._search(self.dates[start:end], start_date, end_date)
+            positions = np.arange(start + lo, start + hi)
+        elif start_date is None and end_date is None:
+            positions = np.arange(len(self.dates))
+        else:
+            lo, hi = self._search(self.sorted_dates, start_date, end_date)
+            positions = np.sort(self.date_order[lo:hi])
+        if naics_codes is not None:
+            positions = positions[np.isin(self.naics[positions], list(naics_codes))]
+        return positions
+
+    def select(self, co_name=None, start_date=None, end_date=None, naics_codes=None, columns=None):
+        '''The rows matching the filters (see rows), with only the requested columns
+            returns (pd.DataFrame)
+        '''
+        positions = self.rows(co_name, start_date, end_date, naics_codes)
+        columns = [self.data.columns.get_loc(c) for c in columns] if columns else slice(None)
+        return self.data.iloc[positions, columns]
+
+    def company_naics_totals(self, co_name, start_date=None, end_date=None, naics_codes=None):
+        '''Dollars obligated and distinct awards per NAICS code for a company
+            args:
+                co_name: (str) company
+                start_date, end_date: (str/date) inclusive action date range, None -> all dates
+                naics_codes: (list) NAICS codes to include, None -> all
+            returns (pd.DataFrame) indexed by naics_code
+        '''
+        return self.company_profile(co_name, start_date, end_date, naics_codes)['naics']
+
+    @staticmethod
+    def _profile(totals):
+        return {
+            'naics': totals,
+            'dollar_total': round(totals['dollars_obligated'].sum(), 2),
+            'award_total': int(totals['number_of_awards'].sum())}
+
+    def company_profile(self, co_name, start_date=None, end_date=None, naics_codes=None):
+        '''A company's NAICS totals (see company_naics_totals), dollar_total and award_total (sum of the
+        per NAICS distinct awards). Read from profiles when the date range covers all the company's actions
+        and no NAICS codes are left out, otherwise aggregated from the company's rows in the range.
+            returns (dict)
+        '''
+        if co_name not in self.profiles:
+            return self._profile(self.company_naics.iloc[:0].droplevel('Company'))
+        profile = self.profiles[co_name]
+        start, end = self.company_rows[co_name]
+        lo, hi = self._search(self.dates[start:end], start_date, end_date)
+        if hi - lo == end - start:
+            if naics_codes is None or profile['naics'].index.isin(list(naics_codes)).all():
+                return profile
+            totals = profile['naics']
+            return self._profile(totals[totals.index.isin(list(naics_codes))])
+        co_data = self.select(co_name, start_date, end_date, naics_codes, ['naics_code', 'dollars_obligated', 'number_of_awards'])
+        return self._profile(co_data.groupby('naics_code').agg({'dollars_obligated': 'sum', 'number_of_awards': 'nunique'}))
+
+    def expired(self, ttl):
+        '''Whether the data is older than ttl seconds and its source has changed since it was loaded (urls always have)'''
+        if time.monotonic() - self.checked_at < ttl:
+            return False
+        self.checked_at = time.monotonic()
+        return self.source is not None and (self.stamp is None or source_stamp(self.source) != self.stamp)
+
+
+class LRUCache:
+    '''Thread-safe least recently used cache (the app's sessions share it)'''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        '''returns the cached value for key, calling build() for it if it isn't cached'''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+def get_data(source=None, ttl=CACHE_TTL):
+    '''
+    Shared ContractData for a source, loaded once per process (every app session and rerun reuses it).
+    The source is checked for changes every ttl seconds and reloaded if it changed.
+        args:
+            source: (str) pipeline DB, csv file or url. Defaults to default_source()
+            ttl: (int) seconds
+        returns (ContractData)
+    '''
+    source = source or default_source()
+    with _cache_lock:
+        contracts = _cache.get(source)
+        if contracts is None or contracts.expired(ttl):
+            contracts = _cache[source] = ContractData(load_frame(source, ttl), source)
+        return contracts
+
+def invalidate(source=None, remove_files=False):
+    '''Drops cached data (all sources if source is None), optionally with the columnar cache files'''
+    with _cache_lock:
+        for key in ([source] if source else list(_cache)):
+            _cache.pop(key, None)
+            if remove_files and os.path.isfile(cache_path(key)):
+                os.remove(cache_path(key))
@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import time
+
+import pandas as pd
+import pytest
+
+import data_access
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_access, 'CACHE_DIR', str(tmp_path / 'data_cache'))
+    data_access.invalidate()
+    yield
+    data_access.invalidate()
+
+def action_rows(start, n):
+    return [(f'CO {i % 3}', 541620 + i % 2, f'A{i}', float(i), f'2021-01-{1 + i % 28:02d}') for i in range(start, start + n)]
+
+def test_reloads_after_a_write_to_the_wal(tmp_path):
+    db_fn = str(tmp_path / 'gov_contracts.db')
+    conn = sqlite3.connect(db_fn)
+    conn.execute('PRAGMA journal_mode = WAL;')
+    conn.execute('PRAGMA wal_autocheckpoint = 0;')  # the writes stay in the -wal file, like during a pipeline load
+    conn.execute(f"CREATE TABLE action_facts ({', '.join(data_access.COLUMNS)})")
+    conn.executemany('INSERT INTO action_facts VALUES (?,?,?,?,?)', action_rows(0, 10))
+    conn.commit()
+    try:
+        contracts = data_access.get_data(db_fn, ttl=0)
+        assert len(contracts.data) == 10
+        assert data_access.get_data(db_fn, ttl=60) is contracts
+
+        db_mtime = os.path.getmtime(db_fn)
+        time.sleep(0.01)
+        conn.executemany('INSERT INTO action_facts VALUES (?,?,?,?,?)', action_rows(10, 5))
+        conn.commit()
+        assert os.path.getmtime(db_fn) == db_mtime  # only the -wal file changed
+        assert data_access.get_data(db_fn, ttl=60) is contracts  # not checked again within ttl
+        reloaded = data_access.get_data(db_fn, ttl=0)
+        assert reloaded is not contracts
+        assert len(reloaded.data) == 15
+        assert len(data_access.load_frame(db_fn)) == 15  # and the cache file was rebuilt
+        assert data_access.get_data(db_fn, ttl=0) is reloaded
+    finally:
+        conn.close()
+
+def test_invalidate_drops_the_data_and_cache_files(tmp_path):
+    csv_fn = str(tmp_path / 'cleaned.csv')
+    pd.DataFrame(action_rows(0, 10), columns=list(data_access.COLUMNS)).to_csv(csv_fn, index=False)
+    contracts = data_access.get_data(csv_fn)
+    assert os.path.isfile(data_access.cache_path(csv_fn))
+    data_access.invalidate(csv_fn, remove_files=True)
+    assert not os.path.isfile(data_access.cache_path(csv_fn))
+    assert data_access.get_data(csv_fn) is not contracts
+
+def test_cache_paths_of_sources_with_the_same_name_differ(tmp_path):
+    assert data_access.cache_path(data_access.SOURCE_URL) != data_access.cache_path(data_access.SOURCE_CSV)
+    assert data_access.cache_path(str(tmp_path / 'a' / 'data.csv')) != data_access.cache_path(str(tmp_path / 'b' / 'data.csv'))
+    assert data_access.cache_path(os.path.relpath(data_access.SOURCE_CSV)) == data_access.cache_path(data_access.SOURCE_CSV)
+
+@pytest.fixture(scope='module')
+def contracts():
+    return data_access.ContractData(data_access.prepare(pd.read_csv(data_access.SOURCE_CSV, usecols=list(data_access.COLUMNS))))
+
+def masked(data, co_name=None, start_date=None, end_date=None, naics_codes=None):
+    '''The app's original pandas boolean mask filters'''
+    mask = pd.Series(True, index=data.index)
+    if co_name is not None:
+        mask &= data['Company'] == co_name
+    if start_date is not None or end_date is not None:
+        mask &= data['action_date'].between(str(start_date or '1900-01-01'), str(end_date or '2100-01-01'))
+    if naics_codes is not None:
+        mask &= data['naics_code'].isin(naics_codes)
+    return data[mask]
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'start_date': '2018-01-01', 'end_date': '2020-12-31'},
+    {'end_date': '2017-08-04'},  # an action date, kept by the inclusive end
+    {'start_date': '2017-08-04', 'end_date': '2017-08-04'},
+    {'co_name': 'TOEROEK ASSOCIATES INC'},
+    {'co_name': 'NEPTUNE AND COMPANY INC', 'start_date': '2019-01-01', 'end_date': '2019-12-31'},
+    {'naics_codes': ['541611', '541690']},
+    {'co_name': 'TOEROEK ASSOCIATES INC', 'start_date': '2018-01-01', 'naics_codes': ['541620']},
+    {'co_name': 'NO SUCH COMPANY'},
+    {'start_date': '2030-01-01'},
+    {'naics_codes': []},
+])
+def test_select_matches_the_pandas_mask(contracts, filters):
+    expected = masked(contracts.data, **filters)
+    pd.testing.assert_frame_equal(contracts.select(**filters), expected)
+    assert contracts.rows(**filters).tolist() == expected.index.tolist()
+    columns = ['naics_code', 'dollars_obligated']
+    pd.testing.assert_frame_equal(contracts.select(columns=columns, **filters), expected[columns])
+
+def test_end_date_includes_the_whole_day():
+    data = data_access.prepare(pd.DataFrame(action_rows(0, 3), columns=list(data_access.COLUMNS)).assign(
+        action_date=['2021-01-01 00:00:00', '2021-01-02 15:30:00', '2021-01-03 00:00:00']))
+    contracts = data_access.ContractData(data)
+    assert contracts.select(end_date='2021-01-02')['action_date'].dt.day.tolist() == [1, 2]
+    assert contracts.select('CO 1', start_date='2021-01-02', end_date='2021-01-02').shape[0] == 1
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'start_date': '2018-01-01', 'end_date': '2020-12-31'},
+    {'naics_codes': ['541620']},
+    {'naics_codes': ['541611', '541620', '999999']},
+    {'start_date': '2030-01-01'},
+])
+def test_company_profile_matches_a_groupby(contracts, filters):
+    aggs = {'dollars_obligated': 'sum', 'number_of_awards': 'nunique'}
+    for co_name in list(contracts.companies[:10]) + ['NO SUCH COMPANY']:
+        co_data = masked(contracts.data, co_name, **filters)
+        totals = co_data.groupby('naics_code').agg(aggs)
+        profile = contracts.company_profile(co_name, **filters)
+        pd.testing.assert_frame_equal(profile['naics'], totals, check_index_type=False, check_dtype=False)
+        assert profile['dollar_total'] == round(totals['dollars_obligated'].sum(), 2)
+        assert profile['award_total'] == totals['number_of_awards'].sum()
+        pd.testing.assert_frame_equal(contracts.company_naics_totals(co_name, **filters), profile['naics'])
+    assert contracts.company_profile('TOEROEK ASSOCIATES INC') is contracts.profiles['TOEROEK ASSOCIATES INC']
+
+def test_lru_cache_evicts_the_least_recently_used():
+    cache = data_access.LRUCache(2)
+    built = []
+    def get(key):
+        return cache.get(key, lambda: built.append(key) or key.upper())
+    assert [get('a'), get('b'), get('a')] == ['A', 'B', 'A']
+    get('c')  # evicts b, a was used more recently
+    assert list(cache.entries) == ['a', 'c']
+    get('b')
+    assert list(cache.entries) == ['c', 'b']
+    assert built == ['a', 'b', 'c', 'b']
+    cache.clear()
+    assert not cache.entries
+
+def test_figures_are_cleared_with_the_data(tmp_path):
+    csv_fn = str(tmp_path / 'cleaned.csv')
+    pd.DataFrame(action_rows(0, 10), columns=list(data_access.COLUMNS)).to_csv(csv_fn, index=False)
+    contracts = data_access.get_data(csv_fn)
+    contracts.figures.get(('CO 1', None, None, None), lambda: 'figure')
+    assert data_access.get_data(csv_fn).figures.entries
+    data_access.invalidate(csv_fn)
+    assert not data_access.get_data(csv_fn).figures.entries
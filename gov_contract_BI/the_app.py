@@ -10,6 +10,8 @@ import matplotlib.style as style
 
 import datetime as dt
 
+import data_access
+
 style.use('fivethirtyeight')
 
 pd.options.display.max_columns = 50
@@ -21,53 +23,52 @@ st.set_option('deprecation.showPyplotGlobalUse', False)
 st.title('Business Intelligence for Government Contracting', 'gov_contracting')
 st.write("### For NAICS code range 5416's for Small Businesses in Target Range")
 target = 'TOEROEK ASSOCIATES INC'
-data = pd.read_csv('https://raw.githubusercontent.com/jryan814/datab-projects/main/gov_contract_BI/cleaned_gov_contracts_data.csv')
-
-data = data.rename(columns={'recipient_name': 'Company', 'award_id': 'number_of_awards'})
-data['naics_code'] = data['naics_code'].astype(str)
-data.style.format({'dollars_obligated': '{:$.2f}'})
+# Loaded once per server process and shared by every session (see data_access.py)
+contracts = data_access.get_data()
 
-company_names = data['Company'].unique()
+company_names = contracts.companies
 selection = st.selectbox('Company selection', company_names)
 
-naics_codes = data['naics_code'].unique()
-naics_data = data.groupby(['naics_code', 'Company']).agg({'dollars_obligated': 'sum', 'number_of_awards': 'nunique'}).reset_index()
+naics_codes = contracts.naics_codes
     
-#@st.cache(suppress_st_warning=True)
-def date_picker(data):
-    col1, col2, _, _ = st.beta_columns(4)
+# Filters are applied by ContractData.select (binary searched dates, only the selected company's rows)
+def date_picker():
+    col1, col2, col3, _ = st.beta_columns(4)
     with col1:
         start_date = st.date_input('From', dt.datetime(2018,1,1))
     with col2:
         end_date = st.date_input('To', dt.datetime(2020, 12, 31))
-    try:
-        data = data[data['action_date'].between(str(start_date), str(end_date))]
-    except:
-        st.write('date picker problem')
-    return data
-data = date_picker(data)
+    with col3:
+        naics_filter = st.multiselect('NAICS codes', list(naics_codes), default=list(naics_codes))
+    return start_date, end_date, naics_filter
+start_date, end_date, naics_filter = date_picker()
 
 
 left, right = st.beta_columns([5,5])
    
     
     
-@st.cache(suppress_st_warning=True, allow_output_mutation=True)
-def company_profile(co_name, data):
-    co_data = data[data['Company'] == co_name]
-    naics_cats = co_data.groupby(['naics_code']).agg({'dollars_obligated': 'sum'})
-    awards = co_data.groupby('naics_code').agg({'number_of_awards': 'nunique'})
+def render_profile(co_name, start_date, end_date, naics_filter):
+    profile = contracts.company_profile(co_name, start_date, end_date, naics_filter)
+    naics_cats = profile['naics'][['dollars_obligated']]
+    awards = profile['naics'][['number_of_awards']]
     fig = px.bar(naics_cats, naics_cats.index, naics_cats['dollars_obligated'], template='seaborn', title='Dollars Obligated per NAICS Code')
     fig2 = px.bar(awards, awards.index, awards['number_of_awards'], template='seaborn', title='Number of Awards per NAICS Code')
     fig.update_xaxes(type='category')
     fig2.update_xaxes(type='category')
     other_info = {
-        'dollar_total': round(naics_cats['dollars_obligated'].sum(), 2),
-        'award_total': awards['number_of_awards'].astype(int).sum()
+        'dollar_total': profile['dollar_total'],
+        'award_total': profile['award_total']
     }
-    return fig, fig2, naics_cats, other_info
+    # figure specs (dicts) so cached figures can't be changed by a session
+    return fig.to_dict(), fig2.to_dict(), naics_cats, other_info
+
+# Rendered profiles are kept in an LRU cache shared by all sessions, so repeat selections skip the figures
+def company_profile(co_name, start_date, end_date, naics_filter):
+    key = (co_name, start_date, end_date, tuple(naics_filter))
+    return contracts.figures.get(key, lambda: render_profile(co_name, start_date, end_date, naics_filter))
 
-fig, fig2, d, other = company_profile(selection, data)
+fig, fig2, d, other = company_profile(selection, start_date, end_date, naics_filter)
 other_award = other['award_total']
 other_dollars = other['dollar_total']
 with left:
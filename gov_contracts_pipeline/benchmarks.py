@@ -0,0 +1,392 @@
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from multiprocessing import cpu_count, freeze_support
+from time import time
+
+import numpy as np
+import pandas as pd
+
+import settings
+import build_db
+import gov_contract_data_cleaner as gcdc
+
+
+AGENCIES = [
+    ('097', 'DEPARTMENT OF DEFENSE (DOD)'), ('070', 'DEPARTMENT OF HOMELAND SECURITY (DHS)'),
+    ('012', 'DEPARTMENT OF AGRICULTURE (USDA)'), ('075', 'DEPARTMENT OF HEALTH AND HUMAN SERVICES (HHS)'),
+    ('089', 'DEPARTMENT OF ENERGY (DOE)'), ('068', 'ENVIRONMENTAL PROTECTION AGENCY (EPA)'),
+    ('014', 'DEPARTMENT OF THE INTERIOR (DOI)'), ('047', 'GENERAL SERVICES ADMINISTRATION (GSA)')]
+AWARD_TYPES = [('A', 'BPA CALL'), ('B', 'PURCHASE ORDER'), ('C', 'DELIVERY ORDER'), ('D', 'DEFINITIVE CONTRACT')]
+NAICS_CODES = [541611, 541612, 541613, 541614, 541618, 541620, 541690]
+STATES = [('VA', 'VIRGINIA'), ('MD', 'MARYLAND'), ('DC', 'DISTRICT OF COLUMBIA'), ('CA', 'CALIFORNIA'),
+    ('TX', 'TEXAS'), ('CO', 'COLORADO'), ('FL', 'FLORIDA'), ('GA', 'GEORGIA'), ('WA', 'WASHINGTON')]
+CITIES = ['ARLINGTON', 'RESTON', 'WASHINGTON', 'BALTIMORE', 'DENVER', 'AUSTIN', 'ATLANTA', 'SEATTLE', 'TAMPA']
+COUNTRIES = [('AFG', 'AFGHANISTAN'), ('DEU', 'GERMANY'), ('JPN', 'JAPAN'), ('KOR', 'KOREA, SOUTH')]
+NAME_SUFFIXES = [' INC', ' INC.', ', INC.', ' INCORPORATED', ' LLC', ' LIMITED LIABILITY COMPANY', ' CORP']
+# Competitor report queries (on the star tables, not the rollups) for bench_engines
+BI_QUERIES = {
+    'dollars_by_naics_company': '''SELECT w.naics_code, a.recipient_name, SUM(a.dollars_obligated) AS dollars
+        FROM actions a JOIN awards w ON a.award_id = w.award_id GROUP BY w.naics_code, a.recipient_name''',
+    'awards_by_company': '''SELECT recipient_name, COUNT(DISTINCT award_id) AS awards, COUNT(*) AS actions
+        FROM actions GROUP BY recipient_name''',
+    'yearly_activity': '''SELECT action_date_fiscal_year, SUM(dollars_obligated) AS dollars, COUNT(*) AS actions
+        FROM actions GROUP BY action_date_fiscal_year''',
+    'top_agencies': '''SELECT awarding_agency_name, SUM(dollars_obligated) AS dollars
+        FROM actions GROUP BY awarding_agency_name ORDER BY dollars DESC LIMIT 10'''}
+DESCRIPTIONS = ['PROGRAM MANAGEMENT SUPPORT SERVICES', 'ENVIRONMENTAL CONSULTING SERVICES',
+    'IT SECURITY TRAINING', 'TEAM AND INDIVIDUAL COACHING SERVICES', 'ADMINISTRATIVE MODIFICATION']
+
+
+def make_date_strings(num_rows: int=1000000, err_rate: float=0.001, null_rate: float=0.02, seed: int=0) -> pd.Series:
+    """## Synthetic USAspending style date column ('%Y-%m-%d')
+
+    Args:
+        num_rows (int, optional): Number of rows. Defaults to 1000000.
+        err_rate (float, optional): Share of dates with the two digit century issue (e.g. 0021-06-24). Defaults to 0.001.
+        null_rate (float, optional): Share of missing dates. Defaults to 0.02.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        pd.Series: Date strings
+    """
+    rng = np.random.default_rng(seed)
+    days = rng.integers(0, 365 * 10, num_rows)
+    dates = pd.Series((np.datetime64('2012-01-01') + days).astype(str), dtype=object)
+    bad = rng.random(num_rows) < err_rate
+    dates[bad] = '00' + dates[bad].str[2:]
+    dates[rng.random(num_rows) < null_rate] = None
+    return dates
+
+def make_raw_data(num_rows: int=10000, seed: int=0, null_rate: float=0.02, err_rate: float=0.001,
+                  intl_rate: float=0.02, start: int=0) -> pd.DataFrame:
+    """## Synthetic USAspending transactions with every rename_map source column
+
+    Args:
+        num_rows (int, optional): Number of rows. Defaults to 10000.
+        seed (int, optional): Random seed. Defaults to 0.
+        null_rate (float, optional): Share of missing values in nullable columns. Defaults to 0.02.
+        err_rate (float, optional): Share of period of performance dates with the century issue. Defaults to 0.001.
+        intl_rate (float, optional): Share of international places of performance. Defaults to 0.02.
+        start (int, optional): First transaction number (for generating a file in chunks). Defaults to 0.
+
+    Returns:
+        pd.DataFrame: Raw data
+    """
+    rng = np.random.default_rng(seed + start)
+    n = num_rows
+
+    def pick(values, size=n):
+        return np.asarray(values, dtype=object)[rng.integers(0, len(values), size)]
+
+    def with_nulls(values, rate=null_rate):
+        values = pd.Series(values, dtype=object)
+        values[rng.random(n) < rate] = None
+        return values
+
+    tx = np.arange(start, start + n)
+    award = rng.integers(0, max(n // 3, 1), n) + start
+    recipient = rng.zipf(1.3, n) % max(n // 20, 50)
+    names = np.array([f'RECIPIENT {i} SOLUTIONS' for i in range(max(n // 20, 50))], dtype=object)[recipient]
+    agency = rng.integers(0, len(AGENCIES), n)
+    sub_agency = agency * 10 + rng.integers(0, 10, n)
+    office = sub_agency * 5 + rng.integers(0, 5, n)
+    state = rng.integers(0, len(STATES), n)
+    award_type = rng.integers(0, len(AWARD_TYPES), n)
+    action_date = np.datetime64('2016-01-01') + rng.integers(0, 365 * 6, n)
+    action_dates = pd.Series(action_date.astype(str), dtype=object)
+    fiscal_year = pd.DatetimeIndex(action_date).year + (pd.DatetimeIndex(action_date).month >= 10)
+    last_modified = pd.Series((action_date + rng.integers(0, 86400 * 30, n).astype('timedelta64[s]')).astype(str),
+        dtype=object).str.replace('T', ' ')
+    dollars = np.round(rng.lognormal(9, 2, n), 2) * np.where(rng.random(n) < 0.05, -1, 1)
+    dollars[rng.random(n) < 0.03] = 0
+
+    def pop_dates(offset_days):
+        dates = pd.Series((action_date + offset_days).astype(str), dtype=object)
+        bad = rng.random(n) < err_rate
+        dates[bad] = '00' + dates[bad].str[2:]
+        return with_nulls(dates)
+
+    data = pd.DataFrame({
+        'contract_transaction_unique_key': [f'CONT_TX_{i}' for i in tx],
+        'contract_award_unique_key': [f'CONT_AWD_{a:010d}' for a in award],
+        'award_id_piid': [f'PIID{a:010d}' for a in award],
+        'parent_award_id_piid': with_nulls([f'IDV{a // 7:09d}' for a in award], 0.3),
+        'parent_award_modification_number': with_nulls(pick(['0', 'P00001', 'P00002']), 0.5),
+        'award_or_idv_flag': 'AWARD',
+        'award_type_code': [AWARD_TYPES[i][0] for i in award_type],
+        'award_type': [AWARD_TYPES[i][1] for i in award_type],
+        'award_description': with_nulls(pick(DESCRIPTIONS)),
+        'federal_action_obligation': dollars,
+        'number_of_actions': 1,
+        'action_date': action_dates,
+        'action_date_fiscal_year': fiscal_year,
+        'last_modified_date': last_modified,
+        'period_of_performance_start_date': pop_dates(-rng.integers(0, 60, n)),
+        'period_of_performance_current_end_date': pop_dates(rng.integers(30, 365, n)),
+        'period_of_performance_potential_end_date': pop_dates(rng.integers(365, 365 * 5, n)),
+        'awarding_agency_code': [AGENCIES[i][0] for i in agency],
+        'awarding_agency_name': with_nulls([AGENCIES[i][1] for i in agency]),
+        'awarding_sub_agency_code': [f'{s:04d}' for s in sub_agency],
+        'awarding_sub_agency_name': [f'SUB AGENCY {s}' for s in sub_agency],
+        'awarding_office_code': [f'OFF{o:05d}' for o in office],
+        'awarding_office_name': [f'CONTRACTING OFFICE {o}' for o in office],
+        'parent_award_agency_id': with_nulls([f'{s:04d}' for s in sub_agency], 0.3),
+        'parent_award_agency_name': with_nulls([AGENCIES[i][1] for i in agency], 0.3),
+        'recipient_name': with_nulls(names + pick(NAME_SUFFIXES), 0.001),
+        'recipient_duns': 100000000 + recipient,
+        'recipient_city_name': pick(CITIES),
+        'recipient_zip_4_code': with_nulls(rng.integers(200000000, 999999999, n).astype(float)),
+        'naics_code': pick(NAICS_CODES),
+        'primary_place_of_performance_city_name': pick(CITIES),
+        'primary_place_of_performance_county_name': pick(['FAIRFAX', 'ARLINGTON', 'MONTGOMERY', 'DENVER']),
+        'primary_place_of_performance_state_code': [STATES[i][0] for i in state],
+        'primary_place_of_performance_state_name': [STATES[i][1] for i in state],
+        'primary_place_of_performance_zip_4': rng.integers(200000000, 999999999, n).astype(str),
+        'primary_place_of_performance_congressional_district': rng.integers(1, 12, n).astype(float),
+        'primary_place_of_performance_country_code': 'USA',
+        'primary_place_of_performance_country_name': 'UNITED STATES',
+        'city_local_government': 'f'})
+
+    # International places of performance are missing everything but the country
+    intl = rng.random(n) < intl_rate
+    country = rng.integers(0, len(COUNTRIES), n)
+    data.loc[intl, 'primary_place_of_performance_country_code'] = [COUNTRIES[i][0] for i in country[intl]]
+    data.loc[intl, 'primary_place_of_performance_country_name'] = [COUNTRIES[i][1] for i in country[intl]]
+    for col in data.columns:
+        if col.startswith('primary_place_of_performance') and 'country' not in col:
+            data.loc[intl, col] = None
+    return data[[c for c in settings.rename_map]]
+
+def write_raw_csv(num_rows: int, fname: str, chunksize: int=1000000, **kwargs) -> str:
+    """## Writes a synthetic raw file in chunks (keeps memory flat for 10M row files)
+
+    Args:
+        num_rows (int): Number of rows.
+        fname (str): Output path.
+        chunksize (int, optional): Rows generated at a time. Defaults to 1000000.
+        **kwargs: Passed to make_raw_data.
+
+    Returns:
+        str: Output path
+    """
+    for start in range(0, num_rows, chunksize):
+        chunk = make_raw_data(min(chunksize, num_rows - start), start=start, **kwargs)
+        chunk.to_csv(fname, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    return fname
+
+def timed(f, *args, **kwargs) -> tuple:
+    start = time()
+    result = f(*args, **kwargs)
+    return result, round(time() - start, 4)
+
+def bench_cleaner(raw: pd.DataFrame) -> dict:
+    """## Times each cleaner stage (in run_pipeline2 order) on one frame
+
+    Args:
+        raw (pd.DataFrame): Raw data
+
+    Returns:
+        dict: Seconds per stage
+    """
+    secs = {}
+    df, secs['pipeline'] = timed(gcdc.pipeline, raw.copy())
+    df, secs['fill_nulls'] = timed(gcdc.fill_nulls, df)
+    df, secs['fix_international'] = timed(gcdc.fix_international, df)
+    _, secs['reformat_names'] = timed(df['recipient_name'].apply, gcdc.reformat_names)
+    df['recipient_name'], secs['reformat_names_vec'] = timed(gcdc.reformat_names_vec, df['recipient_name'])
+    pop_dates = [c for c in df.columns if 'date' in c and 'pop' in c]
+    for d in pop_dates:
+        df[d] = gcdc.fill_from(df[d], df['action_date'])
+    reference = df.copy()
+    start = time()
+    for d in pop_dates:
+        reference[d] = reference[d].apply(gcdc.fix_date_issues)
+    secs['fix_date_issues'] = round(time() - start, 4)
+    _, secs['dtype_conversions_infer'] = timed(gcdc.dtype_conversions, reference, fast=False)
+    df, secs['dtype_conversions'] = timed(gcdc.dtype_conversions, df)
+    df, secs['add_zip_str'] = timed(gcdc.add_zip_str, df)
+    _, secs['fill_unknown'] = timed(gcdc.fill_unknown, df)
+    _, secs['run_pipeline2'] = timed(gcdc.run_pipeline2, raw.copy())
+    _, secs['run_pipeline2_reference'] = timed(gcdc.run_pipeline2, raw.copy(), vectorized=False)
+    return secs
+
+def bench_memory(raw: pd.DataFrame) -> list:
+    """## Profiles the allocations of each run_pipeline2 stage (tracemalloc)
+
+    Args:
+        raw (pd.DataFrame): Raw data
+
+    Returns:
+        list: Peak and net bytes per stage
+    """
+    profile = []
+    data = gcdc.run_pipeline2(raw.copy(), profile=profile)
+    gcdc.profile_stage(gcdc.fill_unknown, data, 'fill_unknown', profile)
+    return profile
+
+def bench_pool(fn: str, process_counts: list=(1, 2, 4)) -> dict:
+    """## Times exec_pool at several process counts, for each handoff
+
+    Args:
+        fn (str): Raw file path
+        process_counts (list, optional): Process counts to try. Defaults to (1, 2, 4).
+
+    Returns:
+        dict: Seconds per process count, keyed by handoff
+    """
+    return {handoff: {str(p): timed(gcdc.exec_pool, fn, num_processes=p, handoff=handoff)[1] for p in process_counts}
+        for handoff in ('pickle', 'arrow')}
+
+def bench_load(data: pd.DataFrame) -> dict:
+    """## Times the bulk SQLite load of cleaned data into a temporary DB, and traces its peak memory
+
+    Args:
+        data (pd.DataFrame): Cleaned data
+
+    Returns:
+        dict: Seconds, rows/sec and peak MB allocated by the insert
+    """
+    import manage
+    db_path = settings.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        settings.DB_PATH = os.path.join(tmp_dir, 'bench.db')
+        try:
+            build_db.DB(True).close_conn()
+            db = build_db.DB(False, True)
+            tracemalloc.start()
+            start = time()
+            db.begin_bulk_load()
+            manage.insert_data(db, data)
+            db.end_bulk_load()
+            secs = time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            db.close_conn()
+        finally:
+            tracemalloc.stop()
+            settings.DB_PATH = db_path
+    return {'secs': round(secs, 4), 'rows_per_sec': round(data.shape[0] / secs), 'peak_mb': round(peak / 1e6, 1)}
+
+def bench_engines(data: pd.DataFrame, engines: list=None, repeat: int=3) -> dict:
+    """## Compares the DB engines: bulk load time and the best of repeat runs of each BI query
+    DuckDB is also timed loading the parquet dataset directly.
+
+    Args:
+        data (pd.DataFrame): Cleaned data
+        engines (list, optional): build_db.ENGINES names. Defaults to sqlite, plus duckdb when it's installed.
+        repeat (int, optional): Runs per query. Defaults to 3.
+
+    Returns:
+        dict: Seconds per engine, for the load and each query
+    """
+    import manage
+    engines = engines or ['sqlite'] + (['duckdb'] if build_db.duckdb else [])
+    paths = (settings.DB_PATH, settings.DUCKDB_PATH)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        settings.DB_PATH = os.path.join(tmp_dir, 'bench.db')
+        settings.DUCKDB_PATH = os.path.join(tmp_dir, 'bench.duckdb')
+        try:
+            for engine in engines:
+                build_db.connect(True, engine=engine).close_conn()
+                db = build_db.connect(False, True, engine=engine)
+                start = time()
+                db.begin_bulk_load()
+                manage.insert_data(db, data)
+                db.end_bulk_load()
+                result = {'load_secs': round(time() - start, 4)}
+                for name, sql in BI_QUERIES.items():
+                    best = min(timed(db.ex_sql, sql)[1] for _ in range(repeat))
+                    result[name] = best
+                if engine == 'duckdb':
+                    parquet_dir = os.path.join(tmp_dir, 'bench.parquet')
+                    gcdc.make_parquet(data, parquet_dir)
+                    db.close_conn()
+                    build_db.connect(True, engine=engine).close_conn()
+                    db = build_db.connect(False, True, engine=engine)
+                    _, result['parquet_load_secs'] = timed(db.insert_parquet, parquet_dir)
+                db.close_conn()
+                results[engine] = result
+        finally:
+            settings.DB_PATH, settings.DUCKDB_PATH = paths
+    return results
+
+def bench_dates(num_rows: int=1000000) -> dict:
+    """## Times the date stage: per-row fix + to_datetime inference vs parse_dates
+
+    Args:
+        num_rows (int, optional): Number of rows. Defaults to 1000000.
+
+    Returns:
+        dict: Seconds for each path
+    """
+    dates = make_date_strings(num_rows)
+    start = time()
+    reference = pd.to_datetime(dates.apply(gcdc.fix_date_issues))
+    reference_secs = time() - start
+
+    start = time()
+    fast = gcdc.parse_dates(dates, '%Y-%m-%d')
+    fast_secs = time() - start
+    assert fast.equals(reference)
+    return {'rows': num_rows, 'reference_secs': round(reference_secs, 3), 'parse_dates_secs': round(fast_secs, 3)}
+
+def run_benchmarks(sizes: list=(10000, 100000), process_counts: list=(1, 2, 4), out: str=None, date_rows: int=1000000) -> dict:
+    """## Runs every benchmark for each file size and writes the results as json
+
+    Args:
+        sizes (list, optional): Row counts to synthesize. Defaults to (10000, 100000).
+        process_counts (list, optional): exec_pool process counts. Defaults to (1, 2, 4).
+        out (str, optional): Results path. Defaults to BENCH_DIR/bench_<timestamp>.json.
+        date_rows (int, optional): Rows for bench_dates. Defaults to 1000000.
+
+    Returns:
+        dict: Results
+    """
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'cpu_count': cpu_count(),
+        'sizes': {}}
+    report_path = settings.QUALITY_REPORT_PATH
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the synthetic files' quality reports would replace the real one
+        settings.QUALITY_REPORT_PATH = os.path.join(tmp_dir, 'quality_report.json')
+        try:
+            for n in sizes:
+                fn = write_raw_csv(n, os.path.join(tmp_dir, f'raw_{n}.csv'))
+                raw = pd.read_csv(fn, usecols=[c for c in settings.rename_map], dtype=settings.source_dtypes, low_memory=False)
+                size = {'file_mb': round(os.path.getsize(fn) / 1e6, 1)}
+                size['cleaner'] = bench_cleaner(raw)
+                size['cleaner_memory'] = bench_memory(raw)
+                size['exec_pool'] = bench_pool(fn, process_counts)
+                cleaned = gcdc.fill_unknown(gcdc.run_pipeline2(raw))
+                size['sqlite_load'] = bench_load(cleaned)
+                size['engines'] = bench_engines(cleaned)
+                results['sizes'][str(n)] = size
+                print(n, json.dumps(size))
+        finally:
+            settings.QUALITY_REPORT_PATH = report_path
+    results['dates'] = bench_dates(date_rows)
+
+    if not out:
+        os.makedirs(settings.BENCH_DIR, exist_ok=True)
+        out = os.path.join(settings.BENCH_DIR, f"bench_{results['timestamp'].replace(':', '')}.json")
+    with open(out, 'w') as file_:
+        json.dump(results, file_, indent=2)
+    return results
+
+if __name__ == '__main__':
+    freeze_support()
+    parser = argparse.ArgumentParser(description='Benchmarks the gov contracts pipeline on synthetic USAspending data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='row counts (10k to 10M)')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4], help='exec_pool process counts')
+    parser.add_argument('--out', default=None, help='results json path')
+    args = parser.parse_args()
+    run_benchmarks(args.sizes, args.processes, args.out)
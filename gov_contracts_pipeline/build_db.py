@@ -1,7 +1,97 @@
 
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
 import settings
 import numpy as np
+import pandas as pd
+try:
+    import duckdb
+except ImportError:  # only needed for settings.DB_ENGINE = 'duckdb'
+    duckdb = None
+
+# Star schema tables loaded from the cleaned data, and the natural key each is upserted on
+STAR_TABLES = {'actions': 'action_key', 'awards': 'award_id', 'businesses': 'recipient_name'}
+
+# Columns added to the star schema tables since the first schema, added by DB.migrate() to older DBs
+ADDED_COLS = {
+    'actions': {
+        'action_key': 'VARCHAR(255)',
+        'raw_recipient_name': 'VARCHAR(255)',
+        'action_date_fiscal_year': 'INTEGER',
+        'awarding_agency_name': 'VARCHAR(255)',
+        'last_modified_date': 'VARCHAR(20)'}}
+
+# Secondary indexes for the BI queries (dropped during a bulk load and rebuilt after it)
+INDEXES = {
+    'idx_actions_award_id': 'actions (award_id)',
+    'idx_actions_recipient_name': 'actions (recipient_name)',
+    'idx_actions_action_date': 'actions (action_date)',
+    'idx_actions_fiscal_year': 'actions (action_date_fiscal_year)',
+    'idx_awards_naics_code': 'awards (naics_code)'}
+
+# Materialized rollups of action_facts: grouping columns of each table (every rollup is grouped by fiscal_year,
+# so refresh_rollups can rebuild just the fiscal years a load touched)
+ROLLUPS = {
+    'rollup_recipients': ['recipient_name', 'naics_code', 'fiscal_year', 'awarding_agency_name'],
+    'rollup_naics': ['naics_code', 'fiscal_year'],
+    'rollup_agencies': ['awarding_agency_name', 'fiscal_year']}
+ROLLUP_COL_TYPES = {'recipient_name': 'VARCHAR(255)', 'naics_code': 'INTEGER', 'fiscal_year': 'INTEGER',
+    'awarding_agency_name': 'VARCHAR(255)'}
+ROLLUP_MEASURES = {
+    'dollars_obligated': 'SUM(dollars_obligated)',
+    'action_count': 'COUNT(*)',
+    'award_count': 'COUNT(DISTINCT award_id)',
+    'recipient_count': 'COUNT(DISTINCT recipient_name)',
+    'first_action_date': 'MIN(action_date)',
+    'last_action_date': 'MAX(action_date)'}
+ROLLUP_MEASURE_TYPES = {'dollars_obligated': 'DOUBLE', 'first_action_date': 'VARCHAR(20)', 'last_action_date': 'VARCHAR(20)'}
+# Each action with its award's NAICS code (the rollup source)
+FACTS_VIEW_SQL = '''CREATE VIEW IF NOT EXISTS action_facts AS
+    SELECT a.recipient_name, w.naics_code, a.action_date_fiscal_year AS fiscal_year, a.awarding_agency_name,
+        a.award_id, a.dollars_obligated, a.action_date
+    FROM actions a LEFT JOIN awards w ON a.award_id = w.award_id;'''
+
+# Recipient name variants of each DUNS number ('' when missing) -> canonical names (see name_index.py);
+# also created on demand for older DBs
+ALIAS_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS recipient_aliases (
+    alias VARCHAR(255) NOT NULL,
+    recipient_duns VARCHAR(255) NOT NULL,
+    canonical_name VARCHAR(255) NOT NULL,
+    score FLOAT,
+    PRIMARY KEY (alias, recipient_duns)
+);'''
+# Table columns filled from a differently named column of the cleaned data
+SOURCE_COLS = {'raw_recipient_name': 'recipient_name'}  # the name as reported, recipient_name may be canonicalized
+
+
+def dedupe_keys(frame, key, upsert=False):
+    '''Drops rows that repeat a key, keeping the last one for upserts and the first otherwise
+    (the row a row by row insert would have left in the table). Rows with a NULL key are all kept, and so is
+    every row of a frame without the key column.
+    '''
+    if key not in frame.columns:
+        return frame
+    keys = frame[key]
+    dupes = keys.duplicated(keep='last' if upsert else 'first') & keys.notna()
+    return frame[~dupes] if dupes.any() else frame
+
+def iter_rows(frame, batch_size=None):
+    '''Yields a DataFrame's rows as tuples of native Python scalars
+    Converts batch_size rows of each column at a time (Series.tolist), so there are no numpy records
+    or numpy scalars, and only one batch of Python objects is alive at once.
+    '''
+    batch_size = batch_size or settings.INSERT_BATCH_ROWS
+    cols = []
+    for c in frame.columns:
+        col = frame[c]
+        if pd.api.types.is_extension_array_dtype(col) and not isinstance(col.dtype, pd.CategoricalDtype):
+            col = col.astype(object).where(col.notna(), None)  # nullable columns list nulls as pd.NA, sqlite can't bind it
+        cols.append(col)
+    for start in range(0, frame.shape[0], batch_size):
+        yield from zip(*[col.iloc[start:start + batch_size].tolist() for col in cols])
 
 
 class DB:
@@ -9,41 +99,97 @@ class DB:
     Automatically builds or rebuilds database, and tables for the gov contracts data.
     Also acts as connection/cursor to sqlite database
     '''
+    rollup_col_types = ROLLUP_COL_TYPES
+    rollup_keys = True  ## Primary keys on the rollup grouping columns
     def __init__(self, new_build=False, row_factory_list=False):
         '''
         Creates data base connection, and cursor as well as initializes class attributes.
         args:
             new_build: (bool) whether to use as connection class or to build the database.
         '''
-        sqlite3.register_adapter(np.int32, str)
-        sqlite3.register_adapter(np.int64, str)
-        db_name = settings.DB_PATH  # db filepath defined in settings.py--for non-sqlite implementation this will need to be changed.
-        self.conn = sqlite3.connect(db_name)
-        if row_factory_list:
-            self.conn.row_factory = lambda cursor, row: [*row]
-        self.cur = self.conn.cursor()
+        self.open_conn(row_factory_list)
+        self.bulk_loading = False  ## Defers commits until end_bulk_load()
         
         self.all_tbl_cols = {}  ## Dictionary of tables and their columns get_table_dict() populates the keys & values
         
         if not new_build: ## Only using class for accessing the db
+            self.migrate()
             self.get_table_dict()
         
         else:
             self.new_build_db() ## Build or rebuild db from scratch
-        
-        
+
+    def open_conn(self, row_factory_list=False):
+        db_name = settings.DB_PATH  # db filepath defined in settings.py--for non-sqlite implementation this will need to be changed.
+        self.conn = sqlite3.connect(db_name)
+        if row_factory_list:
+            self.conn.row_factory = lambda cursor, row: [*row]
+        self.cur = self.conn.cursor()
+
+    def commit(self):
+        self.conn.commit()
 
     def ex_sql(self, *args, **kwargs):
         rows = self.cur.execute(*args)
-        self.conn.commit()
-        if 'SELECT' in args[0]:
-            return rows.fetchall()
+        # Any statement that returns rows (SELECT, WITH, PRAGMA, RETURNING) has a description
+        result = rows.fetchall() if rows.description else None
+        if self.conn.in_transaction and not self.bulk_loading:
+            self.commit()
+        return result
     
     def exmany_sql(self, *args, **kwargs):
         rows = self.cur.executemany(*args)
-        self.conn.commit()
-        if 'SELECT' in args[0]:
-            return rows.fetchall()
+        result = rows.fetchall() if rows.description else None
+        if self.conn.in_transaction and not self.bulk_loading:
+            self.commit()
+        return result
+
+    def create_indexes(self):
+        '''Creates the secondary indexes (if they don't exist)'''
+        for name, on in INDEXES.items():
+            self.cur.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {on};')
+        self.commit()
+
+    def begin_bulk_load(self):
+        '''Switches to bulk load mode: WAL journal, synchronous off, indexes dropped,
+        and every insert in one transaction until end_bulk_load()
+        '''
+        self.commit()
+        self.cur.execute('PRAGMA journal_mode = WAL;')
+        self.cur.execute('PRAGMA synchronous = OFF;')
+        for name in INDEXES:
+            self.cur.execute(f'DROP INDEX IF EXISTS {name};')
+        self.bulk_loading = True
+
+    def end_bulk_load(self):
+        '''Commits the bulk load, rebuilds the indexes, and refreshes the query planner statistics'''
+        self.bulk_loading = False
+        self.commit()
+        self.create_indexes()
+        self.cur.execute('ANALYZE;')
+        self.cur.execute('PRAGMA synchronous = NORMAL;')
+        self.commit()
+
+    def abort_bulk_load(self):
+        '''Rolls the bulk load back and rebuilds the indexes it dropped'''
+        self.bulk_loading = False
+        self.conn.rollback()
+        self.create_indexes()
+        self.cur.execute('PRAGMA synchronous = NORMAL;')
+
+    @contextmanager
+    def transaction(self):
+        '''Defers the commits of the statements in the block to its end, and rolls them all back if it raises'''
+        self.commit()
+        self.bulk_loading = True
+        try:
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            self.bulk_loading = False
+        self.commit()
 
     def get_tbl_cols(self, tbl_name):
         '''Gets table columns from each table
@@ -65,47 +211,523 @@ class DB:
     
     def new_build_db(self):
         
-        drops = ['DROP TABLE IF EXISTS actions;',
+        drops = ['DROP VIEW IF EXISTS action_facts;',
+            'DROP TABLE IF EXISTS actions;',
             'DROP TABLE IF EXISTS awards;',
-            'DROP TABLE IF EXISTS businesses;']
+            'DROP TABLE IF EXISTS businesses;',
+            'DROP TABLE IF EXISTS load_watermarks;',
+            'DROP TABLE IF EXISTS load_runs;',
+            'DROP TABLE IF EXISTS recipient_aliases;']
+        drops += [f'DROP TABLE IF EXISTS {name};' for name in ROLLUPS]
         for d in drops:
             self.cur.execute(d)
 
-        build_db = ['''CREATE TABLE IF NOT EXISTS actions (
-            id INTEGER PRIMARY KEY,
-            award_id VARCHAR(255),
-            recipient_name VARCHAR(255),
-            dollars_obligated FLOAT,
-            action_date VARCHAR(11),
-            FOREIGN KEY (award_id) REFERENCES awards (award_id),
-            FOREIGN KEY (recipient_name) REFERENCES businesses (recipient_name)
-        );''',
-        '''CREATE TABLE IF NOT EXISTS awards (
-            id INTEGER PRIMARY KEY,
-            award_id VARCHAR(255),
-            plop_city VARCHAR(255),
-            plop_state_code VARCHAR(255),
-            plop_country_code VARCHAR(255),
-            naics_code INTEGER NOT NULL
-        );''',
-        '''CREATE TABLE IF NOT EXISTS businesses (
-            recipient_name VARCHAR(255) PRIMARY KEY,
-            recipient_city VARCHAR(255),
-            recipient_zip_code_5 INTEGER,
-            recipient_duns TEXT
-        );''',
-        '''PRAGMA foreign_keys = ON;''']
-        for build in build_db:
+        for build in self.schema():
             self.cur.execute(build)
-        self.conn.commit()
+        self.create_rollups()
+        self.commit()
+        self.create_indexes()
         self.get_table_dict()
+
+    def migrate(self):
+        '''Brings a DB built by an earlier version up to the current schema (nothing to do for a current one):
+        creates the missing tables (e.g. the load control tables), adds the missing ADDED_COLS columns and the
+        unique keys the upserts need (see add_unique_keys), then the action_facts view and rollup tables over them
+        '''
+        for build in self.schema():
+            if not build.startswith('PRAGMA'):  # opened connections keep their settings
+                self.cur.execute(build)
+        for table, cols in ADDED_COLS.items():
+            existing = self.get_tbl_cols(table)
+            for col, col_type in cols.items():
+                if col not in existing:
+                    self.cur.execute(f'ALTER TABLE {table} ADD COLUMN {col} {col_type};')
+        self.add_unique_keys()
+        self.create_rollups()
+        self.commit()
+
+    def has_unique_key(self, table, col):
+        '''Whether a unique constraint or index covers exactly col'''
+        for index in self.cur.execute(f'PRAGMA index_list({table});').fetchall():
+            if index[2] and [i[2] for i in self.cur.execute(f'PRAGMA index_info({index[1]});').fetchall()] == [col]:
+                return True
+        return False
+
+    def add_unique_keys(self):
+        '''Adds a unique index on each STAR_TABLES key without a unique constraint (columns added by migrate()
+        can't have one). Rows repeating a key are deleted first, keeping the first one like an insert would.
+        '''
+        missing = {table: key for table, key in STAR_TABLES.items() if not self.has_unique_key(table, key)}
+        if not missing:
+            return
+        # foreign keys to a column without a unique key are errors while they're checked
+        self.commit()
+        foreign_keys = self.cur.execute('PRAGMA foreign_keys;').fetchone()[0]
+        self.cur.execute('PRAGMA foreign_keys = OFF;')
+        for table, key in missing.items():
+            self.cur.execute(f'''DELETE FROM {table} WHERE {key} IS NOT NULL AND rowid NOT IN (
+                SELECT MIN(rowid) FROM {table} WHERE {key} IS NOT NULL GROUP BY {key});''')
+            self.cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_{key} ON {table} ({key});')
+        self.commit()
+        self.cur.execute(f'PRAGMA foreign_keys = {foreign_keys};')
+
+    def schema(self):
+        '''returns (list) of the statements that create the star schema and control tables'''
+        return ['''CREATE TABLE IF NOT EXISTS actions (
+                id INTEGER PRIMARY KEY,
+                action_key VARCHAR(255) UNIQUE,
+                award_id VARCHAR(255),
+                recipient_name VARCHAR(255),
+                raw_recipient_name VARCHAR(255),
+                dollars_obligated FLOAT,
+                action_date VARCHAR(11),
+                action_date_fiscal_year INTEGER,
+                awarding_agency_name VARCHAR(255),
+                last_modified_date VARCHAR(20),
+                FOREIGN KEY (award_id) REFERENCES awards (award_id),
+                FOREIGN KEY (recipient_name) REFERENCES businesses (recipient_name)
+            );''',
+            '''CREATE TABLE IF NOT EXISTS awards (
+                id INTEGER PRIMARY KEY,
+                award_id VARCHAR(255) UNIQUE,
+                plop_city VARCHAR(255),
+                plop_state_code VARCHAR(255),
+                plop_country_code VARCHAR(255),
+                naics_code INTEGER NOT NULL
+            );''',
+            '''CREATE TABLE IF NOT EXISTS businesses (
+                recipient_name VARCHAR(255) PRIMARY KEY,
+                recipient_city VARCHAR(255),
+                recipient_zip_code_5 INTEGER,
+                recipient_duns TEXT
+            );''',
+            '''CREATE TABLE IF NOT EXISTS load_watermarks (
+                file_name VARCHAR(255) PRIMARY KEY,
+                last_modified_date VARCHAR(20),
+                action_date VARCHAR(20)
+            );''',
+            '''CREATE TABLE IF NOT EXISTS load_runs (
+                id INTEGER PRIMARY KEY,
+                file_name VARCHAR(255),
+                mode VARCHAR(20),
+                started VARCHAR(20),
+                finished VARCHAR(20),
+                rows_loaded INTEGER,
+                last_modified_date VARCHAR(20),
+                action_date VARCHAR(20)
+            );''',
+            ALIAS_TABLE_SQL,
+            '''PRAGMA foreign_keys = ON;''']
+
+    def create_rollups(self):
+        '''Creates the action_facts view and the (empty) rollup tables if they don't exist'''
+        self.cur.execute(FACTS_VIEW_SQL)
+        for name, group_cols in ROLLUPS.items():
+            cols = [f'{c} {self.rollup_col_types[c]}' for c in group_cols]
+            cols += [f'{m} {ROLLUP_MEASURE_TYPES.get(m, "INTEGER")}' for m in ROLLUP_MEASURES]
+            if self.rollup_keys:
+                cols.append(f"PRIMARY KEY ({', '.join(group_cols)})")
+            self.cur.execute(f'''CREATE TABLE IF NOT EXISTS {name} (
+                {', '.join(cols)}
+            );''')
+
+    def refresh_rollups(self, fiscal_years=None):
+        '''Rebuilds the rollup tables from action_facts
+            args:
+                fiscal_years: (iterable) only rebuild these fiscal years. Defaults to None (rebuild everything)
+            returns (int) number of rollup rows written
+        '''
+        self.create_rollups()
+        where, params = '', ()
+        if fiscal_years is not None:
+            params = tuple(sorted({int(y) for y in fiscal_years}))
+            if not params:
+                return 0
+            where = f"WHERE fiscal_year IN ({','.join('?' * len(params))})"
+        measures = ', '.join(f'{sql} AS {m}' for m, sql in ROLLUP_MEASURES.items())
+        num_rows = 0
+        for name, group_cols in ROLLUPS.items():
+            group = ', '.join(group_cols)
+            self.cur.execute(f'DELETE FROM {name} {where};', params)
+            self.cur.execute(f'''INSERT INTO {name} ({group}, {', '.join(ROLLUP_MEASURES)})
+                SELECT {group}, {measures} FROM action_facts {where} GROUP BY {group};''', params)
+            num_rows += self.cur.execute(f'SELECT COUNT(*) FROM {name} {where};', params).fetchone()[0]
+        if not self.bulk_loading:
+            self.commit()
+        return num_rows
+
+    def fiscal_years_of(self, action_keys, batch_size=500):
+        '''returns (set) of the stored fiscal years of the given actions (to refresh before they're upserted)'''
+        action_keys = list(action_keys)
+        years = set()
+        for i in range(0, len(action_keys), batch_size):
+            batch = action_keys[i:i + batch_size]
+            rows = self.cur.execute(f'''SELECT DISTINCT action_date_fiscal_year FROM actions
+                WHERE action_key IN ({','.join('?' * len(batch))});''', batch)
+            years.update(r[0] for r in rows.fetchall() if r[0] is not None)
+        return years
     
+    def get_watermark(self, file_name):
+        '''Gets the incremental load high-water marks for a source file
+            args:
+                file_name: (str) name of the source file
+            returns (tuple) of (last_modified_date, action_date) strings, or None if never loaded
+        '''
+        rows = self.cur.execute('SELECT last_modified_date, action_date FROM load_watermarks WHERE file_name = ?;', (file_name,))
+        row = rows.fetchone()
+        if row:
+            return tuple(row)
+
+    def record_run(self, file_name, mode, started, finished, rows_loaded, last_modified_date, action_date):
+        '''Records run metadata and moves the source file's high-water marks forward
+            args:
+                file_name: (str) name of the source file
+                mode: (str) load mode e.g. 'incremental'
+                started, finished: (str) run timestamps
+                rows_loaded: (int) number of rows upserted
+                last_modified_date, action_date: (str) high-water marks after the run
+        '''
+        self.cur.execute('''INSERT INTO load_runs
+            (file_name, mode, started, finished, rows_loaded, last_modified_date, action_date)
+            VALUES (?,?,?,?,?,?,?);''',
+            (file_name, mode, started, finished, rows_loaded, last_modified_date, action_date))
+        self.cur.execute('''INSERT INTO load_watermarks (file_name, last_modified_date, action_date)
+            VALUES (?,?,?)
+            ON CONFLICT(file_name) DO UPDATE SET
+            last_modified_date=excluded.last_modified_date, action_date=excluded.action_date;''',
+            (file_name, last_modified_date, action_date))
+        self.commit()
+
+    def create_alias_table(self):
+        '''Creates recipient_aliases if it doesn't exist. A table from before aliases were keyed by DUNS is
+        dropped first (its aliases may merge names of different DUNS numbers, they're relearned on the next load)
+        '''
+        cols = self.get_tbl_cols('recipient_aliases')
+        if cols and 'recipient_duns' not in cols:
+            self.cur.execute('DROP TABLE recipient_aliases;')
+        self.cur.execute(ALIAS_TABLE_SQL)
+
+    def get_aliases(self):
+        '''returns (list) of (alias, recipient_duns, canonical_name) rows from recipient_aliases'''
+        self.create_alias_table()
+        return self.cur.execute('SELECT alias, recipient_duns, canonical_name FROM recipient_aliases;').fetchall()
+
+    def save_aliases(self, rows):
+        '''Adds or updates recipient name aliases
+            args:
+                rows: (list) of (alias, recipient_duns, canonical_name, score) tuples
+        '''
+        self.create_alias_table()
+        self.exmany_sql('''INSERT INTO recipient_aliases (alias, recipient_duns, canonical_name, score) VALUES (?,?,?,?)
+            ON CONFLICT(alias, recipient_duns) DO UPDATE SET canonical_name=excluded.canonical_name, score=excluded.score;''', rows)
+
+    def insert_frame(self, table, frame, upsert=False):
+        '''Inserts a DataFrame into a table through one executemany fed by iter_rows
+        Rows repeating a key are dropped first (see dedupe_keys).
+            args:
+                table: (str) table name
+                frame: (DataFrame) rows, with the table's columns in all_tbl_cols order
+                upsert: (bool) update existing rows on the table's natural key instead of ignoring them
+        '''
+        if frame.empty:
+            return
+        key = STAR_TABLES[table]
+        frame = dedupe_keys(frame, key, upsert)
+        cols = list(frame.columns)
+        val_ = ('?,'*len(cols)).rstrip(',')
+        col_names = ','.join(cols)
+        if upsert:
+            updates = ','.join(f'{c}=excluded.{c}' for c in cols if c != key)
+            query = f'''INSERT INTO {table} ({col_names}) VALUES ({val_}) ON CONFLICT({key}) DO UPDATE SET {updates}'''
+        else:
+            query = f'''INSERT OR IGNORE INTO {table} ({col_names}) VALUES ({val_})'''
+        self.exmany_sql(query, iter_rows(frame))
+
     def count_changes(self):
         return self.conn.total_changes
     
     def close_conn(self):
         self.conn.close()
 
+class DuckDB(DB):
+    '''
+    DuckDB (embedded, columnar) implementation of DB with the same star schema, for the large GROUP BY
+    aggregations of the competitor reports. Loads go through DataFrames registered with DuckDB or straight
+    from the parquet dataset instead of executemany, and there are no secondary indexes (DuckDB scans use
+    min/max zone maps instead).
+    '''
+    rollup_keys = False  ## DuckDB primary keys can't be NULL (e.g. the NAICS of an action without an award)
+    ## INTEGER columns of the sqlite schema, cast on insert so both engines return the same types (values that
+    ## aren't numbers, e.g. 'unknown', become NULL since DuckDB columns can't mix types like sqlite's)
+    integer_cols = {'naics_code', 'recipient_zip_code_5'}
+
+    def open_conn(self, row_factory_list=False):
+        if duckdb is None:
+            raise ImportError("settings.DB_ENGINE = 'duckdb' requires the duckdb package")
+        self.conn = duckdb.connect(settings.DUCKDB_PATH)
+        self.cur = self.conn  ## DuckDB connections execute and fetch directly
+        self.changes = 0
+
+    def commit(self):
+        pass  ## autocommits outside of bulk loads
+
+    def ex_sql(self, *args, **kwargs):
+        rows = self.cur.execute(*args)
+        return rows.fetchall() if rows.description else None
+
+    def exmany_sql(self, *args, **kwargs):
+        self.cur.executemany(*args)
+
+    def create_indexes(self):
+        pass
+
+    def add_unique_keys(self):
+        pass  ## DuckDB schemas have always had their key constraints
+
+    def begin_bulk_load(self):
+        '''Runs every insert in one transaction until end_bulk_load()'''
+        self.cur.execute('BEGIN TRANSACTION;')
+        self.bulk_loading = True
+
+    def end_bulk_load(self):
+        '''Commits the bulk load and checkpoints the write-ahead log into the database file'''
+        self.bulk_loading = False
+        self.cur.execute('COMMIT;')
+        self.cur.execute('CHECKPOINT;')
+
+    def abort_bulk_load(self):
+        self.bulk_loading = False
+        self.cur.execute('ROLLBACK;')
+
+    @contextmanager
+    def transaction(self):
+        self.cur.execute('BEGIN TRANSACTION;')
+        self.bulk_loading = True
+        try:
+            yield self
+        except BaseException:
+            self.cur.execute('ROLLBACK;')
+            raise
+        finally:
+            self.bulk_loading = False
+        self.cur.execute('COMMIT;')
+
+    def get_tbl_cols(self, tbl_name):
+        rows = self.cur.execute('''SELECT column_name FROM information_schema.columns
+            WHERE table_name = ? ORDER BY ordinal_position;''', [tbl_name])
+        return [r[0] for r in rows.fetchall() if r[0] != 'id']
+
+    def get_table_dict(self):
+        rows = self.cur.execute("SELECT table_name FROM information_schema.tables WHERE table_type = 'BASE TABLE';")
+        for k in [r[0] for r in rows.fetchall()]:
+            self.all_tbl_cols[k] = self.get_tbl_cols(k)
+
+    def schema(self):
+        return ['''CREATE TABLE IF NOT EXISTS actions (
+                action_key VARCHAR UNIQUE,
+                award_id VARCHAR,
+                recipient_name VARCHAR,
+                raw_recipient_name VARCHAR,
+                dollars_obligated DOUBLE,
+                action_date VARCHAR,
+                action_date_fiscal_year INTEGER,
+                awarding_agency_name VARCHAR,
+                last_modified_date VARCHAR
+            );''',
+            '''CREATE TABLE IF NOT EXISTS awards (
+                award_id VARCHAR UNIQUE,
+                plop_city VARCHAR,
+                plop_state_code VARCHAR,
+                plop_country_code VARCHAR,
+                naics_code INTEGER
+            );''',
+            '''CREATE TABLE IF NOT EXISTS businesses (
+                recipient_name VARCHAR PRIMARY KEY,
+                recipient_city VARCHAR,
+                recipient_zip_code_5 INTEGER,
+                recipient_duns VARCHAR
+            );''',
+            '''CREATE TABLE IF NOT EXISTS load_watermarks (
+                file_name VARCHAR PRIMARY KEY,
+                last_modified_date VARCHAR,
+                action_date VARCHAR
+            );''',
+            'CREATE SEQUENCE IF NOT EXISTS load_runs_id;',
+            '''CREATE TABLE IF NOT EXISTS load_runs (
+                id INTEGER PRIMARY KEY DEFAULT nextval(\'load_runs_id\'),
+                file_name VARCHAR,
+                mode VARCHAR,
+                started VARCHAR,
+                finished VARCHAR,
+                rows_loaded INTEGER,
+                last_modified_date VARCHAR,
+                action_date VARCHAR
+            );''',
+            ALIAS_TABLE_SQL]
+
+    def select_list(self, cols, sources=None):
+        '''SELECT expressions for inserting cols (integer_cols cast, sources maps a column to its source expression)'''
+        sources = sources or {}
+        exprs = []
+        for c in cols:
+            source = sources.get(c, c)
+            exprs.append(f'TRY_CAST({source} AS INTEGER) AS {c}' if c in self.integer_cols else
+                f'{source} AS {c}' if source != c else c)
+        return ','.join(exprs)
+
+    def insert_frame(self, table, frame, upsert=False):
+        '''Inserts a DataFrame into a table with one INSERT ... SELECT over the frame
+        Rows repeating a key are dropped first (see dedupe_keys).
+        '''
+        if frame.empty:
+            return
+        key = STAR_TABLES[table]
+        frame = dedupe_keys(frame, key, upsert)
+        cols = list(frame.columns)
+        col_names = ','.join(cols)
+        selects = self.select_list(cols)
+        if upsert:
+            updates = ','.join(f'{c}=excluded.{c}' for c in cols if c != key)
+            query = f'''INSERT INTO {table} ({col_names}) SELECT {selects} FROM _frame ON CONFLICT ({key}) DO UPDATE SET {updates}'''
+        else:
+            query = f'''INSERT OR IGNORE INTO {table} ({col_names}) SELECT {selects} FROM _frame'''
+        self.conn.register('_frame', frame)
+        try:
+            self.changes += self.cur.execute(query).fetchone()[0]
+        finally:
+            self.conn.unregister('_frame')
+
+    def save_aliases(self, rows):
+        self.create_alias_table()
+        self.conn.register('_aliases', pd.DataFrame(rows, columns=['alias', 'recipient_duns', 'canonical_name', 'score']))
+        try:
+            self.cur.execute('''INSERT INTO recipient_aliases SELECT alias, recipient_duns, canonical_name, score FROM _aliases
+                ON CONFLICT(alias, recipient_duns) DO UPDATE SET canonical_name=excluded.canonical_name, score=excluded.score;''')
+        finally:
+            self.conn.unregister('_aliases')
+
+    def insert_parquet(self, fname=None):
+        '''Bulk loads the cleaned parquet dataset (gcdc.make_parquet) straight into the star tables
+        Rows repeating a key keep the first one in settings.ORDER_COL order, like the sqlite insert. Names are
+        loaded as reported: unlike manage.insert_data, recipient_name isn't canonicalized (see name_index.py)
+        even with settings.CANONICALIZE_NAMES on.
+            args:
+                fname: (str) dataset directory. Defaults to settings.DEF_PARQUET_PATH
+            returns (int) number of actions inserted
+        '''
+        fname = fname or settings.DEF_PARQUET_PATH
+        files = os.path.join(fname, '**', '*.parquet').replace("'", "''")
+        source = f"read_parquet('{files}', hive_partitioning = true)"
+        num_actions = 0
+        for table, key in STAR_TABLES.items():
+            cols = sorted(self.all_tbl_cols[table])
+            col_names = ','.join(cols)
+            selects = self.select_list(cols, dict(SOURCE_COLS,
+                **{settings.PARTITION_COL: f'NULLIF({settings.PARTITION_COL}, {settings.MISSING_PARTITION})'}))
+            rows = self.cur.execute(f'''INSERT OR IGNORE INTO {table} ({col_names})
+                SELECT {selects} FROM {source}
+                QUALIFY {key} IS NULL OR row_number() OVER (PARTITION BY {key} ORDER BY {settings.ORDER_COL}) = 1;''').fetchone()[0]
+            self.changes += rows
+            if table == 'actions':
+                num_actions = rows
+        return num_actions
+
+    def count_changes(self):
+        return self.changes
+
+# Database engines for connect(), by settings.DB_ENGINE name
+ENGINES = {'sqlite': DB, 'duckdb': DuckDB}
+
+def connect(new_build=False, row_factory_list=False, engine=None):
+    '''Opens (or builds, see DB) the database with the configured engine
+        args:
+            engine: (str) ENGINES key. Defaults to settings.DB_ENGINE
+    '''
+    return ENGINES[engine or settings.DB_ENGINE](new_build, row_factory_list)
+
+class ConnectionPool:
+    '''
+    Thread-safe pool of read-only connections for queries (BI app, ad-hoc analytics).
+    Connections are reused across threads so their prepared statement caches stay warm.
+    Writes still go through DB.
+    '''
+    def __init__(self, db_path=None, size=4, cached_statements=256):
+        '''
+        args:
+            db_path: (str) sqlite file. Defaults to settings.DB_PATH
+            size: (int) max number of open connections
+            cached_statements: (int) prepared statements cached per connection
+        '''
+        self.db_path = db_path or settings.DB_PATH
+        self.size = size
+        self.cached_statements = cached_statements
+        self.idle = LifoQueue(maxsize=size)
+        self.slots = threading.BoundedSemaphore(size)
+
+    def new_conn(self):
+        uri = f'file:{self.db_path}?mode=ro'
+        return sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=self.cached_statements)
+
+    @contextmanager
+    def connection(self):
+        '''Borrows a connection (blocks while all are in use)'''
+        self.slots.acquire()
+        try:
+            conn = self.idle.get_nowait()
+        except Empty:
+            conn = self.new_conn()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+            self.slots.release()
+
+    def query(self, sql, params=(), batch_size=1000):
+        '''Streams the rows of a query
+            args:
+                sql: (str) query
+                params: (tuple/dict) query parameters
+                batch_size: (int) rows fetched at a time
+            returns (generator) of row tuples, the connection is returned to the pool once exhausted or closed
+        '''
+        with self.connection() as conn:
+            cur = conn.execute(sql, params)
+            try:
+                rows = cur.fetchmany(batch_size)
+                while rows:
+                    yield from rows
+                    rows = cur.fetchmany(batch_size)
+            finally:
+                cur.close()
+
+    def query_df(self, sql, params=(), **kwargs):
+        '''Runs a query into a DataFrame (kwargs are passed to pd.read_sql_query)'''
+        with self.connection() as conn:
+            return pd.read_sql_query(sql, conn, params=params, **kwargs)
+
+    def query_array(self, sql, params=()):
+        '''Runs a query into a NumPy array (one column per selected field)'''
+        with self.connection() as conn:
+            return np.array(conn.execute(sql, params).fetchall())
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path=None, size=4):
+    '''Shared read-only ConnectionPool for a database file (one per path per process)'''
+    db_path = db_path or settings.DB_PATH
+    with _pools_lock:
+        if db_path not in _pools:
+            _pools[db_path] = ConnectionPool(db_path, size)
+        return _pools[db_path]
+
 if __name__ == '__main__':
     d = DB()
     print(d.all_tbl_cols)
@@ -0,0 +1,12 @@
+import pytest
+
+import settings
+
+
+@pytest.fixture
+def quality_report_path(tmp_path, monkeypatch):
+    '''Writes the data quality reports of the tests that profile the data to a temporary file instead of
+    data/quality_report.json'''
+    path = str(tmp_path / 'quality_report.json')
+    monkeypatch.setattr(settings, 'QUALITY_REPORT_PATH', path)
+    return path
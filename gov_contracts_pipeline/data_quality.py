@@ -0,0 +1,168 @@
+import json
+import numpy as np
+import pandas as pd
+import settings
+
+
+# Expected formats of raw (source) columns, checked on their non-null values
+FORMAT_RULES = {
+    'action_date': r'\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?',
+    'period_of_performance_start_date': r'\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?',
+    'period_of_performance_current_end_date': r'\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?',
+    'period_of_performance_potential_end_date': r'\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?',
+    'last_modified_date': r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}',
+    'naics_code': r'\d{6}',
+    'primary_place_of_performance_state_code': r'[A-Z]{2,3}',  # places outside the US carry their country code
+    'primary_place_of_performance_country_code': r'[A-Z]{3}',
+    'award_type_code': r'[A-Z]'}
+EXAMPLES = 5  # violating values kept per column for the report
+
+
+class DataQualityError(ValueError):
+    '''Raised when a profile breaks the quality thresholds (see check)'''
+
+
+class HyperLogLog:
+    '''
+    HyperLogLog distinct count sketch (2**p one byte registers, ~1.04 / sqrt(2**p) relative error).
+    Sketches of different chunks merge by taking the register maximums.
+    '''
+    def __init__(self, p=12):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, values):
+        '''Adds an array of values (hashed with pandas' hash_array)'''
+        if len(values) == 0:
+            return
+        hashes = pd.util.hash_array(np.asarray(values, dtype=object))
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        low = (hashes & np.uint64(0xFFFFFFFF)).astype(np.float64)  # rank from the low 32 bits (exact in a float)
+        bit_length = np.zeros(len(low))
+        nonzero = low > 0
+        bit_length[nonzero] = np.floor(np.log2(low[nonzero])) + 1
+        rank = (33 - bit_length).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+
+class Profile:
+    '''
+    Per-column data quality statistics of raw chunks: null counts, HyperLogLog distinct counts,
+    min/max (numeric and date columns) and FORMAT_RULES violations. Each column is factorized once
+    per chunk and every statistic is computed from its unique values and their counts.
+    Profiles of chunks cleaned in different workers merge with merge().
+    '''
+    def __init__(self):
+        self.rows = 0
+        self.columns = {}
+
+    @classmethod
+    def of(cls, df: pd.DataFrame):
+        return cls().add(df)
+
+    def add(self, df: pd.DataFrame):
+        '''Adds a chunk's statistics'''
+        self.rows += df.shape[0]
+        for col in df.columns:
+            stats = self.columns.setdefault(col, {'nulls': 0, 'min': None, 'max': None, 'hll': HyperLogLog(),
+                'violations': 0, 'examples': []})
+            series = df[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+            else:
+                codes, uniques = pd.factorize(series)
+            counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+            present = pd.Series(uniques)[counts > 0]
+            counts = counts[counts > 0]
+            stats['nulls'] += int(np.count_nonzero(codes < 0))
+            stats['hll'].add(present.to_numpy())
+            if len(present) and (pd.api.types.is_numeric_dtype(present) or pd.api.types.is_datetime64_any_dtype(present)):
+                self._bound(stats, 'min', present.min(), min)
+                self._bound(stats, 'max', present.max(), max)
+            if col in FORMAT_RULES and len(present):
+                bad = ~present.astype(str).str.fullmatch(FORMAT_RULES[col]).to_numpy(dtype=bool)
+                stats['violations'] += int(counts[bad].sum())
+                room = EXAMPLES - len(stats['examples'])
+                stats['examples'] += [str(v) for v in present[bad].iloc[:room]]
+        return self
+
+    @staticmethod
+    def _bound(stats, name, value, pick):
+        value = value.item() if hasattr(value, 'item') else value
+        stats[name] = value if stats[name] is None else pick(stats[name], value)
+
+    def merge(self, other):
+        '''Adds another profile's statistics (e.g. from another worker)'''
+        self.rows += other.rows
+        for col, theirs in other.columns.items():
+            if col not in self.columns:
+                self.columns[col] = theirs
+                continue
+            stats = self.columns[col]
+            stats['nulls'] += theirs['nulls']
+            stats['violations'] += theirs['violations']
+            stats['hll'].merge(theirs['hll'])
+            stats['examples'] = (stats['examples'] + theirs['examples'])[:EXAMPLES]
+            for name, pick in (('min', min), ('max', max)):
+                if theirs[name] is not None:
+                    self._bound(stats, name, theirs[name], pick)
+        return self
+
+    def report(self) -> dict:
+        '''returns (dict) of rows and per column null_rate, distinct (estimate), min, max, violations and violation_rate'''
+        columns = {}
+        for col, stats in self.columns.items():
+            non_null = self.rows - stats['nulls']
+            columns[col] = {
+                'null_rate': round(stats['nulls'] / self.rows, 6) if self.rows else 0.0,
+                'distinct': stats['hll'].count(),
+                'min': None if stats['min'] is None else str(stats['min']),
+                'max': None if stats['max'] is None else str(stats['max']),
+                'violations': stats['violations'],
+                'violation_rate': round(stats['violations'] / non_null, 6) if non_null else 0.0,
+                'examples': stats['examples']}
+        return {'rows': self.rows, 'columns': columns}
+
+
+def check(profile: Profile, final: bool=True):
+    '''Raises DataQualityError if the profile breaks settings.QUALITY_MAX_NULL_RATES or QUALITY_MAX_VIOLATION_RATE
+        args:
+            profile: (Profile) statistics so far
+            final: (bool) whether the whole file has been profiled. Partial profiles are only checked once
+                they cover settings.QUALITY_MIN_ROWS rows
+    '''
+    if not final and profile.rows < settings.QUALITY_MIN_ROWS:
+        return
+    report = profile.report()['columns']
+    problems = []
+    for col, max_rate in settings.QUALITY_MAX_NULL_RATES.items():
+        if col in report and report[col]['null_rate'] > max_rate:
+            problems.append(f"{col}: null rate {report[col]['null_rate']:.2%} > {max_rate:.2%}")
+    for col, stats in report.items():
+        if stats['violation_rate'] > settings.QUALITY_MAX_VIOLATION_RATE:
+            problems.append(f"{col}: {stats['violations']} format violations ({stats['violation_rate']:.2%}), e.g. {stats['examples']}")
+    if problems:
+        raise DataQualityError(f'{profile.rows} rows profiled:\n' + '\n'.join(problems))
+
+def write_report(profile: Profile, fname: str=None) -> dict:
+    '''Writes the profile's report as json (defaults to settings.QUALITY_REPORT_PATH) and prints a summary'''
+    report = profile.report()
+    with open(fname or settings.QUALITY_REPORT_PATH, 'w') as file_:
+        json.dump(report, file_, indent=2)
+    flagged = {c: s for c, s in report['columns'].items() if s['null_rate'] or s['violations']}
+    print(f"Data quality: {report['rows']} rows, {len(flagged)} columns with nulls or violations")
+    for col, stats in flagged.items():
+        print(f"  {col:<45} nulls {stats['null_rate']:>7.2%}  violations {stats['violations']:>7}  distinct ~{stats['distinct']}")
+    return report
@@ -7,13 +7,32 @@
 
 # imports
 from multiprocessing import freeze_support, Pool
+import errno
+import io
+import json
+import math
+import shutil
+import tempfile
+import tracemalloc
+from functools import partial
+from threading import Event, Semaphore
+import numpy as np
 import pandas as pd
 import os
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # only needed for parquet output and the arrow pool handoff
+    pa = None
 from time import time
 
 
 # import various settings
-from settings import DEF_DATA_FILE, DATA_PATH, rename_map, DEF_CLEAN_PATH
+from settings import DEF_DATA_FILE, DATA_PATH, rename_map, DEF_CLEAN_PATH, source_dtypes, date_formats
+from settings import DEF_PARQUET_PATH, WRITE_PARQUET, PARTITION_COL, MISSING_PARTITION, ORDER_COL, categorical_cols, numeric_cols
+from settings import RUN_LOG_PATH, POOL_MIN_BYTES, POOL_CHUNK_ROWS, POOL_MEM_FACTOR, POOL_HANDOFF, POOL_HANDOFF_DIR
+from settings import PROFILE_MEMORY, PROFILE_QUALITY
+import data_quality
 
 start = time()
 
@@ -21,7 +40,7 @@ def pipeline(df: pd.DataFrame, *args, **kwargs) -> pd.DataFrame:
     """Initial transformations
 
     Args:
-        df (pd.DataFrame): Raw dataset
+        df (pd.DataFrame): Raw dataset (its columns are renamed in place)
 
     Returns:
         pd.DataFrame: Initial processed data
@@ -30,14 +49,52 @@ def pipeline(df: pd.DataFrame, *args, **kwargs) -> pd.DataFrame:
     # keep_list = [k for k in rename_map]
     # df = df[keep_list] 
     
-    df = df.rename(columns=rename_map)
-    df = df.drop(columns=['city_local_government',
-                                'award_or_idv_flag',
-                                'parent_award_mod_number'])
-    df = df[df.columns.sort_values()]
+    df.rename(columns=rename_map, inplace=True)
+    drop_cols = ['city_local_government', 'award_or_idv_flag', 'parent_award_mod_number']
+    keep_cols = df.columns.drop(drop_cols).sort_values()
 
     # Removes any actions with 0 dollars_obligated
-    df = df[df['dollars_obligated'] != 0].copy()
+    # (one row/column take instead of a copy each for the drop, the sort and the filter)
+    keep_rows = (df['dollars_obligated'] != 0).to_numpy()
+    return df.iloc[np.flatnonzero(keep_rows), df.columns.get_indexer(keep_cols)]
+
+def fill_from(target: pd.Series, values) -> pd.Series:
+    """## fillna that also works on categorical columns
+    Adds any new fill values to the target's categories first.
+
+    Args:
+        target (pd.Series): Column to fill
+        values (pd.Series or scalar): Fill values
+
+    Returns:
+        pd.Series: Filled column
+    """    
+    missing = target.isna()
+    if not missing.any():
+        return target
+    if not isinstance(target.dtype, pd.CategoricalDtype):
+        return target.fillna(values)
+    if isinstance(values, pd.Series):
+        values = values[missing].astype(object)
+        new_cats = pd.unique(values.dropna())
+    else:
+        new_cats = [values]
+    new_cats = [c for c in new_cats if c not in target.cat.categories]
+    return target.cat.add_categories(new_cats).fillna(values)
+
+def fill_unknown(df: pd.DataFrame) -> pd.DataFrame:
+    """## Fills remaining nulls in text columns with 'unknown' (categorical safe)
+    Date and numeric columns keep their dtype and nulls (make_csv writes those as 'unknown').
+
+    Args:
+        df (pd.DataFrame): The data (filled in place)
+
+    Returns:
+        pd.DataFrame: Filled data
+    """    
+    for col in df.columns:
+        if df[col].dtype == object or isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = fill_from(df[col], 'unknown')
     return df
 
 def fill_nulls(df: pd.DataFrame) -> pd.DataFrame:
@@ -50,11 +107,11 @@ def fill_nulls(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: Resolved data
     """    
-    df['parent_award_agency_name'] = df['parent_award_agency_name'].fillna(df['awarding_agency_name'])
-    df['awarding_agency_name'] = df['awarding_agency_name'].fillna(df['parent_award_agency_name'])
-    df['parent_award_agency_id'] = df['parent_award_agency_id'].fillna(df['awarding_sub_agency_code'])
-    df['award_description'] = df['award_description'].fillna('unknown')
-    df['award_id'] = df['award_id'].fillna(df['award_piid_ref'])
+    df['parent_award_agency_name'] = fill_from(df['parent_award_agency_name'], df['awarding_agency_name'])
+    df['awarding_agency_name'] = fill_from(df['awarding_agency_name'], df['parent_award_agency_name'])
+    df['parent_award_agency_id'] = fill_from(df['parent_award_agency_id'], df['awarding_sub_agency_code'])
+    df['award_description'] = fill_from(df['award_description'], 'unknown')
+    df['award_id'] = fill_from(df['award_id'], df['award_piid_ref'])
     return df
 
 # resolve missing data for international places of performance
@@ -69,7 +126,7 @@ def fix_international(df: pd.DataFrame) -> pd.DataFrame:
     """    
     for col in df.columns:
         if 'plop' in col:
-            df[col] = df[col].fillna(df['plop_country_code'])
+            df[col] = fill_from(df[col], df['plop_country_code'])
     return df
 
 # Resolve minor name variations
@@ -109,12 +166,114 @@ def fix_date_issues(date_: str) -> str:
         date_ = '20' + date_[2:]
     return date_
 
+# Vectorized versions of reformat_names/fix_date_issues (the per-row functions above are kept as the reference path)
+def reformat_names_vec(names: pd.Series) -> pd.Series:
+    """## Vectorized reformat_names
+
+    Args:
+        names (pd.Series): name strings
+
+    Returns:
+        pd.Series: Resolved name strings
+    """    
+    # Only the unique names need fixing
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        codes, uniques = names.cat.codes.to_numpy(), names.cat.categories
+    else:
+        codes, uniques = pd.factorize(names)
+    uniques = pd.Series(uniques, dtype=object)
+    resolved = uniques.str.replace(
+        ',', '', regex=False).str.replace(
+        '.', '', regex=False).str.replace(
+        'INCORPORATED', 'INC', regex=False).str.replace(
+        'LIMITED LIABILITY COMPANY', 'LLC', regex=False)
+    resolved = np.append(resolved.to_numpy(dtype=object), 'missing')
+    return pd.Series(resolved[codes], index=names.index, name=names.name, dtype=object)  # code -1 (null) -> 'missing'
+
+def fix_date_issues_vec(dates: pd.Series) -> pd.Series:
+    """## Vectorized fix_date_issues
+
+    Args:
+        dates (pd.Series): Date strings
+
+    Returns:
+        pd.Series: Reformatted date strings (None where missing)
+    """    
+    missing = dates.isna()
+    dates = dates.astype(str)
+    years = pd.to_numeric(dates.str.extract(r'^(\d{4})', expand=False), errors='coerce').to_numpy()
+    bad_century = (years < 2000) | (years > 2100)
+    fixed = np.where(bad_century, '20' + dates.str[2:], dates)
+    return pd.Series(fixed, index=dates.index, dtype=object).where(~missing, None)
+
+# Candidate formats tried (after the settings.date_formats hint) when detecting a date column's format
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y', '%m/%d/%Y %H:%M:%S', '%Y%m%d']
+
+# Known formats by cleaned column name
+clean_date_formats = {rename_map[col]: fmt for col, fmt in date_formats.items()}
+
+def detect_date_format(dates: pd.Series, hint: str=None, sample_size: int=100, min_share: float=0.9) -> str:
+    """## Finds the format that parses a sample of a date column
+
+    Args:
+        dates (pd.Series): Date strings
+        hint (str, optional): Format to try first. Defaults to None.
+        sample_size (int, optional): Number of unique values tested. Defaults to 100.
+        min_share (float, optional): Share of the sample the format has to parse (bad dates are expected). Defaults to 0.9.
+
+    Returns:
+        str: strftime format, or None if no candidate parses the sample
+    """    
+    sample = pd.Series(dates.dropna().unique()[:sample_size], dtype=object)
+    if sample.empty:
+        return hint
+    for fmt in [hint] + DATE_FORMATS:
+        if not fmt:
+            continue
+        if pd.to_datetime(sample, format=fmt, errors='coerce').notna().mean() >= min_share:
+            return fmt
+
+def parse_dates(dates: pd.Series, fmt: str=None, repair: bool=True) -> pd.Series:
+    """## Repairs and parses a date column
+    The column is factorized so each unique value is parsed once, with the format detected once for
+    the column. Only values that fail to parse (or, with repair, land outside 2000-2100) go through the
+    century fix and then inference. Unparseable values become NaT.
+
+    Args:
+        dates (pd.Series): Date strings
+        fmt (str, optional): Expected format. Defaults to None.
+        repair (bool, optional): Apply the fix_date_issues century fix (only meant for the pop dates,
+            real dates before 2000 would be moved to 20xx). Defaults to True.
+
+    Returns:
+        pd.Series: datetime64 column
+    """    
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    codes, uniques = pd.factorize(dates)
+    uniques = pd.Series(uniques, dtype=object)
+    fmt = detect_date_format(uniques, fmt)
+    parsed = pd.to_datetime(uniques, format=fmt, errors='coerce')
+    suspect = parsed.isna()
+    if repair:
+        suspect |= (parsed.dt.year < 2000) | (parsed.dt.year > 2100)
+    if suspect.any():
+        fixed = fix_date_issues_vec(uniques[suspect]) if repair else uniques[suspect]
+        reparsed = pd.to_datetime(fixed, format=fmt, errors='coerce')
+        failed = reparsed.isna()
+        if failed.any():
+            reparsed[failed] = pd.to_datetime(fixed[failed], errors='coerce')
+        parsed[suspect] = reparsed
+    parsed = np.append(parsed.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT', 'ns'))
+    return pd.Series(parsed[codes], index=dates.index, name=dates.name)  # code -1 (null) -> NaT
+
 # convert date columns to datetime dtype
-def dtype_conversions(df: pd.DataFrame) -> pd.DataFrame:
+def dtype_conversions(df: pd.DataFrame, fast: bool=True) -> pd.DataFrame:
     """## Converts date columns to datetime
 
     Args:
         df (pd.DataFrame): target data
+        fast (bool, optional): Use parse_dates instead of to_datetime with format inference. Defaults to True.
 
     Returns:
         pd.DataFrame: trsnsformed data
@@ -123,6 +282,10 @@ def dtype_conversions(df: pd.DataFrame) -> pd.DataFrame:
         if 'fiscal_year' in col:
             continue
         if 'date' in col:
+            if fast:
+                # only the pop dates get the century fix (see fill_pop_dates)
+                df[col] = parse_dates(df[col], clean_date_formats.get(col), repair='pop' in col)
+                continue
             try:
                 df[col] = pd.to_datetime(df[col])
             except:
@@ -147,48 +310,245 @@ def add_zip_str(df: pd.DataFrame) -> pd.DataFrame:
             df[col + '_5'] = series_col.str[:5]
     return df
 
-# Runs the rest of the pipeline
-def run_pipeline2(df: pd.DataFrame) -> pd.DataFrame:
-    """## Runs entire pipeline
+def fix_names(df: pd.DataFrame, vectorized: bool=True) -> pd.DataFrame:
+    """## Resolves minor recipient name variations (see reformat_names)
 
     Args:
-        df (pd.DataFrame): The data to transform.
+        df (pd.DataFrame): The data
+        vectorized (bool, optional): Use reformat_names_vec instead of the per-row apply. Defaults to True.
 
     Returns:
-        pd.DataFrame: Transformed data
+        pd.DataFrame: Data with fixed names
+    """    
+    if vectorized:
+        df['recipient_name'] = reformat_names_vec(df['recipient_name'])
+    else:
+        df.loc[:,'recipient_name'] = df.loc[:,'recipient_name'].apply(reformat_names)
+    return df
+
+def fill_pop_dates(df: pd.DataFrame, vectorized: bool=True) -> pd.DataFrame:
+    """## Fills missing period of performance dates with the action date
+
+    Args:
+        df (pd.DataFrame): The data
+        vectorized (bool, optional): Leave the century fix to parse_dates instead of applying fix_date_issues. Defaults to True.
+
+    Returns:
+        pd.DataFrame: Data with filled dates
     """    
-    df = pipeline(df)
-    df = fill_nulls(df)
-    df = fix_international(df)
-    df.loc[:,'recipient_name'] = df.loc[:,'recipient_name'].apply(reformat_names)
-    
-    date_cols = []
     for col in df.columns:
         if 'date' in col and 'pop' in col:
-            date_cols.append(col)
+            df[col] = fill_from(df[col], df['action_date'])
+            if not vectorized:
+                df[col] = df[col].apply(fix_date_issues)
+    return df
+
+def cleaning_stages(vectorized: bool=True) -> list:
+    """## The cleaning transform chain run by run_pipeline2
+    Every stage after pipeline updates the frame in place, column by column.
+
+    Args:
+        vectorized (bool, optional): Use the vectorized name/date fixes. Defaults to True.
+
+    Returns:
+        list: (name, function) for each stage, in order
+    """    
+    return [
+        ('pipeline', pipeline),
+        ('fill_nulls', fill_nulls),
+        ('fix_international', fix_international),
+        ('fix_names', partial(fix_names, vectorized=vectorized)),
+        ('fill_pop_dates', partial(fill_pop_dates, vectorized=vectorized)),
+        ('dtype_conversions', partial(dtype_conversions, fast=vectorized)),
+        ('add_zip_str', add_zip_str)]
+
+def profile_stage(stage, df: pd.DataFrame, name: str, profile: list) -> pd.DataFrame:
+    """## Runs a stage under tracemalloc and appends its allocations to the profile
 
-    for d in date_cols:
-        df[d] = df[d].fillna(df['action_date'])
-        df[d] = df[d].apply(fix_date_issues)
+    Args:
+        stage (function): The stage
+        df (pd.DataFrame): Its input
+        name (str): Stage name for the profile
+        profile (list): Gets a dict of peak_bytes (above the memory traced before the stage), net_bytes and secs
 
-    df = dtype_conversions(df)
-    df = add_zip_str(df)
+    Returns:
+        pd.DataFrame: The stage's output
+    """    
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    began = time()
+    df = stage(df)
+    secs = time() - began
+    current, peak = tracemalloc.get_traced_memory()
+    if started_tracing:
+        tracemalloc.stop()
+    profile.append({'stage': name, 'peak_bytes': peak - before, 'net_bytes': current - before, 'secs': round(secs, 4)})
     return df
 
+# Runs the rest of the pipeline
+def run_pipeline2(df: pd.DataFrame, vectorized: bool=True, profile: list=None) -> pd.DataFrame:
+    """## Runs entire pipeline
+    The raw frame is renamed in place and taken once (see pipeline), the other stages update that copy in place.
+
+    Args:
+        df (pd.DataFrame): The data to transform.
+        vectorized (bool, optional): Use the vectorized name/date fixes instead of the per-row apply. Defaults to True.
+        profile (list, optional): Gets the tracemalloc allocation profile of each stage (see profile_stage). Defaults to None (not profiled).
+
+    Returns:
+        pd.DataFrame: Transformed data
+    """    
+    for name, stage in cleaning_stages(vectorized):
+        if profile is None:
+            df = stage(df)
+        else:
+            df = profile_stage(stage, df, name, profile)
+    return df
+
+def print_profile(profile: list):
+    """## Prints a run_pipeline2 allocation profile"""    
+    for record in profile:
+        print(f"{record['stage']:<20} peak {record['peak_bytes'] / 1e6:>9.1f} MB  net {record['net_bytes'] / 1e6:>9.1f} MB  {record['secs']:.3f} secs")
+
 def make_csv(data: pd.DataFrame, fname: str=None, update: bool=True):
     if update:
         if not fname:
             fname = DEF_CLEAN_PATH
         else:
             fname = os.path.join(DATA_PATH, fname)
-        data.to_csv(fname, index=False)
+        data.to_csv(fname, index=False, na_rep='unknown')
+
+def columnar_types(data: pd.DataFrame) -> pd.DataFrame:
+    """## Restores typed columns for columnar output
+    Undoes the 'unknown' fill for dates and numbers, and stores low cardinality columns as categoricals.
+    Rows without a fiscal year go to the MISSING_PARTITION partition.
 
+    Args:
+        data (pd.DataFrame): Cleaned data
+
+    Returns:
+        pd.DataFrame: Typed copy of the data
+    """    
+    data = data.copy(deep=False)
+    for col in data.columns:
+        if col == PARTITION_COL:
+            data[col] = pd.to_numeric(data[col], errors='coerce').fillna(MISSING_PARTITION).astype('int64')
+            continue
+        if col in categorical_cols:
+            data[col] = data[col].astype(str).astype('category')
+        elif col in numeric_cols:
+            data[col] = pd.to_numeric(data[col], errors='coerce')
+        elif 'date' in col and 'fiscal_year' not in col:
+            data[col] = pd.to_datetime(data[col], errors='coerce')
+        elif data[col].dtype == object:
+            data[col] = data[col].astype(str)
+    return data
+
+def make_parquet(data: pd.DataFrame, fname: str=None, update: bool=True, append: bool=False, first_row: int=0):
+    """## Writes the cleaned data as a parquet dataset partitioned by fiscal year
+    Each row's position in the cleaned data is stored in ORDER_COL.
+
+    Args:
+        data (pd.DataFrame): Cleaned data
+        fname (str, optional): Dataset directory name in DATA_PATH. Defaults to DEF_PARQUET_PATH.
+        update (bool, optional): Whether to write the file. Defaults to True.
+        append (bool, optional): Add files to an existing dataset instead of replacing it. Defaults to False.
+        first_row (int, optional): Position of data's first row (rows already in the dataset). Defaults to 0.
+    """    
+    if update:
+        if not fname:
+            fname = DEF_PARQUET_PATH
+        else:
+            fname = os.path.join(DATA_PATH, fname)
+        if not append and os.path.isdir(fname):
+            shutil.rmtree(fname)
+        data = columnar_types(data)
+        data[ORDER_COL] = np.arange(first_row, first_row + data.shape[0])
+        data.to_parquet(fname, engine='pyarrow', index=False, partition_cols=[PARTITION_COL])
 
-def exec_pipeline(fn: str=None) -> pd.DataFrame:
+def read_parquet(columns: list=None, years: list=None, fname: str=None) -> pd.DataFrame:
+    """## Loads the cleaned parquet dataset
+    Only the requested columns and fiscal year partitions are read.
+
+    Args:
+        columns (list, optional): Columns to load. Defaults to all (but ORDER_COL).
+        years (list, optional): Fiscal years to load. Defaults to all.
+        fname (str, optional): Dataset directory name in DATA_PATH. Defaults to DEF_PARQUET_PATH.
+
+    Returns:
+        pd.DataFrame: Typed cleaned data
+    """    
+    if not fname:
+        fname = DEF_PARQUET_PATH
+    else:
+        fname = os.path.join(DATA_PATH, fname)
+    filters = None
+    if years:
+        filters = [(PARTITION_COL, 'in', [int(y) for y in years])]
+    data = pd.read_parquet(fname, engine='pyarrow', columns=columns, filters=filters)
+    if columns is None:
+        data = data.drop(columns=[ORDER_COL], errors='ignore')
+    if PARTITION_COL in data.columns:
+        years = data[PARTITION_COL].astype(int)
+        data[PARTITION_COL] = years.astype(source_dtypes['action_date_fiscal_year']).mask(years == MISSING_PARTITION)
+    return data
+
+def csv_sink(fname: str=None):
+    """## Creates a sink that appends cleaned chunks to a csv file
+    The file is overwritten by the first chunk.
+
+    Args:
+        fname (str, optional): Filename in DATA_PATH. Defaults to DEF_CLEAN_PATH.
+
+    Returns:
+        function: Sink to pass to exec_pool_stream
+    """    
+    if not fname:
+        fname = DEF_CLEAN_PATH
+    else:
+        fname = os.path.join(DATA_PATH, fname)
+    first_chunk = [True]
+
+    def sink(data: pd.DataFrame):
+        data.to_csv(fname, mode='w' if first_chunk[0] else 'a', header=first_chunk[0], index=False, na_rep='unknown')
+        first_chunk[0] = False
+    return sink
+
+def parquet_sink(fname: str=None):
+    """## Creates a sink that writes cleaned chunks to the partitioned parquet dataset
+    The dataset is replaced by the first chunk, later chunks add their own files to its partitions.
+
+    Args:
+        fname (str, optional): Dataset directory name in DATA_PATH. Defaults to DEF_PARQUET_PATH.
+
+    Returns:
+        function: Sink to pass to exec_pool_stream
+    """    
+    rows_written = [0]
+
+    def sink(data: pd.DataFrame):
+        make_parquet(data, fname, append=rows_written[0] > 0, first_row=rows_written[0])
+        rows_written[0] += data.shape[0]
+    return sink
+
+def tee_sinks(*sinks):
+    """## Creates a sink that passes each cleaned chunk to every sink, in order"""    
+    def sink(data: pd.DataFrame):
+        for s in sinks:
+            s(data)
+    return sink
+
+
+def exec_pipeline(fn: str=None, update: bool=True, quality: bool=None) -> pd.DataFrame:
     """## Execute cleaning pipeline (slow non-parallel version)
 
     Args:
         fn (str, optional): Filename of dirty data. Defaults to None.
+        update (bool, optional): Write the cleaned csv/parquet files. Defaults to True.
+        quality (bool, optional): Profile the raw data and check it before writing anything (see data_quality). Defaults to PROFILE_QUALITY.
 
     Returns:
         pd.DataFrame: Cleaned data
@@ -200,38 +560,428 @@ def exec_pipeline(fn: str=None) -> pd.DataFrame:
             file_name = os.path.join(DATA_PATH, fn)
     else:
         file_name = DEF_DATA_FILE
-    data = pd.read_csv(file_name, usecols=[c for c in rename_map], low_memory=False)
+    data = pd.read_csv(file_name, usecols=[c for c in rename_map], dtype=source_dtypes, low_memory=False)
+    if PROFILE_QUALITY if quality is None else quality:
+        finish_quality(data_quality.Profile.of(data))
     # data = pipeline(data)
-    data = run_pipeline2(data)
-    data = data.fillna('unknown')
-    make_csv(data)
+    if PROFILE_MEMORY:
+        profile = []
+        data = run_pipeline2(data, profile=profile)
+        data = profile_stage(fill_unknown, data, 'fill_unknown', profile)
+        print_profile(profile)
+        append_run_log({'task': 'run_pipeline2', 'file': os.path.basename(file_name), 'rows': data.shape[0], 'stages': profile})
+    else:
+        data = run_pipeline2(data)
+        data = fill_unknown(data)
+    make_csv(data, update=update)
+    make_parquet(data, update=update and WRITE_PARQUET)
     return data
 
-def exec_pool(fn: str=None, num_processes: int=5) -> pd.DataFrame:
+def source_path(fn: str=None) -> str:
+    """## Resolves the raw data file read by exec_pool/exec_pool_stream
+
+    Args:
+        fn (str, optional): Filename in DATA_PATH (or full path). Defaults to None.
+
+    Returns:
+        str: File path
+    """    
+    if not fn:
+        return os.path.join(DATA_PATH, 'USAspending_award_summaries.csv')
+    return os.path.join(DATA_PATH, fn)
+
+def clean_profiled(df: pd.DataFrame) -> tuple:
+    """## Profiles a raw chunk (see data_quality.Profile) and then cleans it
+
+    Args:
+        df (pd.DataFrame): Raw chunk
+
+    Returns:
+        tuple: (cleaned chunk, data_quality.Profile)
+    """    
+    profile = data_quality.Profile.of(df)
+    return run_pipeline2(df), profile
+
+def merge_quality(profile: data_quality.Profile, chunk_profile: data_quality.Profile):
+    """## Merges a chunk's profile and fails fast (with a report of the rows so far) if it breaks the thresholds"""    
+    profile.merge(chunk_profile)
+    try:
+        data_quality.check(profile, final=False)
+    except data_quality.DataQualityError:
+        data_quality.write_report(profile)
+        raise
+
+def finish_quality(profile: data_quality.Profile):
+    """## Writes the data quality report and checks the complete profile against the thresholds"""    
+    data_quality.write_report(profile)
+    data_quality.check(profile)
+
+def exec_pool(fn: str=None, num_processes: int=5, chunksize: int=100000, handoff: str='pickle', quality: bool=None, parquet: bool=False) -> pd.DataFrame:
     """## Executes the Data Cleaning pipeline using multiprocessing pools
 
     Args:
         fn (str, optional): Filename. Defaults to None.
-        num_processes (int, optional): Number of processes and chunks. Defaults to 5.
+        num_processes (int, optional): Number of processes. Defaults to 5.
+        chunksize (int, optional): Rows per chunk. Defaults to 100000.
+        handoff (str, optional): 'pickle' sends raw chunks to the workers and cleaned chunks back through the pool,
+            'arrow' has the workers read their own byte range and hand back Arrow files (see exec_pool_arrow). Defaults to 'pickle'.
+        quality (bool, optional): Profile each raw chunk in its worker, merge the profiles and check them after every chunk
+            (raises data_quality.DataQualityError). Defaults to PROFILE_QUALITY.
+        parquet (bool, optional): Also write the cleaned data as the parquet dataset (see make_parquet). Defaults to False.
 
     Returns:
         pd.DataFrame: Cleaned dataframe
     """
-    if not fn:
-        fn = os.path.join(DATA_PATH, 'USAspending_award_summaries.csv')
-    else:
-        fn = os.path.join(DATA_PATH, fn)
-
-    chunks = pd.read_csv(fn, chunksize=100000, usecols=[c for c in rename_map], low_memory=False)
+    quality = PROFILE_QUALITY if quality is None else quality
+    if handoff == 'arrow':
+        data = exec_pool_arrow(fn, num_processes, chunksize, quality)
+        make_parquet(data, update=parquet)
+        return data
+    fn = source_path(fn)
+
+    chunks = pd.read_csv(fn, chunksize=chunksize, usecols=[c for c in rename_map], dtype=source_dtypes, low_memory=False)
     
+    profile = data_quality.Profile()
+    chunk_results = []
     with Pool(num_processes) as pool:
-        chunk_results = pool.map(run_pipeline2, chunks)
+        for result in pool.imap(clean_profiled if quality else run_pipeline2, chunks):
+            if quality:
+                result, chunk_profile = result
+                merge_quality(profile, chunk_profile)
+            chunk_results.append(result)
+    if quality:
+        finish_quality(profile)
   
     data = pd.concat(chunk_results)
-    data = data.fillna('unknown')
+    data = fill_unknown(data)
+    make_parquet(data, update=parquet)
 
     return data
 
+def sample_rows(fn: str) -> tuple:
+    """## Estimates the row count of a csv from its first MB
+
+    Args:
+        fn (str): File path
+
+    Returns:
+        tuple: (header bytes, bytes per row, estimated rows)
+    """    
+    file_bytes = os.path.getsize(fn)
+    with open(fn, 'rb') as file_:
+        sample = file_.read(1 << 20)
+    header_end = sample.find(b'\n') + 1
+    num_rows = max(sample.count(b'\n', header_end), 1)
+    bytes_per_row = max((len(sample) - header_end) / num_rows, 1)
+    return header_end, bytes_per_row, int((file_bytes - header_end) / bytes_per_row)
+
+def split_byte_ranges(fn: str, num_ranges: int, block_size: int=1 << 24) -> list:
+    """## Splits a csv into byte ranges that start and end on record boundaries
+    Newlines inside quoted fields are skipped by tracking the quote parity, so the file is scanned
+    once (block by block) in the parent.
+
+    Args:
+        fn (str): File path
+        num_ranges (int): Number of (roughly equal) ranges
+        block_size (int, optional): Bytes read at a time. Defaults to 16 MB.
+
+    Returns:
+        list: (start, end) byte offsets, after the header line
+    """    
+    file_bytes = os.path.getsize(fn)
+    with open(fn, 'rb') as file_:
+        header_end = len(file_.readline())
+        targets = [header_end + (file_bytes - header_end) * k // num_ranges for k in range(1, num_ranges)]
+        bounds = [header_end]
+        pos, quotes, t = header_end, 0, 0
+        while t < len(targets):
+            block = file_.read(block_size)
+            if not block:
+                break
+            search_from = max(targets[t] - pos, 0)
+            while t < len(targets) and search_from < len(block):
+                nl = block.find(b'\n', search_from)
+                if nl == -1:
+                    break
+                search_from = nl + 1
+                if (quotes + block.count(b'"', 0, nl)) % 2 == 0:
+                    bounds.append(pos + nl + 1)
+                    t += 1
+                    if t < len(targets):
+                        search_from = max(targets[t] - pos, search_from)
+            quotes += block.count(b'"')
+            pos += len(block)
+    bounds.append(file_bytes)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+def _write_handoff(data: pd.DataFrame, out_path: str) -> str:
+    # Writes a cleaned chunk as an Arrow IPC file (pickle for frames Arrow can't type, e.g. columns mixing
+    # floats and strings), removing what was written if it fails. Returns the file's path
+    try:
+        table = pa.Table.from_pandas(data, preserve_index=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        table = None
+    out_path += '.arrow' if table is not None else '.pkl'
+    try:
+        if table is None:
+            data.to_pickle(out_path)
+        else:
+            with pa.OSFile(out_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+    except BaseException:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+    return out_path
+
+def _clean_byte_range(task: tuple) -> tuple:
+    # Worker side of exec_pool_arrow: parses and cleans its own slice of the csv, then hands it back as a file in
+    # the first of out_paths' directories with space for it
+    fn, start, end, out_paths, quality = task
+    with open(fn, 'rb') as file_:
+        header = file_.readline()
+        file_.seek(start)
+        body = file_.read(end - start)
+    df = pd.read_csv(io.BytesIO(header + body), usecols=[c for c in rename_map], dtype=source_dtypes, low_memory=False)
+    del body
+    raw_rows = df.shape[0]
+    profile = data_quality.Profile.of(df) if quality else None
+    data = run_pipeline2(df)
+    for i, out_path in enumerate(out_paths):
+        try:
+            return _write_handoff(data, out_path), raw_rows, profile
+        except OSError as e:
+            if e.errno != errno.ENOSPC or i == len(out_paths) - 1:
+                raise
+
+def _read_handoff(path: str) -> pd.DataFrame:
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+def handoff_dirs(need_bytes: int) -> list:
+    """## Directories for exec_pool_arrow's handoff files, in the order they're tried
+    POOL_HANDOFF_DIR when it has need_bytes free, then the system temp dir (shared memory is small in containers).
+
+    Args:
+        need_bytes (int): Estimated bytes of the handoff files held at once
+
+    Returns:
+        list: Directory paths
+    """    
+    temp_dir = tempfile.gettempdir()
+    if not POOL_HANDOFF_DIR or os.path.realpath(POOL_HANDOFF_DIR) == os.path.realpath(temp_dir):
+        return [temp_dir]
+    try:
+        if shutil.disk_usage(POOL_HANDOFF_DIR).free >= need_bytes:
+            return [POOL_HANDOFF_DIR, temp_dir]
+    except OSError:
+        pass
+    return [temp_dir]
+
+def exec_pool_arrow(fn: str=None, num_processes: int=5, chunksize: int=100000, quality: bool=False, max_pending: int=None) -> pd.DataFrame:
+    """## Executes the Data Cleaning pipeline using multiprocessing pools, without pickling chunks through the pool
+    Each worker is given a byte range of the raw file (see split_byte_ranges), parses and cleans it, and writes
+    the cleaned chunk as an Arrow IPC file in POOL_HANDOFF_DIR (shared memory where available). The parent
+    memory maps the files back in order, so only file names and offsets go through the pool's pipe.
+    At most max_pending ranges are handed out before their files are read back, so the files can't pile up,
+    and the files go to the system temp dir when POOL_HANDOFF_DIR is short of space (see handoff_dirs).
+
+    Args:
+        fn (str, optional): Filename. Defaults to None.
+        num_processes (int, optional): Number of processes. Defaults to 5.
+        chunksize (int, optional): Approximate rows per byte range. Defaults to 100000.
+        quality (bool, optional): Profile and check the raw data (see exec_pool). Defaults to False.
+        max_pending (int, optional): Max ranges handed out but not yet read back. Defaults to 2 * num_processes.
+
+    Returns:
+        pd.DataFrame: Cleaned dataframe (same as exec_pool)
+    """
+    fn = source_path(fn)
+    est_rows = sample_rows(fn)[2]
+    ranges = split_byte_ranges(fn, max(math.ceil(est_rows / chunksize), 1))
+    max_pending = max_pending or 2 * num_processes
+    slots = Semaphore(max_pending)
+    stop = Event()
+    # a cleaned Arrow chunk takes less than its csv bytes
+    need_bytes = sum(sorted((end - start for start, end in ranges), reverse=True)[:max_pending])
+    out_dirs = [tempfile.mkdtemp(prefix='gcdc_', dir=d) for d in handoff_dirs(need_bytes)]
+    try:
+        tasks = [(fn, start, end, [os.path.join(d, str(i)) for d in out_dirs], quality) for i, (start, end) in enumerate(ranges)]
+        profile = data_quality.Profile()
+        chunk_results = []
+        offset = 0  # each range is parsed from row 0, shift its index to the row's position in the file
+        with Pool(num_processes) as pool:
+            try:
+                for path, raw_rows, chunk_profile in pool.imap(_clean_byte_range, _bounded_chunks(tasks, slots, stop)):
+                    if quality:
+                        merge_quality(profile, chunk_profile)
+                    chunk = _read_handoff(path)
+                    chunk.index += offset
+                    offset += raw_rows
+                    chunk_results.append(chunk)
+                    os.remove(path)
+                    slots.release()
+            finally:
+                # Lets a blocked task feeder exit if a chunk failed
+                stop.set()
+                slots.release()
+    finally:
+        for out_dir in out_dirs:
+            shutil.rmtree(out_dir, ignore_errors=True)
+    if quality:
+        finish_quality(profile)
+    data = pd.concat(chunk_results)
+    data = fill_unknown(data)
+
+    return data
+
+def available_memory() -> int:
+    """## Available physical memory in bytes (None where sysconf doesn't report it)"""    
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def usable_cores() -> int:
+    """## Cores this process may run on (respects CPU affinity where supported)"""    
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def plan_pool(fn: str, cores: int=None, memory: int=None) -> dict:
+    """## Picks the cleaning mode, worker count and chunk size for a raw file
+    Files under POOL_MIN_BYTES are cleaned in-process. Otherwise one worker per spare core, about
+    4 chunks per worker, with the chunk size capped so the chunks in flight fit in half the available memory.
+
+    Args:
+        fn (str): Raw file path
+        cores (int, optional): Cores to plan for. Defaults to usable_cores().
+        memory (int, optional): Bytes of memory to plan for. Defaults to available_memory().
+
+    Returns:
+        dict: The plan (mode, num_processes, chunksize and the estimates behind them)
+    """    
+    file_bytes = os.path.getsize(fn)
+    bytes_per_row, est_rows = sample_rows(fn)[1:]
+    cores = cores or usable_cores()
+    memory = memory or available_memory()
+    plan = {'file': os.path.basename(fn), 'file_bytes': file_bytes, 'est_rows': est_rows,
+        'cores': cores, 'memory': memory}
+    if file_bytes < POOL_MIN_BYTES or cores == 1:
+        plan.update({'mode': 'in_process', 'num_processes': 1, 'chunksize': None, 'handoff': None})
+        return plan
+
+    min_rows, max_rows = POOL_CHUNK_ROWS
+    num_processes = max(cores - 1, 1)  # leaves a core for reading and concatenating
+    chunksize = min(max(math.ceil(est_rows / (num_processes * 4)), min_rows), max_rows)
+    if memory:
+        # each worker holds a chunk and the pool queues about as many cleaned results
+        max_chunk_rows = int(memory * 0.5 / (2 * num_processes * bytes_per_row * POOL_MEM_FACTOR))
+        chunksize = max(min(chunksize, max_chunk_rows), min(chunksize, 1000))
+    num_processes = min(num_processes, math.ceil(est_rows / chunksize))
+    plan.update({'mode': 'pool', 'num_processes': num_processes, 'chunksize': chunksize,
+        'handoff': POOL_HANDOFF if pa else 'pickle'})
+    return plan
+
+def append_run_log(record: dict):
+    """## Appends a record to the structured (json lines) run log"""    
+    with open(RUN_LOG_PATH, 'a') as log_file:
+        log_file.write(json.dumps(record) + '\n')
+
+def exec_auto(fn: str=None, parquet: bool=None) -> pd.DataFrame:
+    """## Executes the Data Cleaning pipeline with an auto-tuned plan (see plan_pool)
+    The plan and the throughput it achieved are printed and written to the run log.
+
+    Args:
+        fn (str, optional): Filename. Defaults to None.
+        parquet (bool, optional): Also write the cleaned data as the parquet dataset. Defaults to WRITE_PARQUET.
+
+    Returns:
+        pd.DataFrame: Cleaned dataframe
+    """    
+    fn = source_path(fn)
+    parquet = WRITE_PARQUET if parquet is None else parquet
+    plan = plan_pool(fn)
+    began = time()
+    if plan['mode'] == 'in_process':
+        data = exec_pipeline(fn, update=False)
+        make_parquet(data, update=parquet)
+    else:
+        data = exec_pool(fn, plan['num_processes'], plan['chunksize'], plan['handoff'], parquet=parquet)
+    secs = time() - began
+    plan.update({'task': 'exec_auto', 'rows': data.shape[0], 'secs': round(secs, 3),
+        'rows_per_sec': round(data.shape[0] / secs) if secs else None})
+    print(f"exec_auto: {plan['mode']} x{plan['num_processes']} (chunksize {plan['chunksize']}, handoff {plan['handoff']}), {plan['rows_per_sec']} rows/sec")
+    append_run_log(plan)
+    return data
+
+def _bounded_chunks(chunks, slots: Semaphore, stop: Event, row_filter=None):
+    # Blocks the pool's task feeder until a cleaned chunk has been taken back (handed to the sink or read from its file)
+    for chunk in chunks:
+        if row_filter:
+            chunk = row_filter(chunk)
+            if chunk.empty:
+                continue
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield chunk
+
+def exec_pool_stream(sink, fn: str=None, num_processes: int=5, chunksize: int=100000, max_pending: int=None, row_filter=None, quality: bool=None, parquet: bool=False) -> int:
+    """## Executes the Data Cleaning pipeline in streaming (bounded memory) mode
+    Cleaned chunks are passed to the sink in file order and released instead of concatenated,
+    so at most max_pending chunks are held in memory at once.
+
+    Args:
+        sink (function): Called with each cleaned chunk (see csv_sink, manage.db_sink).
+        fn (str, optional): Filename. Defaults to None.
+        num_processes (int, optional): Number of processes. Defaults to 5.
+        chunksize (int, optional): Rows per chunk. Defaults to 100000.
+        max_pending (int, optional): Max chunks read but not yet sunk. Defaults to 2 * num_processes.
+        row_filter (function, optional): Applied to each raw chunk before cleaning, returns the rows to keep. Defaults to None.
+        quality (bool, optional): Profile and check the raw chunks as they're cleaned (see exec_pool), the complete
+            profile is checked once every chunk has been sunk (so a sink that loads a DB should roll back if
+            this raises, see manage.run_streaming). Defaults to PROFILE_QUALITY.
+        parquet (bool, optional): Also write each cleaned chunk to the parquet dataset (see parquet_sink). Defaults to False.
+
+    Raises:
+        data_quality.DataQualityError: if the raw data breaks the quality thresholds.
+
+    Returns:
+        int: Number of cleaned rows passed to the sink
+    """
+    if parquet:
+        sink = tee_sinks(sink, parquet_sink())
+    fn = source_path(fn)
+    slots = Semaphore(max_pending or 2 * num_processes)
+    stop = Event()
+
+    chunks = pd.read_csv(fn, chunksize=chunksize, usecols=[c for c in rename_map], dtype=source_dtypes, low_memory=False)
+    quality = PROFILE_QUALITY if quality is None else quality
+    profile = data_quality.Profile()
+    num_rows = 0
+    with Pool(num_processes) as pool:
+        try:
+            for data in pool.imap(clean_profiled if quality else run_pipeline2, _bounded_chunks(chunks, slots, stop, row_filter)):
+                if quality:
+                    data, chunk_profile = data
+                    merge_quality(profile, chunk_profile)
+                data = fill_unknown(data)
+                sink(data)
+                num_rows += data.shape[0]
+                del data
+                slots.release()
+        finally:
+            # Lets a blocked task feeder exit if the sink raised
+            stop.set()
+            slots.release()
+    if quality:
+        finish_quality(profile)
+    return num_rows
+
 if __name__ == '__main__':
     # exec_pipeline(os.path.join(DATA_PATH, 'USAspending_award_summaries.csv'))
     freeze_support()
@@ -1,58 +1,147 @@
 # 
 
 from multiprocessing import freeze_support
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import json
+import os
+import tracemalloc
+import uuid
 import settings
 import build_db
+import stage_cache
+import name_index
+import data_quality
 import gov_contract_data_cleaner as gcdc
+import pandas as pd
 from pandas import DataFrame
+from datetime import datetime
 from time import time
 
 
+def run_task(f: object, args: list, cache: stage_cache.StageCache=None, cache_files: object=None, cache_modules: list=()) -> tuple:
+    """## Runs a task, reusing its cached output when the inputs are unchanged
+
+    Returns:
+        tuple: (output, whether it came from the cache or None if the task isn't cached)
+    """    
+    if not cache:
+        return f(*args), None
+    key = cache.key(f, tuple(args), cache_files(*args), cache_modules)
+    hit, output = cache.get(key)
+    if not hit:
+        output = f(*args)
+        cache.put(key, output)
+    return output, hit
+
 class Pipeline ():
-    """## Task Pipeline (linear)"""
-    def __init__(self):
+    """## Task Pipeline (DAG)
+    Tasks run as soon as all of their dependencies have finished, so independent tasks overlap.
+    """
+    def __init__(self, max_workers: int=4, log_path: str=None, cache: stage_cache.StageCache=None):
         self.tasks = []
+        self.deps = {}  ## task -> list of dependency tasks
+        self.keys = {}  ## task -> key its result is stored and passed under
+        self.executors = {}  ## task -> 'thread' or 'process'
+        self.caching = {}  ## task -> (cache_files, cache_modules) for cached tasks
+        self.max_workers = max_workers
+        self.log_path = log_path or settings.RUN_LOG_PATH
+        self.cache = cache
+        self.results = {}
         
-    def task(self, depends_on: object=None) -> object:
-        """## Adds tasks to the task list
+    def task(self, depends_on: object=None, key: str=None, executor: str='thread',
+             cache_files: object=None, cache_modules: list=()) -> object:
+        """## Adds tasks to the task graph
 
         Args:
-            depends_on (object, optional): Dependencies of the current process. Defaults to None.
+            depends_on (object, optional): Task or list of tasks whose results are passed to this task (in order). Defaults to None.
+            key (str, optional): Key the task's result is stored under in self.results. Defaults to the function name.
+            executor (str, optional): 'thread' or 'process' pool to run the task in. Defaults to 'thread'.
+            cache_files (function, optional): Caches the task's output. Called with the task's args, returns the input file paths to hash. Defaults to None.
+            cache_modules (list, optional): Modules whose source is part of a cached task's key. Defaults to ().
 
         Returns:
             object: Inner function.
         """        
-        idx = 0
-        if depends_on:
-            idx = self.tasks.index(depends_on) + 1
+        if depends_on is None:
+            depends_on = []
+        elif not isinstance(depends_on, (list, tuple)):
+            depends_on = [depends_on]
+        for d in depends_on:
+            if d not in self.tasks:
+                raise ValueError(f'{d.__name__} must be added to the pipeline before its dependents')
         def inner(f):
-            self.tasks.insert(idx, f)
+            self.tasks.append(f)
+            self.deps[f] = list(depends_on)
+            self.keys[f] = key or f.__name__
+            self.executors[f] = executor
+            if cache_files:
+                self.caching[f] = (cache_files, list(cache_modules))
             return f
         return inner
 
-    def run(self, x: DataFrame) -> DataFrame:
+    def log(self, record: dict):
+        """## Appends a record to the structured (json lines) run log"""        
+        with open(self.log_path, 'a') as log_file:
+            log_file.write(json.dumps(record) + '\n')
+
+    def run(self, x: object=None) -> object:
         """## Runs pipeline tasks
+        Tasks without dependencies get x, the rest get their dependencies' results.
 
         Args:
-            x (DataFrame): The dataframe arg passed between tasks
+            x (object): The arg passed to the root tasks
 
         Returns:
-            DataFrame: Processed dataframe
+            object: Result of the last task added
         """        
-        for i in self.tasks:
-            start = time()
-            x = i(x)
-            end = time()
-            print(f'{str(i.__name__)}: {end-start} secs')
-        return x
+        run_id = uuid.uuid4().hex
+        self.results = {}
+        pools = {}
+        pending = list(self.tasks)
+        running = {}
+        try:
+            while pending or running:
+                for f in [t for t in pending if all(self.keys[d] in self.results for d in self.deps[t])]:
+                    args = [self.results[self.keys[d]] for d in self.deps[f]] if self.deps[f] else [x]
+                    kind = self.executors[f]
+                    if kind not in pools:
+                        pools[kind] = (ProcessPoolExecutor if kind == 'process' else ThreadPoolExecutor)(self.max_workers)
+                    cache_files, cache_modules = self.caching.get(f, (None, ()))
+                    cache = self.cache if cache_files else None
+                    future = pools[kind].submit(run_task, f, args, cache, cache_files, cache_modules)
+                    running[future] = (f, time())
+                    pending.remove(f)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    f, start = running.pop(future)
+                    end = time()
+                    error = future.exception()
+                    self.log({'run_id': run_id, 'task': f.__name__, 'executor': self.executors[f],
+                        'depends_on': [d.__name__ for d in self.deps[f]],
+                        'start': datetime.fromtimestamp(start).isoformat(), 'secs': round(end-start, 3),
+                        'status': 'error' if error else 'ok',
+                        'cached': None if error else future.result()[1]})
+                    if error:
+                        raise error
+                    self.results[self.keys[f]] = future.result()[0]
+        finally:
+            for future in running:
+                future.cancel()
+            for p in pools.values():
+                p.shutdown(wait=True)
+        return self.results[self.keys[self.tasks[-1]]]
 
 start = time()
 # Initiates the pipeline
-pipeline = Pipeline()
+pipeline = Pipeline(cache=stage_cache.StageCache())
 
-@pipeline.task()
+def clean_inputs(fn: str=None) -> list:
+    """## Input files of first_task (hashed for its cache key)"""    
+    return [gcdc.source_path(fn)]
+
+@pipeline.task(key='data', cache_files=clean_inputs, cache_modules=[gcdc, data_quality])
 def first_task(fn: str=None) -> DataFrame:
-    """## Runs the multiprocessor transformer pipeline
+    """## Runs the multiprocessor transformer pipeline (auto-tuned, see gcdc.exec_auto)
 
     Args:
         fn (str, optional): Filename to clean. Defaults to None.
@@ -60,77 +149,252 @@ def first_task(fn: str=None) -> DataFrame:
     Returns:
         (DataFrame): Cleaned dataframe
     """
-    data = gcdc.exec_pool(fn)
+    data = gcdc.exec_auto(fn)
     return data
 
-@pipeline.task(depends_on=first_task)
-def second_task(data: DataFrame) -> DataFrame:
-    """## DB setup
+# Whether to clear and rebuild an existing DB. Asked with confirm_rebuild before the pipeline starts,
+# so no prompt runs in a task thread while first_task prints
+REBUILD_DB = False
+
+def confirm_rebuild() -> bool:
+    """## Asks whether to clear and rebuild the existing DB
+
+    Returns:
+        bool: Whether the rebuild was confirmed
+    """    
+    ask_rebuild = input('Rebuild database (clears all records) y/n? ')
+    if 'y' in ask_rebuild:
+        return 'y' in input('ARE YOU SURE YOU WANT TO CLEAR AND REBUILD DB? ')
+    return False
+
+@pipeline.task(key='db_built')
+def second_task(fn: str=None) -> bool:
+    """## DB setup (independent of the cleaning, runs alongside first_task)
+    Builds the DB if it doesn't exist, or rebuilds it if REBUILD_DB was confirmed.
 
     TODO: Transition DB to postgres instead of SQLite
 
     Args:
-        data (DataFrame): Dataframe to be passed to next task.
+        fn (str, optional): Filename being cleaned (unused). Defaults to None.
 
     Returns:
-        DataFrame: Passes dataframe to next task.
+        bool: Whether the DB was (re)built.
     """    
     # Check if database file exists
     need_to_create = settings.RUN_DB_SETUP
-    if need_to_create:
-        db = build_db.DB(True)
+    if need_to_create or REBUILD_DB:
+        db = build_db.connect(True)
         db.close_conn()
-    else:
-        ask_rebuild = input('Rebuild database (clears all records) y/n? ')
-        if 'y' in ask_rebuild:
-            if 'y' in input('ARE YOU SURE YOU WANT TO CLEAR AND REBUILD DB? '):
-                db = build_db.DB(True)
-                db.close_conn()
-    return data
+        return True
+    return False
 
-@pipeline.task(depends_on=second_task)
-def last_task(data: DataFrame) -> DataFrame:
+@pipeline.task(depends_on=[first_task, second_task])
+def last_task(data: DataFrame, db_built: bool=False) -> DataFrame:
     """## Updates the DB
 
     Args:
         data (DataFrame): Data to be inserted/updated
+        db_built (bool, optional): Result of second_task. Defaults to False.
 
     Returns:
-        DataFrame: [description]
+        DataFrame: The inserted data
     """    
-    sql_data = {}
-    db = build_db.DB(False, True)
+    db = build_db.connect(False, True)
     num_rows_to_insert = data.shape[0]
-    
+    names = load_names(db)
+    tracing = settings.PROFILE_MEMORY and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    start = time()
+    db.begin_bulk_load()
+    insert_data(db, data, names=names)
+    save_names(db, names)
+    db.refresh_rollups()
+    db.end_bulk_load()
+    end = time()
+    print_db_stats(db, num_rows_to_insert)
+    print('Rows inserted per sec:', round(num_rows_to_insert / (end-start)))
+    if tracing:
+        print('Peak insert memory (MB):', round(tracemalloc.get_traced_memory()[1] / 1e6, 1))
+        tracemalloc.stop()
+    db.close_conn()
+    return data
+
+def load_names(db: build_db.DB) -> name_index.NameIndex:
+    """## Loads the recipient name index (None when settings.CANONICALIZE_NAMES is off)"""    
+    if settings.CANONICALIZE_NAMES:
+        return name_index.NameIndex.load(db)
+
+def save_names(db: build_db.DB, names: name_index.NameIndex):
+    """## Saves any aliases the name index learned during the load"""    
+    if names is not None:
+        names.save(db)
+
+def insert_data(db: build_db.DB, data: DataFrame, upsert: bool=False, names: name_index.NameIndex=None):
+    """## Inserts the data into each table
+
+    Args:
+        db (build_db.DB): Open DB connection
+        data (DataFrame): Data to be inserted/updated
+        upsert (bool, optional): Update existing rows on their natural key instead of ignoring them. Defaults to False.
+        names (name_index.NameIndex, optional): Maps recipient names to canonical names before the insert. Defaults to None.
+    """    
+    sql_data = {}
+    # columns filled from other data columns (see build_db.SOURCE_COLS), with the canonical recipient names
+    derived = {col: data[source] for col, source in build_db.SOURCE_COLS.items()}
+    if names is not None:
+        derived['recipient_name'] = names.resolve(data['recipient_name'], data['recipient_duns'])
     # Insertion loops
-    # TODO: Update below for use with postgreSQL
     # Sorts table columns alphabetically to lineup with insertion order
     for k in db.all_tbl_cols:
         db.all_tbl_cols[k] = sorted(db.all_tbl_cols[k])
     # Extracts data to be inserted
-    for table, cols in db.all_tbl_cols.items():
-        sql_data[table] = tuple(list(data[cols].to_records(index=False)))
-    # Inserts data for each table
-    for table, values in sql_data.items():
-        val_ = ('?,'*len(values[0])).rstrip(',')
-        col_names = (','.join(db.all_tbl_cols[table]).rstrip(','))
-        query = f'''INSERT OR IGNORE INTO {table} ({col_names}) VALUES ({val_})'''
-        db.exmany_sql(query, values)
+    for table in build_db.STAR_TABLES:
+        cols = db.all_tbl_cols[table]
+        table_data = pd.DataFrame({c: derived[c] if c in derived else data[c] for c in cols})
+        for col in cols:
+            # dates stay typed through the cleaner, store them as text (NULL for NaT)
+            if pd.api.types.is_datetime64_any_dtype(table_data[col]):
+                table_data = table_data.assign(**{col: table_data[col].dt.strftime('%Y-%m-%d %H:%M:%S').astype(object).where(table_data[col].notna(), None)})
+        sql_data[table] = table_data
+    # Inserts data for each table (see build_db.DB.insert_frame for each engine)
+    for table, table_data in sql_data.items():
+        db.insert_frame(table, table_data, upsert)
+
+def print_db_stats(db: build_db.DB, num_rows_to_insert: int):
+    """## Prints DB statistics after an insert
 
+    Args:
+        db (build_db.DB): Open DB connection
+        num_rows_to_insert (int): Number of rows in the dataset
+    """    
     number_action_rows = db.ex_sql('SELECT COUNT(*) FROM actions')
-    # Prints DB statistics
     print('\n', '-'*30)
     print('Total DB rows modified:', db.count_changes())
     print('Rows in actions table:', number_action_rows[0][0])
     print('Number of rows in dataset:', num_rows_to_insert)    
+
+def db_sink(db: build_db.DB, upsert: bool=False, names: name_index.NameIndex=None):
+    """## Creates a sink that inserts each cleaned chunk straight into the DB
+
+    Args:
+        db (build_db.DB): Open DB connection
+        upsert (bool, optional): Update existing rows instead of ignoring them. Defaults to False.
+        names (name_index.NameIndex, optional): Name index shared by every chunk (see insert_data). Defaults to None.
+
+    Returns:
+        function: Sink to pass to gcdc.exec_pool_stream, with a .fiscal_years set of the years it touched (for db.refresh_rollups)
+    """    
+    def sink(data: DataFrame):
+        if upsert:
+            # an upserted action may move out of its stored fiscal year
+            sink.fiscal_years.update(db.fiscal_years_of(data['action_key'].dropna().tolist()))
+        sink.fiscal_years.update(data['action_date_fiscal_year'].dropna().unique().tolist())
+        insert_data(db, data, upsert, names)
+    sink.fiscal_years = set()
+    return sink
+
+def run_streaming(fn: str=None) -> int:
+    """## Runs the pipeline in streaming (bounded memory) mode
+    Chunks are cleaned in parallel and inserted as they finish instead of building the full dataframe.
+
+    Args:
+        fn (str, optional): Filename to clean. Defaults to None.
+
+    Returns:
+        int: Number of rows in the dataset
+    """    
+    second_task(None)
+    db = build_db.connect(False, True)
+    names = load_names(db)
+    db.begin_bulk_load()
+    try:
+        # the complete data quality check runs after the last chunk, a failing file is rolled back
+        num_rows_to_insert = gcdc.exec_pool_stream(db_sink(db, names=names), fn, parquet=settings.WRITE_PARQUET)
+    except BaseException:
+        db.abort_bulk_load()
+        db.close_conn()
+        raise
+    save_names(db, names)
+    db.refresh_rollups()
+    db.end_bulk_load()
+    print_db_stats(db, num_rows_to_insert)
     db.close_conn()
-    return data
+    return num_rows_to_insert
+
+def newer_than(watermark: tuple=None):
+    """## Creates a raw chunk filter that keeps only new or changed actions
+    Tracks the highest last_modified_date and action_date it has kept.
+
+    Args:
+        watermark (tuple, optional): (last_modified_date, action_date) high-water marks, a missing (None) mark
+            isn't filtered on. Defaults to None (keep all rows).
+
+    Returns:
+        function: Row filter to pass to gcdc.exec_pool_stream, with a .marks list of the new high-water marks
+    """    
+    marks = [pd.Timestamp(m) if m else pd.NaT for m in (watermark or (None, None))]
+    start_marks = list(marks)
+
+    def row_filter(chunk: DataFrame) -> DataFrame:
+        last_modified = pd.to_datetime(chunk['last_modified_date'], errors='coerce')
+        action_date = pd.to_datetime(chunk['action_date'], errors='coerce')
+        keep = pd.Series(True, index=chunk.index)
+        newer = [col > mark for col, mark in zip([last_modified, action_date], start_marks) if pd.notna(mark)]
+        if newer:
+            keep = newer[0] if len(newer) == 1 else newer[0] | newer[1]
+        for i, col in enumerate([last_modified[keep], action_date[keep]]):
+            col_max = col.max()
+            if pd.notna(col_max) and (pd.isna(row_filter.marks[i]) or col_max > row_filter.marks[i]):
+                row_filter.marks[i] = col_max
+        return chunk[keep]
+    row_filter.marks = marks
+    return row_filter
+
+def run_incremental(fn: str=None) -> int:
+    """## Cleans and upserts only the actions added or modified since the file's last load
+    High-water marks on last_modified_date and action_date are kept per file in load_watermarks,
+    and each run is recorded in load_runs. Only the rollups of the fiscal years it touched are rebuilt.
+
+    Args:
+        fn (str, optional): Filename to clean. Defaults to None.
+
+    Returns:
+        int: Number of rows upserted
+    """    
+    if settings.RUN_DB_SETUP:
+        build_db.connect(True).close_conn()
+    file_name = os.path.basename(gcdc.source_path(fn))
+    started = datetime.now().isoformat(sep=' ', timespec='seconds')
+    db = build_db.connect(False, True)
+    row_filter = newer_than(db.get_watermark(file_name))
+    names = load_names(db)
+    sink = db_sink(db, upsert=True, names=names)
+    # one transaction, so rows that fail the data quality check (run after the last chunk) are rolled back
+    with db.transaction():
+        # only the new rows are cleaned, so the parquet dataset (a full snapshot) isn't rewritten here
+        num_rows = gcdc.exec_pool_stream(sink, fn, row_filter=row_filter)
+        save_names(db, names)
+        db.refresh_rollups(sink.fiscal_years)
+    marks = [str(m) if pd.notna(m) else None for m in row_filter.marks]
+    finished = datetime.now().isoformat(sep=' ', timespec='seconds')
+    db.record_run(file_name, 'incremental', started, finished, num_rows, *marks)
+    print_db_stats(db, num_rows)
+    db.close_conn()
+    return num_rows
 
 if __name__ == '__main__':
     # For multiprocessing Pool execution
     freeze_support()
     # Executes the pipeline tasks in correct order
-    pipeline.run(None)
+    if settings.INCREMENTAL_MODE:
+        run_incremental()
+    else:
+        REBUILD_DB = not settings.RUN_DB_SETUP and confirm_rebuild()
+        if settings.STREAM_MODE:
+            run_streaming()
+        else:
+            pipeline.run(None)
 
     end = time()
     print('-'*30)
@@ -0,0 +1,155 @@
+
+import re
+from collections import Counter
+import numpy as np
+import pandas as pd
+import settings
+
+
+# Legal suffix spellings -> one form, and the tokens ignored when comparing names
+SUFFIXES = {
+    'INCORPORATED': 'INC',
+    'CORPORATION': 'CORP',
+    'COMPANY': 'CO',
+    'LIMITED': 'LTD',
+    'L L C': 'LLC',
+    'LIMITED LIABILITY COMPANY': 'LLC',
+    'LIMITED LIABILITY CO': 'LLC'}
+IGNORED_TOKENS = {'THE', 'INC', 'CORP', 'CO', 'LTD', 'LLC', 'LP', 'LLP', 'PC', 'PLLC'}
+# Names that aren't companies and never get merged
+PLACEHOLDERS = {'missing', 'unknown'}
+
+_punctuation = re.compile(r'[^\w\s&]')
+_whitespace = re.compile(r'\s+')
+_suffixes = re.compile(r'\b(' + '|'.join(sorted(SUFFIXES, key=len, reverse=True)) + r')\b')
+
+
+def normalize_name(name: str) -> str:
+    '''Uppercases a name, strips punctuation and spaces and shortens legal suffixes'''
+    name = _punctuation.sub(' ', str(name).upper())
+    name = _whitespace.sub(' ', name).strip()
+    return _suffixes.sub(lambda m: SUFFIXES[m.group(1)], name)
+
+def name_key(name: str) -> str:
+    '''The normalized name without legal suffixes (variants sharing a key are the same company)'''
+    tokens = [t for t in normalize_name(name).split(' ') if t not in IGNORED_TOKENS]
+    return ' '.join(tokens)
+
+def trigrams(key: str) -> set:
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def similarity(a: set, b: set) -> float:
+    '''Jaccard similarity of two trigram sets'''
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def duns_keys(duns: pd.Series) -> pd.Series:
+    '''DUNS numbers as the strings names are matched and stored under ('' where missing)'''
+    if pd.api.types.is_float_dtype(duns):
+        duns = duns.astype('Int64')
+    duns = duns.astype(object).where(duns.notna(), '').astype(str)
+    return duns.where(~duns.isin(PLACEHOLDERS), '')
+
+
+class NameIndex:
+    '''
+    Canonical recipient name index.
+    Maps each name variant (alias) of a DUNS number to one canonical name. Unknown names are resolved once per
+    unique (name, DUNS) pair: first by their name_key, then by approximate (trigram) matching, else they become
+    a new canonical name. Names only merge into canonical names with the same DUNS, so distinct legal entities
+    (e.g. a subsidiary with its own DUNS) are never merged, and names without a DUNS only merge on their key.
+    Approximate matches are looked up in an inverted index of (DUNS, trigram) postings, so a name is only scored
+    against the canonical names that share its DUNS and at least one trigram. The aliases are kept in the
+    recipient_aliases table so later loads only do one dictionary lookup per unique pair.
+    '''
+    def __init__(self, aliases=None, threshold=None):
+        '''
+        args:
+            aliases: (dict) (alias, DUNS) -> canonical name
+            threshold: (float) min trigram similarity for an approximate match. Defaults to settings.NAME_MATCH_THRESHOLD
+        '''
+        self.threshold = threshold or settings.NAME_MATCH_THRESHOLD
+        self.aliases = {}
+        self.new_aliases = {}  # (alias, DUNS) -> (canonical, score) not yet saved
+        self.keys = {}  # (DUNS, name_key) -> canonical
+        self.canonicals = []  # (canonical, trigrams) by id
+        self.postings = {}  # (DUNS, trigram) -> [canonical ids]
+        for (alias, duns), canonical in (aliases or {}).items():
+            self.aliases[(alias, duns)] = canonical
+            self.add_canonical(canonical, duns)
+
+    @classmethod
+    def load(cls, db, **kwargs):
+        '''Builds the index from the DB's recipient_aliases table'''
+        return cls({(alias, duns): canonical for alias, duns, canonical in db.get_aliases()}, **kwargs)
+
+    def save(self, db):
+        '''Writes the aliases added since load to the DB'''
+        if self.new_aliases:
+            db.save_aliases([(a, d, c, s) for (a, d), (c, s) in self.new_aliases.items()])
+            self.new_aliases = {}
+
+    def add_canonical(self, canonical, duns):
+        key = name_key(canonical)
+        if (duns, key) in self.keys:
+            return
+        self.keys[(duns, key)] = canonical
+        if duns:
+            grams = trigrams(key)
+            for gram in grams:
+                self.postings.setdefault((duns, gram), []).append(len(self.canonicals))
+            self.canonicals.append((canonical, grams))
+
+    def match(self, name, duns=''):
+        '''Finds the canonical name for a (name, DUNS) pair not in the index
+            returns (tuple) of (canonical, score), score is 1 for a key match and None for a new canonical name
+        '''
+        key = name_key(name)
+        if (duns, key) in self.keys:
+            return self.keys[(duns, key)], 1.0
+        best, best_score = None, self.threshold
+        if duns:
+            grams = trigrams(key)
+            shared = Counter(i for gram in grams for i in self.postings.get((duns, gram), ()))
+            for i, common in shared.items():
+                canonical, candidate_grams = self.canonicals[i]
+                score = common / (len(grams) + len(candidate_grams) - common)  # Jaccard similarity
+                if score >= best_score:
+                    best, best_score = canonical, score
+        if best is None:
+            self.add_canonical(name, duns)
+            return name, None
+        return best, round(best_score, 4)
+
+    def resolve(self, names: pd.Series, duns: pd.Series=None) -> pd.Series:
+        '''Maps names to their canonical names
+            args:
+                names: (pd.Series) recipient names
+                duns: (pd.Series) recipient DUNS numbers, aligned with names. Defaults to None (no DUNS, key matches only)
+            returns (pd.Series) canonical names
+        '''
+        name_codes, name_uniques = pd.factorize(names)
+        duns_codes, duns_uniques = pd.factorize(duns_keys(duns) if duns is not None else pd.Series('', index=names.index))
+        width = max(len(duns_uniques), 1)
+        # One code per (name, DUNS) pair, -1 for null names
+        codes, pairs = pd.factorize(np.where(name_codes >= 0, name_codes.astype(np.int64) * width + duns_codes, -1))
+        # Most common variants first, so they become the canonical spelling
+        counts = np.bincount(codes, minlength=len(pairs))
+        resolved = np.empty(len(pairs), dtype=object)
+        for i in np.argsort(-counts, kind='stable'):
+            if pairs[i] < 0:
+                continue  # null name -> None
+            name, duns_key = name_uniques[pairs[i] // width], duns_uniques[pairs[i] % width]
+            if (name, duns_key) in self.aliases:
+                resolved[i] = self.aliases[(name, duns_key)]
+                continue
+            if name in PLACEHOLDERS:
+                resolved[i] = name
+                continue
+            canonical, score = self.match(name, duns_key)
+            self.aliases[(name, duns_key)] = canonical
+            self.new_aliases[(name, duns_key)] = (canonical, score)
+            resolved[i] = canonical
+        return pd.Series(resolved[codes], index=names.index, name=names.name, dtype=object)
@@ -0,0 +1,123 @@
+
+import heapq
+import settings
+
+
+# Rolling dollars and awards per recipient, NAICS code and fiscal year (over the RANK_ROLLING_YEARS fiscal years
+# ending with it, so recipients without actions in a year still carry their earlier ones), each recipient's share
+# of its NAICS code's rolling totals and the weighted score. Built on the rollup_recipients table
+# (see build_db.ROLLUPS), {where} filters the yearly rows and {scored} the fiscal years scored
+SCORES_SQL = '''WITH yearly AS (
+        SELECT recipient_name, naics_code, fiscal_year,
+            SUM(dollars_obligated) AS dollars, SUM(award_count) AS awards
+        FROM rollup_recipients
+        {where}
+        GROUP BY recipient_name, naics_code, fiscal_year),
+    years AS (
+        SELECT DISTINCT fiscal_year FROM rollup_recipients {scored}),
+    rolling AS (
+        SELECT y.recipient_name, y.naics_code, s.fiscal_year,
+            SUM(y.dollars) AS rolling_dollars, SUM(y.awards) AS rolling_awards
+        FROM yearly y JOIN years s ON s.fiscal_year BETWEEN y.fiscal_year AND y.fiscal_year + {preceding}
+        GROUP BY y.recipient_name, y.naics_code, s.fiscal_year),
+    shares AS (
+        SELECT recipient_name, naics_code, fiscal_year, rolling_dollars, rolling_awards,
+            rolling_dollars / NULLIF(SUM(rolling_dollars) OVER g, 0) AS dollar_share,
+            CAST(rolling_awards AS DOUBLE) / NULLIF(SUM(rolling_awards) OVER g, 0) AS award_share
+        FROM rolling
+        WINDOW g AS (PARTITION BY naics_code, fiscal_year))
+    SELECT recipient_name, naics_code, fiscal_year, rolling_dollars, rolling_awards,
+        ? * COALESCE(dollar_share, 0) + ? * COALESCE(award_share, 0) AS score
+    FROM shares'''
+SCORE_COLS = ['recipient_name', 'naics_code', 'fiscal_year', 'rolling_dollars', 'rolling_awards', 'score']
+
+
+def scores_query(naics_codes=None, fiscal_years=None, rolling_years=None):
+    '''Builds SCORES_SQL for the given filters
+        args:
+            naics_codes: (list) NAICS codes to score, None -> all
+            fiscal_years: (list) fiscal years to score, None -> all (earlier years are still read for the window)
+            rolling_years: (int) fiscal years in the window. Defaults to settings.RANK_ROLLING_YEARS
+        returns (tuple) of (sql, params)
+    '''
+    preceding = int(rolling_years or settings.RANK_ROLLING_YEARS) - 1
+    where, scored, params = [], [], []
+    if naics_codes is not None:
+        where.append(f"naics_code IN ({', '.join('?' * len(naics_codes))})")
+        params += [int(c) for c in naics_codes]
+    if fiscal_years is not None:
+        fiscal_years = [int(y) for y in fiscal_years]
+        where.append('fiscal_year BETWEEN ? AND ?')
+        params += [min(fiscal_years) - preceding, max(fiscal_years)]
+        scored.append(f"fiscal_year IN ({', '.join('?' * len(fiscal_years))})")
+        params += fiscal_years
+    sql = SCORES_SQL.format(
+        where='WHERE ' + ' AND '.join(where) if where else '',
+        scored='WHERE ' + ' AND '.join(scored) if scored else '',
+        preceding=preceding)
+    weights = settings.RANK_WEIGHTS
+    return sql, params + [weights['dollars'], weights['awards']]
+
+def iter_scores(db, naics_codes=None, fiscal_years=None, rolling_years=None, batch_size=10000):
+    '''Streams the score rows (SCORE_COLS tuples) from a build_db DB or DuckDB without fetching them all'''
+    sql, params = scores_query(naics_codes, fiscal_years, rolling_years)
+    rows = db.cur.execute(sql, params)
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+        yield from batch
+
+def top_k(rows, k, key):
+    '''The k largest rows by key, largest first (heap based, O(n log k) and k rows of memory)'''
+    return heapq.nlargest(k, rows, key=key)
+
+def top_k_by_group(rows, k, group, key):
+    '''The k largest rows of each group, in one pass over rows
+        args:
+            rows: (iterable) rows
+            k: (int) rows kept per group
+            group: (function) row -> group key
+            key: (function) row -> sort key
+        returns (dict) of group -> rows, largest first
+    '''
+    heaps = {}
+    for i, row in enumerate(rows):
+        heap = heaps.setdefault(group(row), [])
+        item = (key(row), -i, row)  # earlier rows win ties, rows themselves are never compared
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return {g: [row for _, _, row in sorted(heap, reverse=True)] for g, heap in heaps.items()}
+
+def rank_competitors(db, naics_codes=None, fiscal_years=None, k=None, by='score'):
+    '''
+    Top k recipients per (naics_code, fiscal_year).
+        args:
+            db: (DB/DuckDB) database with refreshed rollups
+            naics_codes, fiscal_years: (list) filters, None -> all
+            k: (int) recipients per NAICS code and fiscal year. Defaults to settings.RANK_TOP_K
+            by: (str) 'score', 'rolling_dollars' or 'rolling_awards'
+        returns (dict) of (naics_code, fiscal_year) -> [dict of SCORE_COLS], best first
+    '''
+    col = SCORE_COLS.index(by)
+    ranked = top_k_by_group(iter_scores(db, naics_codes, fiscal_years), k or settings.RANK_TOP_K,
+        group=lambda row: (row[1], row[2]), key=lambda row: row[col])
+    return {g: [dict(zip(SCORE_COLS, row)) for row in rows] for g, rows in ranked.items()}
+
+def competitors(db, naics_code, fiscal_year, k=None, by='score'):
+    '''Top k recipients of one NAICS code and fiscal year, with their businesses row (city, zip, duns)
+        returns (list) of dicts, best first
+    '''
+    col = SCORE_COLS.index(by)
+    ranked = [dict(zip(SCORE_COLS, row)) for row in top_k(iter_scores(db, [naics_code], [fiscal_year]),
+        k or settings.RANK_TOP_K, key=lambda row: row[col])]
+    if ranked:
+        names = [r['recipient_name'] for r in ranked]
+        info = db.ex_sql(f'''SELECT recipient_name, recipient_city, recipient_zip_code_5, recipient_duns FROM businesses
+            WHERE recipient_name IN ({', '.join('?' * len(names))})''', names)
+        info = {row[0]: row[1:] for row in info}
+        for r in ranked:
+            r['recipient_city'], r['recipient_zip_code_5'], r['recipient_duns'] = info.get(r['recipient_name'], (None,) * 3)
+    return ranked
@@ -11,11 +11,78 @@ DB_PATH = os.path.join(DATA_PATH, 'gov_contracts.db')
 
 DEF_CLEAN_PATH = os.path.join(DATA_PATH, 'cleaned_data.csv')
 
-RUN_DB_SETUP = not os.path.isfile(DB_PATH)
+RUN_LOG_PATH = os.path.join(DATA_PATH, 'run_log.jsonl')  # per-task timings from manage.Pipeline
+
+BENCH_DIR = os.path.join(DATA_PATH, 'benchmarks')  # benchmarks.py results (json)
+
+CACHE_DIR = os.path.join(DATA_PATH, 'stage_cache')  # cached pipeline stage outputs (see stage_cache.py)
+
+CACHE_MAX_BYTES = 2 * 1024**3  # least recently used outputs are evicted above this size
+
+DEF_PARQUET_PATH = os.path.join(DATA_PATH, 'cleaned_data.parquet')  # directory, partitioned by PARTITION_COL
+
+# Database engine for build_db.connect: 'sqlite' (DB_PATH) or 'duckdb' (DUCKDB_PATH, requires duckdb)
+DB_ENGINE = 'sqlite'
+
+DUCKDB_PATH = os.path.join(DATA_PATH, 'gov_contracts.duckdb')
+
+RUN_DB_SETUP = not os.path.isfile(DUCKDB_PATH if DB_ENGINE == 'duckdb' else DB_PATH)
 
 DOES_CLEAN_EXIST = os.path.isfile(DEF_CLEAN_PATH)
+
+# exec_auto tuning: files under POOL_MIN_BYTES are cleaned in-process, chunks are kept between
+# POOL_CHUNK_ROWS rows, and a chunk is assumed to take POOL_MEM_FACTOR times its csv size in memory
+POOL_MIN_BYTES = 20 * 1024**2
+POOL_CHUNK_ROWS = (25000, 500000)
+POOL_MEM_FACTOR = 5
+# How exec_auto's workers get chunks and return results: 'pickle' (through the pool) or 'arrow' (workers read
+# their own byte range and hand back Arrow files in POOL_HANDOFF_DIR, see gcdc.exec_pool_arrow)
+POOL_HANDOFF = 'arrow'
+POOL_HANDOFF_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None  # None -> system temp dir
+
+# Also write the cleaned data as a partitioned parquet dataset (requires pyarrow)
+WRITE_PARQUET = True
+
+# Map recipient name variants to one canonical name on load (see name_index.py, the name as reported is kept in
+# actions.raw_recipient_name). Only names with the same DUNS number are merged, on their name key or at
+# NAME_MATCH_THRESHOLD trigram similarity or above. Off by default, similar names can still be different companies
+CANONICALIZE_NAMES = False
+NAME_MATCH_THRESHOLD = 0.8
+
+# Rows converted to Python scalars at a time by build_db.iter_rows (sqlite inserts)
+INSERT_BATCH_ROWS = 50000
+
+# Report the tracemalloc peak of each cleaning stage from exec_pipeline, and of the insert in
+# manage.last_task (slows both down)
+PROFILE_MEMORY = False
+
+# Opt in to profiling the raw data while it's cleaned (see data_quality.py) and writing the report to
+# QUALITY_REPORT_PATH. Cleaning then stops with a DataQualityError once QUALITY_MIN_ROWS rows have been profiled
+# and a column's null rate is above its QUALITY_MAX_NULL_RATES entry, or its format violations are above
+# QUALITY_MAX_VIOLATION_RATE (streamed loads are rolled back, see manage.run_streaming)
+PROFILE_QUALITY = False
+QUALITY_REPORT_PATH = os.path.join(DATA_PATH, 'quality_report.json')
+QUALITY_MIN_ROWS = 10000
+QUALITY_MAX_NULL_RATES = {
+    'action_date': 0.01,
+    'federal_action_obligation': 0.01,
+    'recipient_name': 0.05}
+QUALITY_MAX_VIOLATION_RATE = 0.01
+
+# Competitor rankings (see rankings.py): recipients are scored on their dollars and awards over the last
+# RANK_ROLLING_YEARS fiscal years, as weighted shares of their NAICS code's totals, and the top RANK_TOP_K kept
+RANK_ROLLING_YEARS = 3
+RANK_WEIGHTS = {'dollars': 0.7, 'awards': 0.3}
+RANK_TOP_K = 10
+
+# Clean and load chunk by chunk (bounded memory) instead of building the full dataframe
+STREAM_MODE = False
+
+# Only clean and upsert actions newer than the last load of the file (see manage.run_incremental)
+INCREMENTAL_MODE = False
 # Data column names and name changes
 rename_map = {
+    'contract_transaction_unique_key': 'action_key', ## -> natural key of each action (incremental upserts)
     'period_of_performance_start_date': 'pop_start_date',
     'recipient_duns': 'recipient_duns',
     'primary_place_of_performance_zip_4': 'plop_zip',
@@ -55,6 +122,55 @@ rename_map = {
     'awarding_agency_name': 'awarding_agency_name',
     'naics_code': 'naics_code'}
 
+# Source column schema for read_csv, keyed by rename_map's source names
+# (columns not listed in source_dtypes are left to pandas to infer, so cleaned values match the untyped read
+# apart from the place of performance zip, which keeps its leading zeros)
+_source_categories = [
+    'award_or_idv_flag', 'award_type', 'award_type_code', 'awarding_agency_name', 'awarding_office_code',
+    'awarding_office_name', 'awarding_sub_agency_code', 'awarding_sub_agency_name', 'city_local_government',
+    'naics_code', 'parent_award_agency_id', 'parent_award_agency_name', 'recipient_city_name',
+    'primary_place_of_performance_city_name', 'primary_place_of_performance_country_code',
+    'primary_place_of_performance_country_name', 'primary_place_of_performance_county_name',
+    'primary_place_of_performance_state_code', 'primary_place_of_performance_state_name']
+_source_numbers = {'action_date_fiscal_year': 'Int32', 'number_of_actions': 'float32', 'recipient_zip_4_code': 'float64'}
+# Read as strings so every chunk gets the same dtype (inference differs between chunks for zips with leading zeros)
+_source_strings = ['primary_place_of_performance_zip_4']
+# USAspending date formats (dates are read as strings, the cleaner fixes and parses them)
+date_formats = {
+    'action_date': '%Y-%m-%d',
+    'last_modified_date': '%Y-%m-%d %H:%M:%S',
+    'period_of_performance_start_date': '%Y-%m-%d',
+    'period_of_performance_current_end_date': '%Y-%m-%d',
+    'period_of_performance_potential_end_date': '%Y-%m-%d'}
+source_dtypes = {}
+for _col in rename_map:
+    if _col in _source_categories:
+        source_dtypes[_col] = 'category'
+    elif _col in _source_numbers:
+        source_dtypes[_col] = _source_numbers[_col]
+    elif _col in date_formats or _col in _source_strings:
+        source_dtypes[_col] = 'object'
+
+# Columnar (parquet) output dtypes, by cleaned column name
+PARTITION_COL = 'action_date_fiscal_year'
+MISSING_PARTITION = 0  # partition of the rows without a fiscal year (a null partition can't be read back)
+# Position of each row in the cleaned data, stored in the parquet dataset so a loader can keep the first row of
+# a repeated key like the sqlite insert does (the partition files don't keep the rows in order)
+ORDER_COL = 'source_row'
+categorical_cols = [
+    'awarding_agency_name',
+    'awarding_sub_agency_name',
+    'awarding_office_name',
+    'parent_award_agency_name',
+    'naics_code',
+    'plop_state',
+    'plop_state_code',
+    'plop_country_code',
+    'plop_country_name',
+    'award_type',
+    'award_type_code']
+numeric_cols = ['dollars_obligated', 'number_of_actions', 'plop_congressional_district']
+
 top = '-'*41
 opener = f'''{top}
 | Government Contract Database Pipeline |
@@ -0,0 +1,91 @@
+
+import hashlib
+import inspect
+import os
+import pickle
+import settings
+
+
+# Settings that change what the cleaner reads, outputs or rejects, their current values are part of every key
+KEY_SETTINGS = ['rename_map', 'source_dtypes', 'date_formats', 'PROFILE_QUALITY', 'QUALITY_MIN_ROWS',
+    'QUALITY_MAX_NULL_RATES', 'QUALITY_MAX_VIOLATION_RATE']
+
+
+class StageCache:
+    '''
+    On-disk cache of pipeline stage outputs.
+    Outputs are keyed by a hash of the stage's input file bytes, its source code (and the source of any
+    modules it relies on), its args and the KEY_SETTINGS values. Least recently used outputs are evicted
+    once the cache grows past max_bytes.
+    '''
+    def __init__(self, cache_dir=None, max_bytes=None):
+        '''
+        args:
+            cache_dir: (str) directory for cached outputs. Defaults to settings.CACHE_DIR
+            max_bytes: (int) max total size of cached outputs. Defaults to settings.CACHE_MAX_BYTES
+        '''
+        self.cache_dir = cache_dir or settings.CACHE_DIR
+        self.max_bytes = max_bytes or settings.CACHE_MAX_BYTES
+
+    def key(self, f, args=(), files=(), modules=()):
+        '''Builds the cache key for a stage
+            args:
+                f: (function) the stage
+                args: (tuple) args the stage is called with
+                files: (list) input file paths, hashed by content
+                modules: (list) modules whose source changes should invalidate the output
+            returns (str) hex digest
+        '''
+        h = hashlib.sha256()
+        h.update(inspect.getsource(f).encode())
+        for m in modules:
+            h.update(inspect.getsource(m).encode())
+        for name in KEY_SETTINGS:
+            value = getattr(settings, name)
+            h.update(repr(sorted(value.items()) if isinstance(value, dict) else value).encode())
+        h.update(repr(args).encode())
+        for fname in files:
+            with open(fname, 'rb') as file_:
+                for block in iter(lambda: file_.read(1 << 20), b''):
+                    h.update(block)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pkl')
+
+    def get(self, key):
+        '''returns (tuple) of (hit, output)'''
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return False, None
+        os.utime(path)  # marks as recently used
+        with open(path, 'rb') as file_:
+            return True, pickle.load(file_)
+
+    def put(self, key, output):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as file_:
+            pickle.dump(output, file_, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        '''Removes least recently used outputs until the cache fits in max_bytes'''
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.cache_dir, fname))
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(e[1] for e in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, fname))
+            total -= size
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for fname in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, fname))
@@ -0,0 +1,26 @@
+
+import json
+
+import settings
+import benchmarks
+import gov_contract_data_cleaner as gcdc
+
+
+def test_synthetic_data_is_usaspending_shaped():
+    raw = benchmarks.make_raw_data(5000)
+    assert list(raw.columns) == [c for c in settings.rename_map]
+    assert raw['contract_transaction_unique_key'].is_unique
+    assert raw['period_of_performance_start_date'].str.startswith('00').any()
+    cleaned = gcdc.run_pipeline2(raw)
+    assert str(cleaned['pop_start_date'].dtype) == 'datetime64[ns]'
+    assert cleaned['pop_start_date'].dt.year.min() >= 2000
+
+def test_run_benchmarks_writes_json(tmp_path):
+    out = str(tmp_path / 'bench.json')
+    benchmarks.run_benchmarks([2000], [1], out, date_rows=1000)
+    results = json.load(open(out))
+    size = results['sizes']['2000']
+    assert set(size) == {'file_mb', 'cleaner', 'cleaner_memory', 'exec_pool', 'sqlite_load', 'engines'}
+    assert set(size['engines']['sqlite']) == {'load_secs'} | set(benchmarks.BI_QUERIES)
+    assert size['sqlite_load']['rows_per_sec'] > 0
+    assert 'run_pipeline2' in size['cleaner']
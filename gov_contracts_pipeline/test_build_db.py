@@ -0,0 +1,106 @@
+
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import settings
+import build_db
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    db = build_db.DB(True)
+    db.exmany_sql('INSERT INTO businesses (recipient_name, recipient_city) VALUES (?,?)',
+        [(f'CO {i}', 'RESTON') for i in range(50)])
+    yield db
+    db.close_conn()
+
+def test_ex_sql_fetches_any_row_query(db):
+    assert db.ex_sql('select count(*) from businesses') == [(50,)]
+    assert db.ex_sql('WITH b AS (SELECT * FROM businesses) SELECT COUNT(*) FROM b') == [(50,)]
+    assert db.ex_sql('PRAGMA journal_mode')[0][0] == 'delete'
+    assert db.ex_sql("UPDATE businesses SET recipient_city = 'VIENNA'") is None
+
+def test_pool_concurrent_reads(db):
+    pool = build_db.ConnectionPool(size=2)
+    q = 'SELECT COUNT(*) FROM businesses WHERE recipient_name > ?'
+    with ThreadPoolExecutor(8) as ex:
+        counts = list(ex.map(lambda i: pool.query_array(q, (f'CO {i}',))[0][0], range(40)))
+    assert counts[0] == 49
+    assert pool.idle.qsize() <= 2
+
+    assert len(list(pool.query('SELECT * FROM businesses', batch_size=7))) == 50
+    assert pool.query_df('SELECT recipient_name FROM businesses').shape == (50, 1)
+    with pytest.raises(sqlite3.OperationalError):
+        pool.query_array("DELETE FROM businesses")
+    pool.close()
+
+def test_refresh_rollups_by_fiscal_year(db):
+    db.exmany_sql('INSERT INTO awards (award_id, naics_code) VALUES (?,?)', [('A1', 541620), ('A2', 541330)])
+    db.exmany_sql("""INSERT INTO actions (action_key, award_id, recipient_name, dollars_obligated, action_date_fiscal_year,
+        awarding_agency_name) VALUES (?,?,?,?,?,?)""",
+        [('T1', 'A1', 'CO 1', 10.0, 2020, 'EPA'), ('T2', 'A1', 'CO 1', 5.0, 2020, 'EPA'), ('T3', 'A2', 'CO 2', 1.0, 2021, 'DOE')])
+    assert db.refresh_rollups() == 2 + 2 + 2
+    assert db.ex_sql('SELECT dollars_obligated, action_count, award_count FROM rollup_recipients WHERE fiscal_year = 2020') == [(15.0, 2, 1)]
+
+    db.ex_sql("UPDATE actions SET dollars_obligated = 7.0, action_date_fiscal_year = 2021 WHERE action_key = 'T2'")
+    db.ex_sql("UPDATE actions SET dollars_obligated = 100.0 WHERE action_key = 'T3'")
+    assert db.refresh_rollups([2020]) == 3
+    assert db.ex_sql('SELECT fiscal_year, dollars_obligated FROM rollup_naics ORDER BY fiscal_year') == [(2020, 10.0), (2021, 1.0)]
+    assert db.fiscal_years_of(['T2', 'T3', 'T9']) == {2021}
+    db.refresh_rollups([2021])
+    assert db.ex_sql('SELECT naics_code, fiscal_year, dollars_obligated FROM rollup_naics ORDER BY fiscal_year, naics_code') == [
+        (541620, 2020, 10.0), (541330, 2021, 100.0), (541620, 2021, 7.0)]
+
+def test_dedupe_keys_keeps_the_row_a_row_by_row_load_would():
+    frame = pd.DataFrame({'action_key': ['T1', 'T2', 'T1', None, None], 'dollars_obligated': [1.0, 2.0, 3.0, 4.0, 5.0]})
+    assert build_db.dedupe_keys(frame, 'action_key')['dollars_obligated'].tolist() == [1.0, 2.0, 4.0, 5.0]
+    assert build_db.dedupe_keys(frame, 'action_key', upsert=True)['dollars_obligated'].tolist() == [2.0, 3.0, 4.0, 5.0]
+    unique = frame.iloc[:2]
+    assert build_db.dedupe_keys(unique, 'action_key') is unique
+
+def test_dedupe_keys_without_the_key_column(db):
+    frame = pd.DataFrame({'action_date': ['2021-01-01', '2021-01-01'], 'dollars_obligated': [1.0, 2.0]})
+    assert build_db.dedupe_keys(frame, 'action_key') is frame
+    db.insert_frame('actions', frame)
+    db.insert_frame('actions', frame, upsert=True)
+    assert db.ex_sql('SELECT COUNT(*) FROM actions WHERE action_key IS NULL')[0][0] == 4
+
+def test_opening_a_pre_key_db_adds_the_keys(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'old.db'))
+    conn = sqlite3.connect(settings.DB_PATH)
+    conn.executescript('''CREATE TABLE actions (id INTEGER PRIMARY KEY, award_id VARCHAR(255), recipient_name VARCHAR(255));
+        CREATE TABLE awards (id INTEGER PRIMARY KEY, award_id VARCHAR(255), naics_code INTEGER NOT NULL);
+        INSERT INTO awards (award_id, naics_code) VALUES ('A1', 1), ('A1', 2), (NULL, 3), (NULL, 4);''')
+    conn.close()
+    db = build_db.DB()
+    assert 'action_key' in db.all_tbl_cols['actions']
+    assert db.has_unique_key('actions', 'action_key') and db.has_unique_key('awards', 'award_id')
+    assert db.ex_sql('SELECT award_id, naics_code FROM awards ORDER BY id') == [('A1', 1), (None, 3), (None, 4)]
+    db.insert_frame('actions', pd.DataFrame({'action_key': ['T1', 'T1'], 'award_id': ['A1', 'A2']}), upsert=True)
+    assert db.ex_sql('SELECT action_key, award_id FROM actions') == [('T1', 'A2')]
+    db.close_conn()
+
+def test_insert_frame_first_row_wins_and_upsert_last_row_wins(db):
+    frame = pd.DataFrame({'recipient_name': ['CO 1', 'NEW CO', 'NEW CO'], 'recipient_city': ['ARLINGTON', 'DALLAS', 'AUSTIN']})
+    db.insert_frame('businesses', frame)
+    q = "SELECT recipient_name, recipient_city FROM businesses WHERE recipient_name IN ('CO 1', 'NEW CO') ORDER BY 1"
+    assert db.ex_sql(q) == [('CO 1', 'RESTON'), ('NEW CO', 'DALLAS')]
+    db.insert_frame('businesses', frame, upsert=True)
+    assert db.ex_sql(q) == [('CO 1', 'ARLINGTON'), ('NEW CO', 'AUSTIN')]
+
+def test_iter_rows_batches_native_values(monkeypatch):
+    monkeypatch.setattr(settings, 'INSERT_BATCH_ROWS', 4)
+    frame = pd.DataFrame({'n': np.arange(10), 'x': np.linspace(0, 1, 10), 's': list('abcdefghij')})
+    frame.loc[5, 'x'] = np.nan
+    rows = list(build_db.iter_rows(frame))  # 3 batches, the last one short
+    assert [r[0] for r in rows] == list(range(10))
+    assert [r[2] for r in rows] == list('abcdefghij')
+    assert rows[4][1] == frame.loc[4, 'x'] and rows[6][1] == frame.loc[6, 'x'] and np.isnan(rows[5][1])
+    assert all(type(v) in (int, float, str) for row in rows for v in row)
+    assert [r[0] for r in build_db.iter_rows(frame, batch_size=3)] == list(range(10))
+    assert list(build_db.iter_rows(frame.iloc[:0])) == []
@@ -0,0 +1,288 @@
+
+import errno
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import settings
+import data_quality
+import gov_contract_data_cleaner as gcdc
+
+
+def load_cleaned():
+    return pd.read_csv(settings.DEF_CLEAN_PATH, low_memory=False)
+
+def as_raw(df):
+    # Rebuilds a raw USAspending shaped frame from the cleaned data
+    inverse_map = {v: k for k, v in settings.rename_map.items()}
+    raw = df.drop(columns=['year', 'plop_zip_5', 'recipient_zip_code_5']).rename(columns=inverse_map)
+    raw = raw.replace('unknown', np.nan)
+    for col in settings.rename_map:
+        if col not in raw.columns:
+            raw[col] = None
+    return raw[[c for c in settings.rename_map]]
+
+
+def test_reformat_names_parity():
+    names = load_cleaned()['recipient_name']
+    names = pd.concat([names, pd.Series([None, 'ACME, INCORPORATED.', 'FOO LIMITED LIABILITY COMPANY'])], ignore_index=True)
+    expected = names.apply(gcdc.reformat_names)
+    pd.testing.assert_series_equal(gcdc.reformat_names_vec(names), expected)
+
+def test_fix_date_issues_parity():
+    df = load_cleaned()
+    extra = pd.Series([None, '0021-06-24', '1921-06-24 00:00:00', '2205-01-01'])
+    for col in ['pop_start_date', 'pop_end_date', 'pop_potential_end_date', 'action_date']:
+        dates = pd.concat([df[col], extra], ignore_index=True)
+        expected = dates.apply(gcdc.fix_date_issues)
+        pd.testing.assert_series_equal(gcdc.fix_date_issues_vec(dates), expected, check_dtype=False)
+
+def test_run_pipeline2_parity():
+    raw = as_raw(load_cleaned())
+    vectorized = gcdc.run_pipeline2(raw.copy())
+    reference = gcdc.run_pipeline2(raw.copy(), vectorized=False)
+    pd.testing.assert_frame_equal(vectorized, reference)
+
+def test_pre_2000_dates_are_kept():
+    raw = as_raw(load_cleaned())
+    raw.loc[raw.index[0], 'action_date'] = '1999-10-01'
+    raw.loc[raw.index[0], 'last_modified_date'] = '1999-10-02 08:00:00'
+    raw.loc[raw.index[0], 'period_of_performance_start_date'] = '0019-10-01'
+    vectorized = gcdc.run_pipeline2(raw.copy())
+    pd.testing.assert_frame_equal(vectorized, gcdc.run_pipeline2(raw.copy(), vectorized=False))
+    first = vectorized.loc[raw.index[0]]
+    assert first['action_date'] == pd.Timestamp('1999-10-01')
+    assert first['last_modified_date'] == pd.Timestamp('1999-10-02 08:00:00')
+    assert first['year'] == 1999
+    assert first['pop_start_date'] == pd.Timestamp('2019-10-01')  # the pop dates still get the century fix
+    assert gcdc.parse_dates(pd.Series(['1999-10-01', 'not a date']), '%Y-%m-%d', repair=False).tolist()[0] == pd.Timestamp('1999-10-01')
+
+def test_exec_pool_stream_matches_exec_pool(tmp_path):
+    raw_fn = str(tmp_path / 'raw.csv')
+    out_fn = str(tmp_path / 'streamed.csv')
+    expected_fn = str(tmp_path / 'expected.csv')
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    expected = gcdc.exec_pool(raw_fn, num_processes=2)
+
+    num_rows = gcdc.exec_pool_stream(gcdc.csv_sink(out_fn), raw_fn, num_processes=2, chunksize=500, max_pending=2)
+    expected.to_csv(expected_fn, index=False, na_rep='unknown')
+    assert num_rows == expected.shape[0]
+    assert open(out_fn).read() == open(expected_fn).read()
+    # Every column, with the dtypes a reload infers
+    pd.testing.assert_frame_equal(pd.read_csv(out_fn, low_memory=False), pd.read_csv(expected_fn, low_memory=False))
+
+def test_parquet_round_trip(tmp_path):
+    fname = str(tmp_path / 'cleaned.parquet')
+    data = load_cleaned()
+    gcdc.make_parquet(data, fname)
+
+    typed = gcdc.read_parquet(['naics_code', 'action_date', 'dollars_obligated', 'action_date_fiscal_year'], years=[2021], fname=fname)
+    assert typed.shape[0] == data.shape[0]
+    assert str(typed['naics_code'].dtype) == 'category'
+    assert str(typed['action_date'].dtype) == 'datetime64[ns]'
+    assert typed['dollars_obligated'].sum() == data['dollars_obligated'].sum()
+    assert gcdc.read_parquet(['naics_code'], years=[2020], fname=fname).empty
+
+def test_missing_fiscal_years_are_kept(tmp_path):
+    raw_fn = str(tmp_path / 'raw.csv')
+    fname = str(tmp_path / 'cleaned.parquet')
+    raw = as_raw(load_cleaned())
+    raw.loc[raw.index[:5], 'action_date_fiscal_year'] = None
+    raw.to_csv(raw_fn, index=False)
+
+    data = gcdc.exec_pool(raw_fn, num_processes=2, chunksize=500)
+    assert str(data['action_date_fiscal_year'].dtype) == 'Int32'
+    assert data['action_date_fiscal_year'].isna().sum() == 5
+    gcdc.make_parquet(data, fname)
+    years = gcdc.read_parquet(['action_date_fiscal_year'], fname=fname)['action_date_fiscal_year']
+    assert years.isna().sum() == 5 and years.dropna().unique().tolist() == [2021]
+    assert gcdc.read_parquet(['naics_code'], years=[2021], fname=fname).shape[0] == data.shape[0] - 5
+
+def test_exec_pool_stream_writes_parquet(tmp_path, monkeypatch):
+    raw_fn = str(tmp_path / 'raw.csv')
+    whole_fn = str(tmp_path / 'whole.parquet')
+    streamed_fn = str(tmp_path / 'streamed.parquet')
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    gcdc.make_parquet(gcdc.exec_pool(raw_fn, num_processes=2), whole_fn)
+
+    monkeypatch.setattr(gcdc, 'DEF_PARQUET_PATH', streamed_fn)
+    for _ in range(2):  # a rerun replaces the dataset instead of adding to it
+        gcdc.exec_pool_stream(lambda data: None, raw_fn, num_processes=2, chunksize=500, parquet=True)
+    # files within a partition come back in any order
+    whole, streamed = [gcdc.read_parquet(fname=fn) for fn in (whole_fn, streamed_fn)]
+    whole, streamed = [df.loc[df.astype(str).sort_values(list(df.columns)).index].reset_index(drop=True) for df in (whole, streamed)]
+    pd.testing.assert_frame_equal(streamed, whole, check_categorical=False)
+
+def test_typed_read_matches_untyped(tmp_path):
+    raw_fn = str(tmp_path / 'raw.csv')
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    cols = [c for c in settings.rename_map]
+    typed = pd.read_csv(raw_fn, usecols=cols, dtype=settings.source_dtypes, low_memory=False)
+    untyped = pd.read_csv(raw_fn, usecols=cols, dtype={'primary_place_of_performance_zip_4': str}, low_memory=False)
+    assert str(typed['naics_code'].dtype) == 'category'
+    assert typed.memory_usage(deep=True).sum() < untyped.memory_usage(deep=True).sum()
+
+    typed = gcdc.fill_unknown(gcdc.run_pipeline2(typed))
+    untyped = gcdc.fill_unknown(gcdc.run_pipeline2(untyped))
+    assert typed.to_csv(index=False) == untyped.to_csv(index=False)
+
+def test_parse_dates_matches_reference():
+    dates = load_cleaned()['pop_end_date']
+    dates = pd.concat([dates, pd.Series([None, '0021-06-24 00:00:00', '1921-06-24 00:00:00'])], ignore_index=True)
+    expected = pd.to_datetime(dates.apply(gcdc.fix_date_issues))
+    pd.testing.assert_series_equal(gcdc.parse_dates(dates), expected)
+
+    mixed = pd.Series(['2021-06-24', '06/25/2021', 'not a date', None])
+    assert gcdc.detect_date_format(mixed.iloc[:1]) == '%Y-%m-%d'
+    assert gcdc.parse_dates(mixed, '%Y-%m-%d').tolist()[:2] == [pd.Timestamp('2021-06-24'), pd.Timestamp('2021-06-25')]
+    assert gcdc.parse_dates(mixed).iloc[2:].isna().all()
+
+def test_plan_pool(tmp_path, monkeypatch):
+    raw_fn = str(tmp_path / 'raw.csv')
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    assert gcdc.plan_pool(raw_fn, cores=8)['mode'] == 'in_process'
+
+    monkeypatch.setattr(gcdc, 'POOL_MIN_BYTES', 0)
+    monkeypatch.setattr(gcdc, 'POOL_CHUNK_ROWS', (500, 5000))
+    plan = gcdc.plan_pool(raw_fn, cores=8, memory=16 * 1024**3)
+    assert plan['mode'] == 'pool'
+    assert abs(plan['est_rows'] - 3088) < 300
+    assert plan['num_processes'] == 7 and plan['chunksize'] == 500
+    monkeypatch.setattr(gcdc, 'POOL_CHUNK_ROWS', (5000, 50000))
+    assert gcdc.plan_pool(raw_fn, cores=8, memory=16 * 1024**3)['chunksize'] == 5000
+    # Low memory shrinks the chunks
+    assert gcdc.plan_pool(raw_fn, cores=8, memory=100 * 1024**2)['chunksize'] < 5000
+
+def test_exec_auto_matches_exec_pool(tmp_path, monkeypatch):
+    raw_fn = str(tmp_path / 'raw.csv')
+    log_fn = str(tmp_path / 'run_log.jsonl')
+    parquet_fn = str(tmp_path / 'cleaned.parquet')
+    monkeypatch.setattr(gcdc, 'RUN_LOG_PATH', log_fn)
+    monkeypatch.setattr(gcdc, 'DEF_PARQUET_PATH', parquet_fn)
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    expected = gcdc.exec_pool(raw_fn, num_processes=2)
+
+    in_process = gcdc.exec_auto(raw_fn)
+    monkeypatch.setattr(gcdc, 'POOL_MIN_BYTES', 0)
+    monkeypatch.setattr(gcdc, 'POOL_CHUNK_ROWS', (1000, 5000))
+    monkeypatch.setattr(gcdc, 'usable_cores', lambda: 3)
+    pooled = gcdc.exec_auto(raw_fn)
+    for data in (in_process, pooled):
+        assert data.to_csv(index=False) == expected.to_csv(index=False)
+    assert [json.loads(line)['mode'] for line in open(log_fn)] == ['in_process', 'pool']
+    assert gcdc.read_parquet(['action_key'], fname=parquet_fn).shape[0] == expected.shape[0]
+
+def test_split_byte_ranges_respects_quoted_newlines(tmp_path):
+    fn = str(tmp_path / 'quoted.csv')
+    df = pd.DataFrame({'a': range(200), 'b': ['line one\nline "two"\n' if i % 3 else 'x' for i in range(200)]})
+    df.to_csv(fn, index=False)
+    ranges = gcdc.split_byte_ranges(fn, 7, block_size=256)
+    assert len(ranges) == 7
+    with open(fn, 'rb') as file_:
+        header = file_.readline()
+        content = file_.read()
+    pieces = [pd.read_csv(io.BytesIO(header + content[start - len(header):end - len(header)])) for start, end in ranges]
+    pd.testing.assert_frame_equal(pd.concat(pieces, ignore_index=True), df)
+
+def test_exec_pool_arrow_matches_exec_pool(tmp_path):
+    raw_fn = str(tmp_path / 'raw.csv')
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    expected = gcdc.exec_pool(raw_fn, num_processes=2, chunksize=700)
+    arrow = gcdc.exec_pool(raw_fn, num_processes=2, chunksize=700, handoff='arrow')
+    assert arrow.index.equals(expected.index)
+    assert arrow.to_csv(index=False) == expected.to_csv(index=False)
+
+def test_exec_pool_arrow_bounds_and_falls_back(tmp_path, monkeypatch):
+    raw_fn = str(tmp_path / 'raw.csv')
+    shm = tmp_path / 'shm'
+    shm.mkdir()
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    expected = gcdc.exec_pool(raw_fn, num_processes=2, chunksize=300)
+    monkeypatch.setattr(gcdc, 'POOL_HANDOFF_DIR', str(shm))
+
+    # No more than max_pending cleaned files wait to be read back
+    held = []
+    read_handoff = gcdc._read_handoff
+    def counting_read(path):
+        held.append(sum(len(files) for _, _, files in os.walk(shm)))
+        time.sleep(0.05)  # a slow reader, unbounded workers would run ahead of it
+        return read_handoff(path)
+    monkeypatch.setattr(gcdc, '_read_handoff', counting_read)
+    bounded = gcdc.exec_pool_arrow(raw_fn, num_processes=2, chunksize=300, max_pending=2)
+    assert len(held) > 2 and max(held) <= 2
+    assert bounded.to_csv(index=False) == expected.to_csv(index=False)
+
+    # A full handoff dir: the workers write to the system temp dir instead
+    write_handoff = gcdc._write_handoff
+    def full_shm(data, out_path):
+        if out_path.startswith(str(shm)):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        return write_handoff(data, out_path)
+    monkeypatch.setattr(gcdc, '_write_handoff', full_shm)
+    fallback = gcdc.exec_pool_arrow(raw_fn, num_processes=2, chunksize=700)
+    assert fallback.to_csv(index=False) == expected.to_csv(index=False)
+    assert os.listdir(shm) == []
+    # or up front, when it doesn't have room for the pending files
+    monkeypatch.setattr(gcdc.shutil, 'disk_usage', lambda path: shutil._ntuple_diskusage(1, 1, 0))
+    assert gcdc.handoff_dirs(1) == [tempfile.gettempdir()]
+
+def test_run_pipeline2_profile_keeps_types():
+    profile = []
+    data = gcdc.fill_unknown(gcdc.run_pipeline2(as_raw(load_cleaned()), profile=profile))
+    assert [r['stage'] for r in profile] == [name for name, _ in gcdc.cleaning_stages()]
+    assert all(r['peak_bytes'] > 0 for r in profile)
+    assert str(data['pop_end_date'].dtype) == 'datetime64[ns]'
+    assert str(data['recipient_zip_code'].dtype) == 'float64'
+    assert not data.select_dtypes(['object', 'category']).isna().any().any()
+
+def test_quality_profiles_merge_across_chunks(tmp_path):
+    raw_fn = str(tmp_path / 'raw.csv')
+    as_raw(load_cleaned()).to_csv(raw_fn, index=False)
+    raw = pd.read_csv(raw_fn, usecols=[c for c in settings.rename_map], dtype=settings.source_dtypes, low_memory=False)
+    whole = data_quality.Profile.of(raw)
+    merged = data_quality.Profile()
+    for start in range(0, raw.shape[0], 700):
+        merged.merge(data_quality.Profile.of(raw.iloc[start:start + 700]))
+    expected, report = whole.report(), merged.report()
+    assert report['rows'] == expected['rows'] == raw.shape[0]
+    for col, stats in report['columns'].items():
+        assert stats['null_rate'] == expected['columns'][col]['null_rate']
+        assert stats['violations'] == expected['columns'][col]['violations']
+        assert (stats['min'], stats['max']) == (expected['columns'][col]['min'], expected['columns'][col]['max'])
+        assert stats['distinct'] == expected['columns'][col]['distinct']  # max of the registers is order independent
+        assert abs(stats['distinct'] - raw[col].nunique()) <= max(2, 0.05 * raw[col].nunique())
+
+def test_exec_pool_fails_fast_on_bad_data(tmp_path, monkeypatch, quality_report_path):
+    raw_fn = str(tmp_path / 'raw.csv')
+    monkeypatch.setattr(settings, 'QUALITY_MIN_ROWS', 500)
+    raw = as_raw(load_cleaned())
+    raw.loc[raw.index[:1000], 'action_date'] = '24/06/2021'
+    raw.to_csv(raw_fn, index=False)
+
+    for handoff in ('pickle', 'arrow'):
+        with pytest.raises(data_quality.DataQualityError, match='action_date'):
+            gcdc.exec_pool(raw_fn, num_processes=2, chunksize=500, handoff=handoff, quality=True)
+        # Stopped at the first chunk over the threshold, with a report of the rows profiled so far
+        assert json.load(open(quality_report_path))['rows'] < raw.shape[0]
+    assert gcdc.exec_pool(raw_fn, num_processes=2, chunksize=500, quality=False).shape[0] == raw.shape[0]
+
+def test_exec_pool_stream_checks_the_complete_profile(tmp_path, quality_report_path):
+    raw_fn = str(tmp_path / 'raw.csv')
+    raw = as_raw(load_cleaned())
+    raw.loc[raw.index[:1000], 'action_date'] = '24/06/2021'
+    raw.to_csv(raw_fn, index=False)
+
+    # fewer rows than QUALITY_MIN_ROWS, so only the check after the last chunk can stop it
+    assert raw.shape[0] < settings.QUALITY_MIN_ROWS
+    sunk = []
+    with pytest.raises(data_quality.DataQualityError, match='action_date'):
+        gcdc.exec_pool_stream(sunk.append, raw_fn, num_processes=2, chunksize=500, quality=True)
+    assert json.load(open(quality_report_path))['rows'] == raw.shape[0]
+    assert gcdc.exec_pool_stream(sunk.append, raw_fn, num_processes=2, chunksize=500, quality=False) == raw.shape[0]
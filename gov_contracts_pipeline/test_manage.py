@@ -0,0 +1,302 @@
+
+import json
+import sqlite3
+import time
+
+import pandas as pd
+import pytest
+
+import settings
+import build_db
+import manage
+import rankings
+from test_cleaner import as_raw, load_cleaned
+
+
+def raw_with_keys():
+    raw = as_raw(load_cleaned())
+    raw['contract_transaction_unique_key'] = [f'TX_{i}' for i in range(raw.shape[0])]
+    return raw
+
+def test_run_incremental_only_loads_delta(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(settings, 'RUN_DB_SETUP', True)
+    raw_fn = str(tmp_path / 'raw.csv')
+    raw = raw_with_keys()
+    raw.to_csv(raw_fn, index=False)
+
+    assert manage.run_incremental(raw_fn) == raw.shape[0]
+    monkeypatch.setattr(settings, 'RUN_DB_SETUP', False)
+    assert manage.run_incremental(raw_fn) == 0
+
+    # Two modified actions get newer last_modified_dates
+    raw.loc[:1, 'last_modified_date'] = '2022-01-01 00:00:00'
+    raw.loc[:1, 'federal_action_obligation'] = 123.0
+    raw.to_csv(raw_fn, index=False)
+    assert manage.run_incremental(raw_fn) == 2
+
+    db = build_db.DB()
+    assert db.ex_sql('SELECT COUNT(*) FROM actions')[0][0] == raw.shape[0]
+    assert db.ex_sql("SELECT dollars_obligated FROM actions WHERE action_key = 'TX_0'")[0][0] == 123.0
+    assert db.get_watermark('raw.csv')[0] == '2022-01-01 00:00:00'
+    assert db.ex_sql('SELECT rows_loaded FROM load_runs ORDER BY id') == [(raw.shape[0],), (0,), (2,)]
+    for rollup in build_db.ROLLUPS:
+        dollars, actions = db.ex_sql(f'SELECT SUM(dollars_obligated), SUM(action_count) FROM {rollup}')[0]
+        assert actions == raw.shape[0]
+        assert abs(dollars - db.ex_sql('SELECT SUM(dollars_obligated) FROM actions')[0][0]) < 0.01
+    db.close_conn()
+
+def baseline_db(path):
+    '''A DB with the first schema (before the load keys, control tables and rollups), with two copies of an award'''
+    conn = sqlite3.connect(path)
+    conn.executescript('''CREATE TABLE actions (
+            id INTEGER PRIMARY KEY,
+            award_id VARCHAR(255),
+            recipient_name VARCHAR(255),
+            dollars_obligated FLOAT,
+            action_date VARCHAR(11),
+            FOREIGN KEY (award_id) REFERENCES awards (award_id),
+            FOREIGN KEY (recipient_name) REFERENCES businesses (recipient_name)
+        );
+        CREATE TABLE awards (
+            id INTEGER PRIMARY KEY,
+            award_id VARCHAR(255),
+            plop_city VARCHAR(255),
+            plop_state_code VARCHAR(255),
+            plop_country_code VARCHAR(255),
+            naics_code INTEGER NOT NULL
+        );
+        CREATE TABLE businesses (
+            recipient_name VARCHAR(255) PRIMARY KEY,
+            recipient_city VARCHAR(255),
+            recipient_zip_code_5 INTEGER,
+            recipient_duns TEXT
+        );
+        INSERT INTO actions (award_id, recipient_name, dollars_obligated, action_date)
+            VALUES ('OLD_1', 'OLD CO', 10.0, '2015-03-01');
+        INSERT INTO awards (award_id, plop_city, naics_code) VALUES ('OLD_1', 'RESTON', 541620), ('OLD_1', 'VIENNA', 541620);
+        INSERT INTO businesses (recipient_name, recipient_city) VALUES ('OLD CO', 'RESTON');''')
+    conn.commit()
+    conn.close()
+
+def test_run_incremental_on_a_baseline_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(settings, 'RUN_DB_SETUP', False)
+    baseline_db(settings.DB_PATH)
+    raw_fn = str(tmp_path / 'raw.csv')
+    raw = raw_with_keys()
+    raw.to_csv(raw_fn, index=False)
+
+    assert manage.run_incremental(raw_fn) == raw.shape[0]
+    assert manage.run_incremental(raw_fn) == 0
+    db = build_db.DB()
+    assert db.ex_sql('SELECT COUNT(*) FROM actions')[0][0] == raw.shape[0] + 1
+    # the repeated award was dropped (the first one kept) for its unique key
+    assert db.ex_sql("SELECT plop_city FROM awards WHERE award_id = 'OLD_1'") == [('RESTON',)]
+    assert db.ex_sql('SELECT rows_loaded FROM load_runs ORDER BY id') == [(raw.shape[0],), (0,)]
+    assert db.get_watermark('raw.csv') is not None
+    db.close_conn()
+
+def test_last_task_on_a_baseline_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    baseline_db(settings.DB_PATH)
+    data = manage.gcdc.fill_unknown(manage.gcdc.run_pipeline2(raw_with_keys()))
+    manage.last_task(data)
+
+    db = build_db.DB()
+    assert db.ex_sql('SELECT COUNT(*) FROM actions')[0][0] == data.shape[0] + 1
+    # the old actions have no fiscal year, the new ones are all in the rollups
+    assert db.ex_sql('SELECT SUM(action_count) FROM rollup_naics WHERE fiscal_year IS NOT NULL')[0][0] == data.shape[0]
+    assert db.ex_sql('SELECT COUNT(*) FROM action_facts')[0][0] == data.shape[0] + 1
+    db.close_conn()
+
+@pytest.mark.parametrize('run', ['run_streaming', 'run_incremental'])
+def test_streamed_load_failing_the_quality_check_is_rolled_back(tmp_path, monkeypatch, quality_report_path, run):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(settings, 'RUN_DB_SETUP', False)
+    monkeypatch.setattr(settings, 'WRITE_PARQUET', False)
+    monkeypatch.setattr(manage.gcdc, 'PROFILE_QUALITY', True)
+    build_db.DB(True).close_conn()
+    raw_fn = str(tmp_path / 'raw.csv')
+    raw = raw_with_keys()
+    raw.loc[raw.index[:1000], 'action_date'] = '24/06/2021'
+    raw.to_csv(raw_fn, index=False)
+
+    # the chunks are sunk before the check of the complete profile fails
+    with pytest.raises(manage.data_quality.DataQualityError, match='action_date'):
+        getattr(manage, run)(raw_fn)
+    db = build_db.DB()
+    for table in build_db.STAR_TABLES:
+        assert db.ex_sql(f'SELECT COUNT(*) FROM {table}')[0][0] == 0
+    assert db.ex_sql('SELECT COUNT(*) FROM load_runs')[0][0] == 0
+    indexes = [r[0] for r in db.ex_sql("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")]
+    assert sorted(indexes) == sorted(build_db.INDEXES)
+    db.close_conn()
+
+def test_newer_than_without_marks_keeps_all_rows():
+    chunk = raw_with_keys()
+    assert manage.newer_than(None)(chunk).shape[0] == chunk.shape[0]
+    # a first run over a file without dates stores (None, None) marks
+    row_filter = manage.newer_than((None, None))
+    assert row_filter(chunk).shape[0] == chunk.shape[0]
+    assert row_filter.marks[0] == pd.Timestamp(chunk['last_modified_date'].max())
+
+    newest = chunk['action_date'].max()
+    only_action_date = manage.newer_than((None, newest))(chunk)
+    assert only_action_date.shape[0] == 0
+    assert manage.newer_than((None, '2000-01-01'))(chunk).shape[0] == chunk.shape[0]
+
+def test_last_task_bulk_load_rebuilds_indexes(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    build_db.DB(True).close_conn()
+    manage.last_task(manage.gcdc.run_pipeline2(raw_with_keys()).fillna('unknown'))
+
+    db = build_db.DB()
+    indexes = [r[0] for r in db.ex_sql("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")]
+    assert sorted(indexes) == sorted(build_db.INDEXES)
+    assert db.cur.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert db.ex_sql('SELECT COUNT(*) FROM sqlite_stat1')[0][0] > 0
+    assert db.ex_sql('SELECT DISTINCT typeof(action_date) FROM actions') == [('text',)]
+    db.close_conn()
+
+def test_pipeline_runs_independent_tasks_concurrently(tmp_path):
+    log_path = str(tmp_path / 'run_log.jsonl')
+    p = manage.Pipeline(log_path=log_path)
+    spans = {}
+
+    @p.task(key='a')
+    def slow_a(x):
+        start = time.monotonic()
+        time.sleep(0.3)
+        spans['a'] = (start, time.monotonic())
+        return x + 1
+
+    @p.task(key='b')
+    def slow_b(x):
+        start = time.monotonic()
+        time.sleep(0.3)
+        spans['b'] = (start, time.monotonic())
+        return x * 10
+
+    @p.task(depends_on=[slow_a, slow_b])
+    def combine(a, b):
+        spans['combine'] = (time.monotonic(), time.monotonic())
+        return a + b
+
+    assert p.run(2) == 23
+    # a and b overlap, combine starts after both finished
+    assert spans['a'][0] < spans['b'][1] and spans['b'][0] < spans['a'][1]
+    assert spans['combine'][0] >= max(spans['a'][1], spans['b'][1])
+    assert p.results == {'a': 3, 'b': 20, 'combine': 23}
+    records = [json.loads(line) for line in open(log_path)]
+    assert [r['task'] for r in records][-1] == 'combine'
+    assert all(r['status'] == 'ok' for r in records)
+
+def test_second_task_never_prompts(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr('builtins.input', lambda *args: pytest.fail('second_task prompted'))
+    monkeypatch.setattr(settings, 'RUN_DB_SETUP', True)
+    assert manage.second_task(None) is True
+    monkeypatch.setattr(settings, 'RUN_DB_SETUP', False)
+    assert manage.second_task(None) is False
+    monkeypatch.setattr(manage, 'REBUILD_DB', True)
+    assert manage.second_task(None) is True
+
+def test_duckdb_engine_matches_sqlite(tmp_path, monkeypatch):
+    pytest.importorskip('duckdb')
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(settings, 'DUCKDB_PATH', str(tmp_path / 'test.duckdb'))
+    data = manage.gcdc.fill_unknown(manage.gcdc.run_pipeline2(raw_with_keys()))
+    q = '''SELECT recipient_name, naics_code, fiscal_year, awarding_agency_name, ROUND(dollars_obligated, 2), action_count,
+        award_count FROM rollup_recipients ORDER BY 1, 2, 3, 4'''
+    results, ranked = {}, {}
+    for engine in ['sqlite', 'duckdb']:
+        monkeypatch.setattr(settings, 'DB_ENGINE', engine)
+        build_db.connect(True).close_conn()
+        manage.last_task(data)
+        db = build_db.connect()
+        results[engine] = [tuple(row) for row in db.ex_sql(q)]
+        ranked[engine] = {g: [r['recipient_name'] for r in rows] for g, rows in rankings.rank_competitors(db, k=3).items()}
+        db.close_conn()
+    assert len(results['sqlite']) > 0
+    assert results['duckdb'] == results['sqlite']
+    # same column types in both engines, so the rankings are keyed the same (e.g. (541620, 2021))
+    assert ranked['duckdb'] == ranked['sqlite']
+    assert all(isinstance(naics, int) for naics, _ in ranked['duckdb'] if naics is not None)
+
+    parquet_dir = str(tmp_path / 'cleaned.parquet')
+    manage.gcdc.make_parquet(data, parquet_dir)
+    db = build_db.DuckDB(True)
+    assert db.insert_parquet(parquet_dir) == data.shape[0]
+    assert db.ex_sql('SELECT COUNT(*) FROM awards')[0][0] == data['award_id'].nunique()
+    db.close_conn()
+
+def test_insert_parquet_keeps_the_first_rows_like_sqlite(tmp_path, monkeypatch):
+    pytest.importorskip('duckdb')
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(settings, 'DUCKDB_PATH', str(tmp_path / 'test.duckdb'))
+    data = manage.gcdc.fill_unknown(manage.gcdc.run_pipeline2(raw_with_keys()))
+    # a repeated award and action key whose first row is in a later fiscal year partition than the second
+    first, second = data.index[10], data.index[2500]
+    data.loc[[first, second], 'action_date_fiscal_year'] = [2021, 2019]
+    data.loc[[first, second], 'award_id'] = 'DUP_AWARD'
+    data.loc[[first, second], 'plop_city'] = ['FIRST', 'SECOND']
+    data.loc[second, 'action_key'] = data.loc[first, 'action_key']
+    data.loc[[first, second], 'dollars_obligated'] = [1.0, 2.0]
+
+    queries = ['SELECT award_id, plop_city, plop_state_code FROM awards ORDER BY 1',
+        'SELECT recipient_name, recipient_city, recipient_duns FROM businesses ORDER BY 1',
+        'SELECT action_key, award_id, recipient_name, dollars_obligated FROM actions ORDER BY 1']
+    build_db.DB(True).close_conn()
+    manage.last_task(data)
+    db = build_db.DB()
+    expected = [db.ex_sql(q) for q in queries]
+    db.close_conn()
+    assert ('DUP_AWARD', 'FIRST') in [row[:2] for row in expected[0]]
+
+    parquet_dir = str(tmp_path / 'cleaned.parquet')
+    sink = manage.gcdc.parquet_sink(parquet_dir)
+    for start in range(0, data.shape[0], 1000):  # written chunk by chunk like exec_pool_stream
+        sink(data.iloc[start:start + 1000])
+    db = build_db.DuckDB(True)
+    db.insert_parquet(parquet_dir)
+    assert [[tuple(row) for row in db.ex_sql(q)] for q in queries] == expected
+    db.close_conn()
+
+def test_insert_parquet_loads_the_names_as_reported(tmp_path, monkeypatch):
+    pytest.importorskip('duckdb')
+    monkeypatch.setattr(settings, 'DUCKDB_PATH', str(tmp_path / 'test.duckdb'))
+    monkeypatch.setattr(settings, 'CANONICALIZE_NAMES', True)
+    data = manage.gcdc.fill_unknown(manage.gcdc.run_pipeline2(raw_with_keys()))
+    parquet_dir = str(tmp_path / 'cleaned.parquet')
+    manage.gcdc.make_parquet(data, parquet_dir)
+    db = build_db.DuckDB(True)
+    db.insert_parquet(parquet_dir)
+    assert db.ex_sql('SELECT COUNT(*) FROM actions WHERE recipient_name IS DISTINCT FROM raw_recipient_name')[0][0] == 0
+    assert db.ex_sql('SELECT COUNT(*) FROM recipient_aliases')[0][0] == 0
+    db.close_conn()
+
+def test_missing_fiscal_years_load_as_null(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(settings, 'DUCKDB_PATH', str(tmp_path / 'test.duckdb'))
+    raw_fn = str(tmp_path / 'raw.csv')
+    raw = raw_with_keys()
+    raw.loc[raw.index[:5], 'action_date_fiscal_year'] = None
+    raw.to_csv(raw_fn, index=False)
+    data = manage.gcdc.fill_unknown(manage.gcdc.exec_pool(raw_fn, num_processes=2))
+    q = 'SELECT COUNT(*) FROM actions WHERE action_date_fiscal_year IS NULL'
+
+    build_db.DB(True).close_conn()
+    manage.last_task(data)
+    db = build_db.DB()
+    assert db.ex_sql(q)[0][0] == 5
+    assert db.ex_sql('SELECT SUM(action_count) FROM rollup_naics WHERE fiscal_year IS NULL')[0][0] == 5
+    db.close_conn()
+
+    if build_db.duckdb is not None:
+        parquet_dir = str(tmp_path / 'cleaned.parquet')
+        manage.gcdc.make_parquet(data, parquet_dir)
+        db = build_db.DuckDB(True)
+        db.insert_parquet(parquet_dir)
+        assert db.ex_sql(q)[0][0] == 5
+        db.close_conn()
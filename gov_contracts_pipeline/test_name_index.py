@@ -0,0 +1,63 @@
+import time
+
+import pandas as pd
+
+import settings
+import build_db
+import manage
+import name_index
+from test_manage import raw_with_keys
+
+
+def test_resolve_merges_variants():
+    names = pd.Series(['ACME INC', 'ACME INC', 'THE ACME CORPORATION', 'ACME, INCORPORATED',
+        'FEDERAL INTEGRATED SYSTEMS CORP', 'FEDERAL INTERGRATED SYSTEMS CORP', 'FEDERAL STREAM INC', None, 'missing'])
+    duns = pd.Series([1, 1, 1, 1, 2, 2, 2, None, None])
+    index = name_index.NameIndex()
+    resolved = index.resolve(names, duns)
+    assert resolved.tolist() == ['ACME INC'] * 4 + ['FEDERAL INTEGRATED SYSTEMS CORP'] * 2 + ['FEDERAL STREAM INC', None, 'missing']
+    assert index.new_aliases[('FEDERAL INTERGRATED SYSTEMS CORP', '2')][1] >= settings.NAME_MATCH_THRESHOLD
+    assert index.new_aliases[('FEDERAL STREAM INC', '2')] == ('FEDERAL STREAM INC', None)
+
+def test_resolve_never_merges_different_duns():
+    names = pd.Series(['AECOM TECHNICAL SERVICES INC', 'AECOM TECHNICAL SERVICES OF NY INC', 'ACME INC', 'ACME CORP', 'ACME LLC'])
+    resolved = name_index.NameIndex().resolve(names, pd.Series([1, 2, 3, 4, None]))
+    assert resolved.tolist() == names.tolist()
+    # Without DUNS numbers only exact name key matches merge
+    resolved = name_index.NameIndex().resolve(pd.Series(['ACME INC', 'ACME CORP', 'FEDERAL INTEGRATED SYSTEMS CORP', 'FEDERAL INTERGRATED SYSTEMS CORP']))
+    assert resolved.tolist() == ['ACME INC', 'ACME INC', 'FEDERAL INTEGRATED SYSTEMS CORP', 'FEDERAL INTERGRATED SYSTEMS CORP']
+
+def test_resolve_scales_to_many_distinct_names():
+    names = pd.Series([f'NUMBERED SERVICES {i} INC' for i in range(10000)])
+    for duns in (pd.Series(range(10000)), pd.Series(7, index=names.index), None):
+        began = time.perf_counter()
+        resolved = name_index.NameIndex().resolve(names, duns)
+        assert time.perf_counter() - began < 10
+        if duns is None or duns.nunique() > 1:
+            assert resolved.nunique() == 10000
+
+def test_aliases_persist_between_loads(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(settings, 'CANONICALIZE_NAMES', True)
+    build_db.DB(True).close_conn()
+    data = manage.gcdc.fill_unknown(manage.gcdc.run_pipeline2(raw_with_keys()))
+    # a variant spelling on one row of a name and DUNS with several rows
+    counts = data.groupby(['recipient_name', 'recipient_duns']).size()
+    variant, duns = counts[counts >= 3].index[0]
+    alias = variant.replace(' ', '  ', 1) + ','
+    rows = data.index[(data['recipient_name'] == variant) & (data['recipient_duns'] == duns)]
+    data.loc[rows[:1], 'recipient_name'] = alias
+    manage.last_task(data)
+
+    db = build_db.DB()
+    aliases = {(a, d): c for a, d, c in db.get_aliases()}
+    assert len(aliases) == data[['recipient_name', 'recipient_duns']].drop_duplicates().shape[0]
+    assert aliases[(alias, str(duns))] == variant
+    assert db.ex_sql('SELECT COUNT(*) FROM businesses')[0][0] == len(set(aliases.values()))
+    # the reported name is kept next to the canonical one
+    assert db.ex_sql('SELECT DISTINCT recipient_name FROM actions WHERE raw_recipient_name = ?', (alias,)) == [(variant,)]
+
+    index = name_index.NameIndex.load(db)
+    index.resolve(data['recipient_name'], data['recipient_duns'])
+    assert index.new_aliases == {}
+    db.close_conn()
@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+import settings
+import build_db
+import rankings
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DB_PATH', str(tmp_path / 'test.db'))
+    db = build_db.DB(True)
+    db.exmany_sql('INSERT INTO businesses (recipient_name, recipient_city) VALUES (?,?)',
+        [(f'CO {i}', 'RESTON') for i in range(4)])
+    db.exmany_sql('INSERT INTO awards (award_id, naics_code) VALUES (?,?)',
+        [('A1', 541620), ('A2', 541620), ('A3', 541620), ('A4', 541330)])
+    db.exmany_sql("""INSERT INTO actions (action_key, award_id, recipient_name, dollars_obligated, action_date_fiscal_year,
+        awarding_agency_name) VALUES (?,?,?,?,?,?)""", [
+            ('T1', 'A1', 'CO 1', 100.0, 2017, 'EPA'),
+            ('T2', 'A1', 'CO 1', 10.0, 2020, 'EPA'),
+            ('T3', 'A2', 'CO 2', 50.0, 2019, 'EPA'),
+            ('T4', 'A3', 'CO 2', 20.0, 2020, 'DOE'),
+            ('T5', 'A3', 'CO 3', 30.0, 2020, 'DOE'),
+            ('T6', 'A4', 'CO 3', 99.0, 2020, 'DOE')])
+    db.refresh_rollups()
+    yield db
+    db.close_conn()
+
+def test_scores_roll_over_fiscal_years(db, monkeypatch):
+    monkeypatch.setattr(settings, 'RANK_WEIGHTS', {'dollars': 1.0, 'awards': 0.0})
+    rows = {(r[0], r[1], r[2]): r for r in rankings.iter_scores(db, fiscal_years=[2020])}
+    assert {key[2] for key in rows} == {2020}
+    # CO 1's 2017 dollars are outside the 3 year window, CO 2's 2019 dollars are inside it
+    assert rows[('CO 1', 541620, 2020)][3] == 10.0
+    assert rows[('CO 2', 541620, 2020)][3:5] == (70.0, 2)
+    assert rows[('CO 2', 541620, 2020)][5] == pytest.approx(70 / 110)
+    assert rows[('CO 3', 541330, 2020)][5] == pytest.approx(1.0)
+    assert len(list(rankings.iter_scores(db, rolling_years=5, fiscal_years=[2020], naics_codes=[541330]))) == 1
+    # Recipients without actions in a fiscal year are still scored on the earlier years in its window
+    rows = {r[0]: r for r in rankings.iter_scores(db, fiscal_years=[2019])}
+    assert rows['CO 1'][3] == 100.0 and rows['CO 1'][5] == pytest.approx(100 / 150)
+    assert rows.keys() == {'CO 1', 'CO 2'}
+
+def test_competitors_top_k(db):
+    top = rankings.competitors(db, 541620, 2020, k=2)
+    assert [r['recipient_name'] for r in top] == ['CO 2', 'CO 3']
+    assert top[0]['recipient_city'] == 'RESTON'
+    ranked = rankings.rank_competitors(db, fiscal_years=[2019, 2020], k=1, by='rolling_dollars')
+    assert {g: [r['recipient_name'] for r in rows] for g, rows in ranked.items()} == {
+        (541620, 2019): ['CO 1'], (541620, 2020): ['CO 2'], (541330, 2020): ['CO 3']}
+
+def test_top_k_by_group_matches_sort():
+    rng = random.Random(0)
+    rows = [(rng.randrange(5), rng.random()) for _ in range(2000)]
+    ranked = rankings.top_k_by_group(rows, 7, group=lambda r: r[0], key=lambda r: r[1])
+    for g in range(5):
+        assert ranked[g] == sorted([r for r in rows if r[0] == g], key=lambda r: r[1], reverse=True)[:7]
+    assert rankings.top_k(rows, 3, key=lambda r: r[1]) == sorted(rows, key=lambda r: r[1], reverse=True)[:3]
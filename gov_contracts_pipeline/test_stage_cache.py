@@ -0,0 +1,52 @@
+
+import os
+
+import settings
+import manage
+import stage_cache
+import data_quality
+
+
+def test_cached_task_skips_rerun(tmp_path):
+    src = tmp_path / 'raw.csv'
+    src.write_text('a,b\n1,2\n')
+    cache = stage_cache.StageCache(str(tmp_path / 'cache'))
+    p = manage.Pipeline(log_path=str(tmp_path / 'log.jsonl'), cache=cache)
+    calls = []
+
+    @p.task(cache_files=lambda fn: [fn])
+    def clean(fn):
+        calls.append(fn)
+        return open(fn).read().upper()
+
+    @p.task(depends_on=clean)
+    def downstream(data):
+        return data.split(',')
+
+    assert p.run(str(src)) == ['A', 'B\n1', '2\n']
+    assert p.run(str(src)) == ['A', 'B\n1', '2\n']
+    assert len(calls) == 1
+
+    src.write_text('a,b\n3,4\n')
+    assert p.run(str(src))[2] == '4\n'
+    assert len(calls) == 2
+
+def test_lru_eviction_by_size(tmp_path):
+    cache = stage_cache.StageCache(str(tmp_path), max_bytes=3500)
+    for i in range(3):
+        cache.put(f'k{i}', b'x' * 1000)
+        os.utime(cache.path(f'k{i}'), (i, i))
+    cache.get('k0')  # k0 is now the most recently used
+    cache.put('k3', b'x' * 1000)
+    assert sorted(f for f in os.listdir(tmp_path)) == ['k0.pkl', 'k2.pkl', 'k3.pkl']
+
+def test_key_covers_cleaning_settings(tmp_path, monkeypatch):
+    cache = stage_cache.StageCache(str(tmp_path))
+    modules = manage.pipeline.caching[manage.first_task][1]
+    assert data_quality in modules
+    key = cache.key(manage.first_task, (None,), (), modules)
+    assert cache.key(manage.first_task, (None,), (), modules) == key
+    monkeypatch.setattr(settings, 'source_dtypes', {**settings.source_dtypes, 'naics_code': 'object'})
+    dtypes_key = cache.key(manage.first_task, (None,), (), modules)
+    monkeypatch.setattr(settings, 'QUALITY_MAX_VIOLATION_RATE', 0.5)
+    assert len({key, dtypes_key, cache.key(manage.first_task, (None,), (), modules)}) == 3
@@ -0,0 +1,92 @@
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import feature_store as fstore
+import rolling
+
+
+def make_bars(years: int=50, seed: int=0) -> pd.DataFrame:
+    """Synthetic daily bars (business days), shaped like the price store's history()
+
+    Args:
+        years (int, optional): Years of bars. Defaults to 50.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: Bars indexed by symbol and date
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end='2021-12-31', periods=years * 252)
+    close = 90 * np.exp(np.cumsum(rng.normal(0.0003, 0.011, len(dates))))
+    spread = close * rng.uniform(0.002, 0.03, len(dates))
+    bars = pd.DataFrame({
+        'symbol': '^GSPC',
+        'date': dates,
+        'open': close,
+        'high': close + spread / 2,
+        'low': close - spread / 2,
+        'close': close,
+        'volume': rng.integers(10**6, 10**9, len(dates))})
+    return bars.set_index(['symbol', 'date'])
+
+def timed(f, repeat: int=5) -> float:
+    """Best of repeat runs of f() in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        f()
+        secs = perf_counter() - start
+        best = secs if best is None else min(best, secs)
+    return best
+
+def current_methods(p):
+    p.multiple_avg_periods()
+    p.multiple_std_periods()
+    p.multiple_avg_hl_periods()
+    return p
+
+def batched(p):
+    p.multiple_rolling_periods()
+    return p
+
+def fresh(pipeline):
+    """Resets a pipeline's df and features (so timings leave out FeaturesPipeline's setup)"""
+    pipeline.df, pipeline.features = pipeline.original_df.copy(), []
+    return pipeline
+
+def run_benchmark(years: int=50, repeat: int=5) -> dict:
+    """Times the per window rolling methods against the batched kernel, and checks they match
+
+    Returns:
+        dict: Seconds per variant (best of repeat)
+    """
+    bars = make_bars(years)
+    base = fstore.FeaturesPipeline(bars).df
+    p = fstore.FeaturesPipeline(base)
+    expected, actual = current_methods(fresh(p)).df, batched(fresh(p)).df
+    assert list(expected.columns) == list(actual.columns)
+    # pandas' rolling std adds and removes values from running sums over the whole series, on 50 years of prices
+    # its 2 period stds drift ~5e-6 from a direct per window std (the batched kernel stays within ~3e-9)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-6, atol=1e-5)
+
+    results = {
+        'bars': len(bars),
+        'current_methods': timed(lambda: current_methods(fresh(p)), repeat),
+        'batched': timed(lambda: batched(fresh(p)), repeat)}
+    close, spread = p.df['close'].to_numpy(), (p.df['high'] - p.df['low']).to_numpy()
+    out = np.empty((len(close), 9))
+    windows = ([2, 3, 5], [2, 3], [2, 3, 5, 30])
+    results['kernel_numpy'] = timed(lambda: rolling.rolling_features(close, spread, *windows, out=out, use_numba=False), repeat)
+    if rolling.njit is not None:
+        rolling.rolling_features(close, spread, *windows, out=out, use_numba=True)  # compile
+        results['kernel_numba'] = timed(lambda: rolling.rolling_features(close, spread, *windows, out=out, use_numba=True), repeat)
+    return results
+
+
+if __name__ == '__main__':
+    results = run_benchmark()
+    print(f"{results.pop('bars')} daily bars")
+    for name, secs in results.items():
+        print(f'{name:<16} {secs * 1000:8.2f} ms')
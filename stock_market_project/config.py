@@ -27,6 +27,20 @@ STOCK_TICKER = '^GSPC'
 
 START_DATE = '1970-01-01'
 
+# Local daily bar store (see price_store.py), bars are only fetched after the last stored date
+PRICE_STORE_PATH = os.path.join(DATA_DIR, 'prices.db')
+
+# Where new bars come from: 'yahoo' (yahooquery) or 'csv' (<ticker>.csv files in PRICE_CSV_DIR, e.g. test fixtures)
+PRICE_FETCHER = 'yahoo'
+
+PRICE_CSV_DIR = os.path.join(ROOT_DIR, 'fixtures')
+
+# Seconds before a ticker's store is checked for new bars again
+PRICE_REFRESH_SECS = 6 * 60 * 60
+
+# Compute the rolling features with rolling.py's numba kernel when numba is installed (numpy kernel otherwise)
+ROLLING_USE_NUMBA = True
+
 # funcs for generating file paths [don't need to import os for creating new file paths]
 def new_fpath(fname, directory_var=ROOT_DIR):
     """Generates a new file path in the directory_var (does not create actual file)
@@ -1,10 +1,12 @@
 from datetime import timedelta
 import datetime as dt
 
-from yahooquery import Ticker
+import numpy as np
 import pandas as pd
 
 import config as cfg
+import price_store
+import rolling
 
 
 class FeaturesPipeline():
@@ -115,6 +117,28 @@ class FeaturesPipeline():
             self.df = self.avg_high_low_period(n)
         return self.df
     
+    def multiple_rolling_periods(self, mean_windows: list=[2, 3, 5], std_windows: list=[2, 3], hl_windows: list=[2, 3, 5, 30]):
+        """Calculates the avg, std and avg high low features of multiple_avg_periods, multiple_std_periods and
+        multiple_avg_hl_periods in one batch (see rolling.rolling_features)
+
+        Args:
+            mean_windows (list, optional): Periods to average. Defaults to [2, 3, 5].
+            std_windows (list, optional): Periods for standard deviations. Defaults to [2, 3].
+            hl_windows (list, optional): Periods for avg high low differences. Defaults to [2, 3, 5, 30].
+
+        Returns:
+            pd.DataFrame: Updated df.
+        """        
+        new_cols = [f'avg_{n}_periods' for n in mean_windows]
+        new_cols += [f'std_{n}_periods' for n in std_windows]
+        new_cols += [f'high_low_{n}_periods' for n in hl_windows]
+        matrix = np.empty((len(self.df), len(new_cols)))
+        rolling.rolling_features(self.df[self.target_col].to_numpy(), (self.df['high'] - self.df['low']).to_numpy(),
+                                 mean_windows, std_windows, hl_windows, out=matrix)
+        self.features += new_cols
+        self.df = pd.concat([self.df, pd.DataFrame(matrix, columns=new_cols, index=self.df.index)], axis=1)
+        return self.df
+
     def prev_day_close_period(self, window: int=1):
         """Prev day closing price  
 
@@ -155,9 +179,11 @@ class FeaturesPipeline():
         """        
         self.add_weekday()
        
-        self.multiple_avg_periods(**kwargs)
-        self.multiple_std_periods(**kwargs)
-        self.multiple_avg_hl_periods(**kwargs)
+        windows = kwargs.get('windows')
+        if windows is None:
+            self.multiple_rolling_periods()
+        else:
+            self.multiple_rolling_periods(windows, windows, windows)
         
         self.df = self.df.dropna()
         if encode:
@@ -203,8 +229,7 @@ def get_prev_close_date(today: dt.date=cfg.TODAY_DATE, date_string: bool=False):
 def get_new_data(ticker: str=None, get_df: bool=False):
     
     if not ticker:
-        stock = Ticker(cfg.STOCK_TICKER)
-        stock_df = stock.history(period='max', interval='1d', start=cfg.START_DATE)
+        stock_df = price_store.get_store().history(cfg.STOCK_TICKER, start=cfg.START_DATE)
         pipeline = FeaturesPipeline(stock_df)
         X, y = pipeline.run()
         if get_df:
@@ -213,10 +238,9 @@ def get_new_data(ticker: str=None, get_df: bool=False):
         return X, y
     else:
         try:
-            stock = Ticker(ticker)
+            stock_df = price_store.get_store().history(ticker, start=cfg.START_DATE)
         except:
             raise Exception(f'{ticker} not a valid ticker symbol, or is not accepted via yahoo finance')
-        stock_df = stock.history(period='max', interval='1d', start=cfg.START_DATE)
         cfg.STOCK_TICKER = ticker
         pipeline = FeaturesPipeline(stock_df)
         X, y = pipeline.run()
@@ -255,7 +279,7 @@ pipeline = Pipeline()
 
 @pipeline.task()
 def first_task(ticker: str=None) -> pd.DataFrame:
-    """Get dataframe from yahoo finance
+    """Get dataframe from the local price store (new bars are fetched from yahoo finance, see price_store.py)
 
     Args:
         ticker (str, optional): ticker symbol to collect data for. Defaults to None.
@@ -266,14 +290,7 @@ def first_task(ticker: str=None) -> pd.DataFrame:
     Returns:
         pd.DataFrame: The un-engineered dataframe
     """    
-    if not ticker:
-        stock = Ticker(cfg.STOCK_TICKER) 
-    else:
-        try:
-            stock = Ticker(ticker)
-        except:
-            raise Exception(f'{ticker} not valid stock ticker')
-    stock_df = stock.history(period='max', interval='1d')
+    stock_df = price_store.get_store().history(ticker or cfg.STOCK_TICKER)
     return stock_df
         
 @pipeline.task(depends_on=first_task)
@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+
+import pandas as pd
+
+import config as cfg
+
+
+# Daily bar columns kept in the store (in yahooquery's history() naming)
+PRICE_COLS = ['open', 'high', 'low', 'close', 'volume', 'adjclose', 'dividends', 'splits']
+PRICE_COL_TYPES = {c: 'INTEGER' if c == 'volume' else 'REAL' for c in PRICE_COLS}
+
+
+class YahooFetcher():
+    """Fetches daily bars from yahoo finance (yahooquery)"""
+
+    def fetch(self, ticker: str, start: str=None) -> pd.DataFrame:
+        """Daily bars for a ticker
+
+        Args:
+            ticker (str): Ticker symbol.
+            start (str, optional): First date to fetch ('%Y-%m-%d'). Defaults to None (full history).
+
+        Raises:
+            Exception: if ticker is invalid.
+
+        Returns:
+            pd.DataFrame: Bars with a date column and PRICE_COLS
+        """
+        from yahooquery import Ticker  # only needed when fetching from yahoo
+        try:
+            stock = Ticker(ticker)
+        except:
+            raise Exception(f'{ticker} not valid stock ticker')
+        if start:
+            stock_df = stock.history(interval='1d', start=start)
+        else:
+            stock_df = stock.history(period='max', interval='1d')
+        if not isinstance(stock_df, pd.DataFrame):
+            # yahooquery returns the error message (or a dict of them) instead of a df
+            if start and 'No data found' in str(stock_df):
+                return pd.DataFrame(columns=['date'] + PRICE_COLS)
+            raise Exception(f'{ticker} not valid stock ticker')
+        return stock_df.reset_index()
+
+
+class CsvFetcher():
+    def __init__(self, directory: str=None):
+        """Fetches daily bars from local <ticker>.csv files (e.g. test fixtures)
+
+        Args:
+            directory (str, optional): Directory of the csv files. Defaults to cfg.PRICE_CSV_DIR.
+        """
+        self.directory = directory or cfg.PRICE_CSV_DIR
+
+    def fetch(self, ticker: str, start: str=None) -> pd.DataFrame:
+        fname = cfg.new_fpath(f'{ticker}.csv', self.directory)
+        if not os.path.isfile(fname):
+            raise Exception(f'{ticker} not valid stock ticker')
+        stock_df = pd.read_csv(fname)
+        if start:
+            stock_df = stock_df[pd.to_datetime(stock_df['date']) >= pd.Timestamp(start)]
+        return stock_df
+
+
+FETCHERS = {'yahoo': YahooFetcher, 'csv': CsvFetcher}
+
+
+class PriceStore():
+    def __init__(self, path: str=None, fetcher=None, refresh_secs: int=None):
+        """## Local store of daily bars (one sqlite file, rows keyed by ticker and date)
+
+        history() reads from the store and only fetches the bars from the last stored date on,
+        at most once every refresh_secs per ticker.
+
+        Args:
+            path (str, optional): sqlite file. Defaults to cfg.PRICE_STORE_PATH.
+            fetcher (optional): Object with fetch(ticker, start) returning bars. Defaults to cfg.PRICE_FETCHER's.
+            refresh_secs (int, optional): Seconds before a ticker is checked for new bars again. Defaults to cfg.PRICE_REFRESH_SECS.
+        """
+        self.path = path or cfg.PRICE_STORE_PATH
+        self.fetcher = fetcher or FETCHERS[cfg.PRICE_FETCHER]()
+        self.refresh_secs = cfg.PRICE_REFRESH_SECS if refresh_secs is None else refresh_secs
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.connect() as conn:
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS prices (
+                symbol TEXT,
+                date TEXT,
+                {', '.join(f'{c} {PRICE_COL_TYPES[c]}' for c in PRICE_COLS)},
+                PRIMARY KEY (symbol, date)
+            ) WITHOUT ROWID;''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS symbols (
+                symbol TEXT PRIMARY KEY,
+                checked_at REAL
+            );''')
+
+    @contextmanager
+    def connect(self):
+        """Connection to the store, committed (or rolled back) and closed on exit"""
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            yield conn
+
+    def last_date(self, ticker: str) -> str:
+        with self.connect() as conn:
+            return conn.execute('SELECT MAX(date) FROM prices WHERE symbol = ?', (ticker,)).fetchone()[0]
+
+    def checked_at(self, ticker: str) -> float:
+        with self.connect() as conn:
+            row = conn.execute('SELECT checked_at FROM symbols WHERE symbol = ?', (ticker,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, ticker: str) -> int:
+        """Fetches and stores the bars from the last stored date on (the full history for a new ticker).
+        The last stored bar is fetched again, in case it was stored before the close.
+
+        Args:
+            ticker (str): Ticker symbol.
+
+        Returns:
+            int: Number of bars stored
+        """
+        last = self.last_date(ticker)
+        new_df = self.fetcher.fetch(ticker, last)
+        rows = []
+        if not new_df.empty:
+            new_df = new_df.copy()
+            new_df['date'] = pd.to_datetime(new_df['date'].astype(str).str[:10]).dt.strftime('%Y-%m-%d')
+            for c in PRICE_COLS:
+                if c not in new_df.columns:
+                    new_df[c] = None
+            new_df = new_df[new_df['date'] >= last] if last else new_df
+            new_df = new_df.drop_duplicates('date', keep='last')
+            values = new_df[['date'] + PRICE_COLS].astype(object)  # native python values (sqlite has no numpy adapters)
+            values = values.where(values.notna(), None)
+            rows = [(ticker, *row) for row in values.itertuples(index=False)]
+        with self.connect() as conn:
+            conn.executemany(f'''INSERT OR REPLACE INTO prices (symbol, date, {', '.join(PRICE_COLS)})
+                VALUES ({', '.join('?' * (len(PRICE_COLS) + 2))})''', rows)
+            conn.execute('INSERT OR REPLACE INTO symbols (symbol, checked_at) VALUES (?, ?)', (ticker, time.time()))
+        return len(rows)
+
+    def read(self, ticker: str, start: str=None) -> pd.DataFrame:
+        """Stored bars for a ticker, shaped like yahooquery's history() (indexed by symbol and date)
+
+        Args:
+            ticker (str): Ticker symbol.
+            start (str, optional): First date ('%Y-%m-%d'). Defaults to None.
+
+        Returns:
+            pd.DataFrame: Bars
+        """
+        with self.connect() as conn:
+            stock_df = pd.read_sql_query(f'''SELECT symbol, date, {', '.join(PRICE_COLS)} FROM prices
+                WHERE symbol = ? AND date >= ? ORDER BY date''', conn, params=(ticker, start or ''))
+        stock_df['date'] = pd.to_datetime(stock_df['date'])
+        return stock_df.set_index(['symbol', 'date'])
+
+    def history(self, ticker: str, start: str=None) -> pd.DataFrame:
+        """Daily bars for a ticker, fetching new ones first if the ticker hasn't been checked in refresh_secs
+
+        Args:
+            ticker (str): Ticker symbol.
+            start (str, optional): First date ('%Y-%m-%d'). Defaults to None.
+
+        Raises:
+            Exception: if ticker is invalid.
+
+        Returns:
+            pd.DataFrame: Bars (see read)
+        """
+        with self.lock:
+            checked_at = self.checked_at(ticker)
+            if checked_at is None or time.time() - checked_at >= self.refresh_secs:
+                self.update(ticker)
+        return self.read(ticker, start)
+
+
+_stores = {}
+
+def get_store(path: str=None) -> PriceStore:
+    """Shared PriceStore for a path (one per process, so dashboard reruns reuse it)"""
+    path = path or cfg.PRICE_STORE_PATH
+    if path not in _stores:
+        _stores[path] = PriceStore(path)
+    return _stores[path]
@@ -0,0 +1,212 @@
+import numpy as np
+
+import config as cfg
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the numpy kernel is used without it
+    njit = None
+
+
+# Statistics of rolling_features, a window's columns are ordered like the windows
+STATS = ('mean', 'std', 'spread')
+
+
+def block_prefix_sums(x: np.ndarray, block: int, squares: bool=True) -> dict:
+    """Prefix sums of x (and x**2) restarted every `block` rows, around each block's mean
+
+    Summing deviations from a local reference instead of the raw values keeps the sums small, so
+    window variances taken as differences of them don't lose their precision to decades of prices.
+    Everything is laid out per row, so window_sums only needs slices.
+
+    Args:
+        x (np.ndarray): Values (NaNs count as 0, see nan_prefix).
+        block (int): Rows per block (at least the largest window, so a window spans at most 2 blocks).
+        squares (bool, optional): Also sum the squared deviations (std windows). Defaults to True.
+
+    Returns:
+        dict: Per row arrays: s1/s2 (sums of deviations/squared deviations from the block start through the row),
+            before1/before2 (the same sums before the row), total1/total2 (the block's sums), ref (block mean),
+            block (block number), count (rows from the block start through the row)
+    """
+    n = len(x)
+    n_blocks = -(-n // block)
+    padded = np.zeros(n_blocks * block)
+    padded[:n] = x
+    padded = padded.reshape(n_blocks, block)
+    counts = np.full(n_blocks, block)
+    counts[-1] = n - (n_blocks - 1) * block
+    nans = np.isnan(padded)
+    if nans.any():
+        counts -= nans.sum(axis=1)
+        padded[nans] = 0
+    ref = padded.sum(axis=1) / np.maximum(counts, 1)
+    dev = padded - ref[:, None]
+    dev[nans] = 0
+    dev.ravel()[n:] = 0
+    rows = np.arange(n)
+    s1 = np.cumsum(dev, axis=1)
+    sums = {
+        's1': s1.ravel()[:n],
+        'before1': (s1 - dev).ravel()[:n],
+        'total1': np.repeat(s1[:, -1], block)[:n],
+        'ref': np.repeat(ref, block)[:n],
+        'block': rows // block,
+        'count': rows % block + 1}
+    if squares:
+        dev *= dev
+        s2 = np.cumsum(dev, axis=1)
+        sums.update({'s2': s2.ravel()[:n], 'before2': (s2 - dev).ravel()[:n], 'total2': np.repeat(s2[:, -1], block)[:n]})
+    return sums
+
+def nan_prefix(x: np.ndarray) -> np.ndarray:
+    """Running count of NaNs (a window with any NaN gets a NaN feature, like pandas' rolling)"""
+    counts = np.zeros(len(x) + 1, dtype=np.int64)
+    np.cumsum(np.isnan(x), out=counts[1:])
+    return counts
+
+def window_sums(sums: dict, n: int, w: int) -> tuple:
+    """Sums of the previous w values (and of their squares) for rows w..n-1, around the window's first block mean
+
+    Args:
+        sums (dict): block_prefix_sums of the values.
+        n (int): Rows.
+        w (int): Window.
+
+    Returns:
+        tuple: ref of each window, sums of deviations, sums of squared deviations
+    """
+    first, last = slice(0, n - w), slice(w - 1, n - 1)  # first and last row of each window
+    squares = 's2' in sums
+    s = sums['s1'][last] - sums['before1'][first]
+    q = sums['s2'][last] - sums['before2'][first] if squares else None
+    cross = sums['block'][last] != sums['block'][first]
+    if cross.any():
+        # the window ends in the next block: finish the first block's sums and move the second block's
+        # deviations (k rows, sums s1/s2 at the last row) to the first block's mean
+        k = sums['count'][last][cross]
+        delta = sums['ref'][last][cross] - sums['ref'][first][cross]
+        s1_last = sums['s1'][last][cross]
+        s[cross] += sums['total1'][first][cross] + k * delta
+        if squares:
+            q[cross] += sums['total2'][first][cross] + 2 * delta * s1_last + k * delta * delta
+    return sums['ref'][first], s, q
+
+def rolling_features_numpy(close, spread, mean_windows, std_windows, spread_windows, out):
+    n = len(close)
+    block = max([64, *mean_windows, *std_windows, *spread_windows])
+    close_sums = block_prefix_sums(close, block, squares=len(std_windows) > 0)
+    spread_sums = block_prefix_sums(spread, block, squares=False) if len(spread_windows) else None
+    close_nans = nan_prefix(close) if np.isnan(close).any() else None
+    spread_nans = nan_prefix(spread) if np.isnan(spread).any() else None
+    col = 0
+    for stat, windows in zip(STATS, (mean_windows, std_windows, spread_windows)):
+        sums, nans = (spread_sums, spread_nans) if stat == 'spread' else (close_sums, close_nans)
+        for w in windows:
+            column = out[:, col]
+            column[:min(w, n)] = np.nan
+            col += 1
+            if w >= n:
+                continue
+            ref, s, q = window_sums(sums, n, w)
+            if stat == 'std':
+                if w < 2:
+                    column[w:] = np.nan
+                    continue
+                var = (q - s * s / w) / (w - 1)
+                column[w:] = np.sqrt(np.maximum(var, 0))
+            else:
+                column[w:] = ref + s / w
+            if nans is not None:
+                column[w:][nans[w:n] - nans[:n - w] > 0] = np.nan
+    return out
+
+def rolling_features_loops(close, spread, mean_windows, std_windows, spread_windows, out):
+    """The same kernel as one loop over the rows (compiled with numba when it's installed)
+
+    Keeps running sums of each window, updated by the value entering and the one leaving it. The sums are
+    rebuilt around a value of the window every w rows, so rounding can't build up over decades of prices.
+    """
+    n = close.shape[0]
+    col = 0
+    for kind in range(3):
+        windows = mean_windows if kind == 0 else std_windows if kind == 1 else spread_windows
+        x = spread if kind == 2 else close
+        for j in range(windows.shape[0]):
+            w = windows[j]
+            s = 0.0
+            q = 0.0
+            nans = 0
+            ref = 0.0
+            for t in range(min(w, n)):
+                out[t, col] = np.nan
+            for t in range(w, n):
+                if (t - w) % w == 0:
+                    s = 0.0
+                    q = 0.0
+                    nans = 0
+                    ref = 0.0
+                    for i in range(t - w, t):
+                        if not np.isnan(x[i]):
+                            ref = x[i]
+                            break
+                    for i in range(t - w, t):
+                        if np.isnan(x[i]):
+                            nans += 1
+                        else:
+                            s += x[i] - ref
+                            q += (x[i] - ref) * (x[i] - ref)
+                else:
+                    old = x[t - w - 1]
+                    if np.isnan(old):
+                        nans -= 1
+                    else:
+                        s -= old - ref
+                        q -= (old - ref) * (old - ref)
+                    new = x[t - 1]
+                    if np.isnan(new):
+                        nans += 1
+                    else:
+                        s += new - ref
+                        q += (new - ref) * (new - ref)
+                if nans > 0 or (kind == 1 and w < 2):
+                    out[t, col] = np.nan
+                elif kind == 1:
+                    var = (q - s * s / w) / (w - 1)
+                    out[t, col] = np.sqrt(var) if var > 0 else 0.0
+                else:
+                    out[t, col] = ref + s / w
+            col += 1
+    return out
+
+if njit is not None:
+    rolling_features_loops = njit(cache=True)(rolling_features_loops)
+
+def rolling_features(close, spread, mean_windows=(), std_windows=(), spread_windows=(), out=None, use_numba=None):
+    """## Batched rolling features of the previous w bars for every window
+
+    The same values as pandas' x.shift(1).rolling(w).mean() / .std() for each window, computed from one set
+    of prefix sums per input and written into one preallocated matrix.
+
+    Args:
+        close (array-like): Target values (mean and std windows).
+        spread (array-like): High - low values (spread windows, the mean high minus the mean low).
+        mean_windows (list, optional): Windows of the mean of close. Defaults to ().
+        std_windows (list, optional): Windows of the standard deviation of close. Defaults to ().
+        spread_windows (list, optional): Windows of the mean of spread. Defaults to ().
+        out (np.ndarray, optional): (rows, windows) float64 matrix to fill. Defaults to None (allocated).
+        use_numba (bool, optional): Use the compiled loop kernel. Defaults to cfg.ROLLING_USE_NUMBA if numba is installed.
+
+    Returns:
+        np.ndarray: Features, columns ordered mean windows, std windows, spread windows
+    """
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    spread = np.ascontiguousarray(spread, dtype=np.float64)
+    windows = [np.asarray(w, dtype=np.int64) for w in (mean_windows, std_windows, spread_windows)]
+    cols = sum(len(w) for w in windows)
+    if out is None:
+        out = np.empty((len(close), cols))
+    if use_numba is None:
+        use_numba = cfg.ROLLING_USE_NUMBA and njit is not None
+    kernel = rolling_features_loops if use_numba else rolling_features_numpy
+    return kernel(close, spread, *windows, out)
@@ -0,0 +1,80 @@
+import shutil
+
+import pandas as pd
+import pytest
+
+import config as cfg
+import price_store
+
+
+FIXTURE = cfg.new_fpath('TEST.csv', cfg.PRICE_CSV_DIR)
+
+
+class SpyFetcher(price_store.CsvFetcher):
+    """CsvFetcher that records the start of each fetch"""
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.starts = []
+
+    def fetch(self, ticker, start=None):
+        self.starts.append(start)
+        return super().fetch(ticker, start)
+
+
+@pytest.fixture
+def bars():
+    return pd.read_csv(FIXTURE, parse_dates=['date'])
+
+@pytest.fixture
+def fetcher(tmp_path):
+    shutil.copy(FIXTURE, tmp_path / 'TEST.csv')
+    return SpyFetcher(str(tmp_path))
+
+@pytest.fixture
+def store(tmp_path, fetcher):
+    return price_store.PriceStore(str(tmp_path / 'prices.db'), fetcher, refresh_secs=0)
+
+def test_cold_fill_stores_the_full_history(store, fetcher, bars):
+    history = store.history('TEST')
+    assert fetcher.starts == [None]
+    assert history.index.names == ['symbol', 'date']
+    assert history.index.get_level_values('symbol').unique().tolist() == ['TEST']
+    pd.testing.assert_frame_equal(history.reset_index(drop=True), bars[price_store.PRICE_COLS])
+    assert history['volume'].dtype == 'int64'
+    assert store.last_date('TEST') == '2021-12-14'
+
+def test_update_refetches_from_the_last_stored_bar(tmp_path, store, fetcher, bars):
+    bars[:6].to_csv(tmp_path / 'TEST.csv', index=False)
+    assert store.update('TEST') == 6
+    assert store.last_date('TEST') == '2021-12-08'
+
+    # the 12/08 bar was stored before the close, the next fetch corrects it
+    updated = bars.copy()
+    updated.loc[5, 'close'] = 4700.58
+    updated.to_csv(tmp_path / 'TEST.csv', index=False)
+    assert store.update('TEST') == 5
+    assert fetcher.starts == [None, '2021-12-08']
+    history = store.read('TEST')
+    assert len(history) == len(bars)
+    assert history['close'].tolist() == updated['close'].tolist()
+
+    assert store.update('TEST') == 1  # nothing new, only the last bar again
+    assert len(store.read('TEST')) == len(bars)
+
+def test_start_filters_the_bars(store, fetcher, bars):
+    history = store.history('TEST', start='2021-12-09')
+    assert history.index.get_level_values('date').tolist() == bars['date'][bars['date'] >= '2021-12-09'].tolist()
+    assert len(store.read('TEST')) == len(bars)  # only the read is filtered, the store has the full history
+    assert fetcher.fetch('TEST', '2021-12-13')['date'].tolist() == ['2021-12-13', '2021-12-14']
+
+def test_history_fetches_at_most_once_per_refresh(tmp_path, fetcher):
+    store = price_store.PriceStore(str(tmp_path / 'prices.db'), fetcher, refresh_secs=3600)
+    store.history('TEST')
+    store.history('TEST', start='2021-12-10')
+    assert fetcher.starts == [None]
+
+def test_invalid_ticker_raises(store, fetcher):
+    with pytest.raises(Exception, match='NOPE not valid stock ticker'):
+        store.history('NOPE')
+    assert store.checked_at('NOPE') is None
+    assert store.read('NOPE').empty
@@ -0,0 +1,64 @@
+import functools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_store as fstore
+import rolling
+
+
+def make_bars(n, seed=0, nans=()):
+    """Daily bars for FeaturesPipeline, with NaN closes/highs at the given positions"""
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    spread = close * rng.uniform(0.002, 0.03, n)
+    bars = pd.DataFrame({
+        'date': pd.bdate_range('2020-01-01', periods=n),
+        'high': close + spread / 2,
+        'low': close - spread / 2,
+        'volume': rng.integers(10**6, 10**9, n),
+        'close': close})
+    bars.loc[list(nans), ['close', 'high']] = np.nan
+    return bars
+
+def per_window(bars, mean_windows, std_windows, hl_windows):
+    p = fstore.FeaturesPipeline(bars)
+    p.multiple_avg_periods(mean_windows)
+    p.multiple_std_periods(std_windows)
+    p.multiple_avg_hl_periods(hl_windows)
+    return p.df
+
+def batched(bars, mean_windows, std_windows, hl_windows):
+    p = fstore.FeaturesPipeline(bars)
+    p.multiple_rolling_periods(mean_windows, std_windows, hl_windows)
+    return p.df
+
+CASES = {
+    'defaults': (make_bars(500), [2, 3, 5], [2, 3], [2, 3, 5, 30]),
+    'leading_nans': (make_bars(300, nans=range(7)), [2, 5], [2, 3], [3, 30]),
+    'gaps': (make_bars(300, nans=[40, 41, 150, 299]), [2, 5, 64, 65], [2, 10, 100], [3, 30]),
+    'window_of_1': (make_bars(100, nans=[10]), [1, 2], [1, 2], [1]),
+    'window_past_the_end': (make_bars(20), [19, 20, 25], [20, 30], [19, 21]),
+}
+
+@pytest.mark.parametrize('use_numba', [False, True], ids=['numpy', 'loops'])
+@pytest.mark.parametrize('case', CASES)
+def test_kernels_match_the_per_window_methods(case, use_numba, monkeypatch):
+    # the loop kernel runs as plain python when numba isn't installed
+    monkeypatch.setattr(rolling, 'rolling_features', functools.partial(rolling.rolling_features, use_numba=use_numba))
+    bars, *windows = CASES[case]
+    expected, actual = per_window(bars, *windows), batched(bars, *windows)
+    assert list(actual.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-9, atol=1e-9)
+
+@pytest.mark.parametrize('use_numba', [False, True], ids=['numpy', 'loops'])
+def test_rolling_features_fills_out(use_numba):
+    bars = make_bars(50, nans=[0])
+    close, spread = bars['close'].to_numpy(), (bars['high'] - bars['low']).to_numpy()
+    out = np.full((50, 3), -1.0)
+    assert rolling.rolling_features(close, spread, [3], [3], [3], out=out, use_numba=use_numba) is out
+    assert np.isnan(out[:4]).all()  # the first window and the one with the NaN
+    assert not np.isnan(out[4:]).any()
+    np.testing.assert_allclose(out[4:, 0], bars['close'].shift(1).rolling(3).mean()[4:], rtol=1e-12)
+    assert rolling.rolling_features(close, spread).shape == (50, 0)